@@ -0,0 +1,203 @@
+# asgi.py
+# -*- coding: utf-8 -*-
+'''
+An ASGI front end for Loris, for Python 3.5 or later (see doc/asgi.md).
+
+This is a bridge from an ASGI server to the synchronous Loris: requests go
+through Loris.route(), exactly as they do under WSGI, so they get the same
+LorisRequest parsing, the same caches and the same responses. Nothing in
+Loris is asynchronous. Each request is routed in one thread pool, response
+bodies are read a chunk at a time in another, and the event loop only moves
+bytes to and from clients.
+
+So no more than ``workers`` requests are resolved, fetched or rendered at
+once, as with that many WSGI threads; the rest wait for a thread. A routing
+thread is busy for as long as it takes to decide the response (resolving,
+fetching the source, and rendering unless ``stream_renders`` is on). What is
+gained is that it is then free for the next request, however slowly the
+client reads the image, where a WSGI worker would be tied up until the last
+byte was sent. A body thread is busy only while a chunk is read, or, for a
+streamed render, while the render produces it.
+
+JP2 decodes also go to the transformer's bounded pool of decoder processes
+(``decoder_pool_size``), so a burst of renders can't take every core.
+
+Usage, e.g. with uvicorn::
+
+    # loris2_asgi.py
+    from loris.asgi import create_app
+    application = create_app(config_file_path='/etc/loris2/loris2.conf')
+
+    $ uvicorn loris2_asgi:application
+'''
+from __future__ import absolute_import
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+import sys
+
+from werkzeug.wrappers import Request
+
+from loris import webapp
+
+# Threads routing requests (i.e. resolving, rendering, or looking in the
+# cache) at once.
+WORKERS_DEFAULT = 64
+
+# Threads reading chunks of response bodies (from files, or from streamed
+# renders) at once.
+BODY_WORKERS_DEFAULT = 64
+
+
+def to_environ(scope, body):
+    '''The WSGI environ for an ASGI HTTP ``scope`` and request ``body``.
+
+    As in PEP 3333, strings in the environ are bytes decoded as latin-1, so
+    werkzeug decodes them just as it would under a WSGI server.
+    '''
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        if name in environ:
+            value = environ[name] + ',' + value
+        environ[name] = value
+    return environ
+
+
+class LorisASGI(object):
+    '''
+    An ASGI (3.0, i.e. single callable) application serving ``app``.
+
+    Args:
+        app (webapp.Loris)
+        workers (int): threads routing requests at once.
+        body_workers (int): threads reading response bodies at once. These
+            are kept apart from ``workers``, so that reading the bodies of
+            responses already under way never waits behind new requests,
+            or ties up threads that could be routing them.
+    '''
+    def __init__(self, app, workers=WORKERS_DEFAULT,
+                 body_workers=BODY_WORKERS_DEFAULT):
+        self.app = app
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.body_executor = ThreadPoolExecutor(max_workers=body_workers)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            await self._http(scope, receive, send)
+        elif scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        else:
+            raise ValueError('Unsupported ASGI scope type: %r' % (scope['type'],))
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _http(self, scope, receive, send):
+        body = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.append(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+
+        loop = asyncio.get_event_loop()
+        environ = to_environ(scope, b''.join(body))
+        app_iter, status, headers = await loop.run_in_executor(
+            self.executor, self._respond, environ
+        )
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': status,
+                'headers': headers,
+            })
+            if isinstance(app_iter, (list, tuple)):
+                for chunk in app_iter:
+                    await _send_chunk(send, chunk)
+            else:
+                # Each chunk is read in a body thread: it may come from a
+                # file, or from a render that is still going on.
+                chunks = iter(app_iter)
+                while True:
+                    chunk = await loop.run_in_executor(
+                        self.body_executor, next, chunks, None
+                    )
+                    if chunk is None:
+                        break
+                    await _send_chunk(send, chunk)
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            close = getattr(app_iter, 'close', None)
+            if close is not None:
+                await loop.run_in_executor(self.body_executor, close)
+
+    def shutdown(self, wait=True):
+        '''Shut down both thread pools.'''
+        self.executor.shutdown(wait=wait)
+        self.body_executor.shutdown(wait=wait)
+
+    def _respond(self, environ):
+        '''Routes the request (in a worker thread), as Loris.wsgi_app would.
+
+        Returns:
+            (iterable of bytes, int, [(bytes, bytes)]): the body, status and
+            headers of the response.
+        '''
+        response = self.app.route(Request(environ))
+        app_iter, status, headers = response.get_wsgi_response(environ)
+        headers = [
+            (k.lower().encode('latin-1'), v.encode('latin-1'))
+            for k, v in headers
+        ]
+        return (app_iter, int(status.split(None, 1)[0]), headers)
+
+
+async def _send_chunk(send, chunk):
+    if chunk:
+        await send({
+            'type': 'http.response.body',
+            'body': chunk,
+            'more_body': True,
+        })
+
+
+def create_app(debug=False, debug_jp2_transformer='kdu', config_file_path='',
+               workers=WORKERS_DEFAULT, body_workers=BODY_WORKERS_DEFAULT):
+    '''As webapp.create_app, but returns a LorisASGI.'''
+    return LorisASGI(
+        webapp.create_app(debug, debug_jp2_transformer, config_file_path),
+        workers=workers,
+        body_workers=body_workers
+    )
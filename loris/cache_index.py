@@ -0,0 +1,374 @@
+# cache_index.py
+# -*- coding: utf-8 -*-
+'''
+An SQLite index of the image and info caches, so that a cache hit costs one
+indexed lookup rather than a series of filesystem calls, and the image cache
+can keep itself under a size limit without walking the whole tree (see
+:class:`loris.img.ImageCache` and :class:`loris.img_info.InfoCache`).
+
+For every derivative image, the index records its size, modification time,
+content type and last access, and the request-path symlinks that point at it.
+A running total of the sizes is kept up to date by triggers, so reading it is
+a single row lookup. For every cached info, it records the modification time
+and (for the info.json files of older versions) whether there is a color
+profile alongside it.
+
+Paths are relative to the root of the cache. Files are always written (and
+renamed into place) before they are added to the index, so a reader that
+finds an entry can open the file; if it has gone anyway (e.g. deleted by
+hand), the reader drops the entry and treats it as a miss.
+
+The database is shared by every process using the cache, and is opened in
+WAL mode so that readers don't block the (short) write transactions. Like
+any SQLite database, it must be on a local filesystem.
+
+Run ``bin/loris-cache_index`` to build the index for an existing cache.
+'''
+from __future__ import absolute_import
+
+import argparse
+from logging import getLogger
+import os
+from os import path
+import sqlite3
+import sys
+import threading
+import time
+
+from loris.utils import mkdir_p
+
+logger = getLogger(__name__)
+
+CONFIG_FILE_DEFAULT = '/etc/loris2/loris2.conf'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    atime REAL NOT NULL,
+    mtime REAL NOT NULL,
+    content_type TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_atime ON files (atime);
+
+CREATE TABLE IF NOT EXISTS links (
+    path TEXT PRIMARY KEY,
+    target TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS links_target ON links (target);
+
+CREATE TABLE IF NOT EXISTS total (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    size INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO total VALUES (0, 0);
+
+CREATE TRIGGER IF NOT EXISTS files_insert AFTER INSERT ON files BEGIN
+    UPDATE total SET size = size + NEW.size;
+END;
+CREATE TRIGGER IF NOT EXISTS files_delete AFTER DELETE ON files BEGIN
+    UPDATE total SET size = size - OLD.size;
+END;
+CREATE TRIGGER IF NOT EXISTS files_update AFTER UPDATE OF size ON files BEGIN
+    UPDATE total SET size = size + NEW.size - OLD.size;
+END;
+
+CREATE TABLE IF NOT EXISTS infos (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    has_profile INTEGER NOT NULL
+);
+'''
+
+# Derivatives are named {quality}.{format}; anything else under the cache
+# root (e.g. an InfoCache sharing it) is left out of the files table.
+QUALITIES = ('default', 'color', 'gray', 'bitonal', 'native')
+FORMATS = ('jpg', 'png', 'gif', 'webp', 'tif')
+
+
+def is_derivative(name):
+    stem, _, ext = name.rpartition('.')
+    return stem in QUALITIES and ext in FORMATS
+
+
+class CacheIndex(object):
+    '''
+    Args:
+        db_fp (str): the SQLite database; created if it doesn't exist.
+
+    Each thread (and process) gets its own connection. Access times are
+    recorded in memory by :meth:`touch` and written in bulk by :meth:`flush`,
+    so that serving a cached image doesn't cost a write transaction.
+    '''
+    def __init__(self, db_fp):
+        self.db_fp = db_fp
+        self._local = threading.local()
+        self._touched = {}
+        self._touched_lock = threading.Lock()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            mkdir_p(path.dirname(self.db_fp))
+            conn = sqlite3.connect(self.db_fp, timeout=60)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def add(self, rel_fp, size, mtime, content_type, atime=None):
+        '''Record a new (or re-rendered) file.'''
+        atime = atime or time.time()
+        conn = self._connection()
+        with conn:
+            cursor = conn.execute(
+                'UPDATE files SET size = ?, atime = ?, mtime = ?, content_type = ? '
+                'WHERE path = ?',
+                (size, atime, mtime, content_type, rel_fp)
+            )
+            if cursor.rowcount == 0:
+                conn.execute(
+                    'INSERT INTO files (path, size, atime, mtime, content_type) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    (rel_fp, size, atime, mtime, content_type)
+                )
+
+    def add_link(self, rel_link, rel_target):
+        '''Record a symlink to a file, to be removed along with it.'''
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO links (path, target) VALUES (?, ?)',
+                (rel_link, rel_target)
+            )
+
+    def lookup(self, rel_fp):
+        '''
+        Find a file by its own path, or the path of a link to it.
+
+        Returns:
+            (path, size, mtime, content_type), or None if it isn't indexed.
+        '''
+        return self._connection().execute(
+            'SELECT path, size, mtime, content_type FROM files WHERE path = ?1 '
+            'UNION ALL '
+            'SELECT f.path, f.size, f.mtime, f.content_type '
+            'FROM links l JOIN files f ON f.path = l.target WHERE l.path = ?1 '
+            'LIMIT 1',
+            (rel_fp,)
+        ).fetchone()
+
+    def discard(self, rel_fp):
+        '''Forget a file that has gone, by its own path or a link's.'''
+        conn = self._connection()
+        with conn:
+            row = conn.execute(
+                'SELECT target FROM links WHERE path = ?', (rel_fp,)
+            ).fetchone()
+            target = row[0] if row else rel_fp
+            conn.execute('DELETE FROM files WHERE path = ?', (target,))
+            conn.execute('DELETE FROM links WHERE target = ? OR path = ?',
+                (target, rel_fp))
+
+    def touch(self, rel_fp):
+        with self._touched_lock:
+            self._touched[rel_fp] = time.time()
+
+    def flush(self):
+        '''Write the access times recorded by touch().'''
+        with self._touched_lock:
+            touched, self._touched = self._touched, {}
+        if touched:
+            conn = self._connection()
+            with conn:
+                conn.executemany(
+                    'UPDATE files SET atime = ? WHERE path = ? AND atime < ?',
+                    ((t, p, t) for p, t in touched.items())
+                )
+
+    def total_size(self):
+        return self._connection().execute(
+            'SELECT size FROM total'
+        ).fetchone()[0]
+
+    def __len__(self):
+        return self._connection().execute(
+            'SELECT COUNT(*) FROM files'
+        ).fetchone()[0]
+
+    def least_recently_used(self, n):
+        '''Returns [(path, size, atime)] of the n least recently used files.'''
+        return self._connection().execute(
+            'SELECT path, size, atime FROM files ORDER BY atime LIMIT ?', (n,)
+        ).fetchall()
+
+    def remove(self, rel_fp, atime):
+        '''
+        Forget a file, and the links to it, provided it hasn't been used (or
+        re-rendered) since ``atime``.
+
+        Returns:
+            [str] the links to remove along with it, or None if the file has
+            been used since, and should be kept.
+        '''
+        conn = self._connection()
+        with conn:
+            cursor = conn.execute(
+                'DELETE FROM files WHERE path = ? AND atime <= ?',
+                (rel_fp, atime)
+            )
+            if cursor.rowcount == 0:
+                return None
+            links = [row[0] for row in conn.execute(
+                'SELECT path FROM links WHERE target = ?', (rel_fp,)
+            )]
+            conn.execute('DELETE FROM links WHERE target = ?', (rel_fp,))
+        return links
+
+    def add_info(self, rel_fp, mtime, has_profile):
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO infos (path, mtime, has_profile) '
+                'VALUES (?, ?, ?)',
+                (rel_fp, mtime, int(has_profile))
+            )
+
+    def lookup_info(self, rel_fp):
+        '''Returns (mtime, has_profile) of a cached info, or None.'''
+        row = self._connection().execute(
+            'SELECT mtime, has_profile FROM infos WHERE path = ?', (rel_fp,)
+        ).fetchone()
+        return (row[0], bool(row[1])) if row else None
+
+    def remove_info(self, rel_fp):
+        conn = self._connection()
+        with conn:
+            conn.execute('DELETE FROM infos WHERE path = ?', (rel_fp,))
+
+    def rebuild(self, cache_root, content_types):
+        '''
+        Replace the derivatives (and links to them) in the index with those
+        found under ``cache_root``. Access times are taken from the
+        filesystem.
+
+        Args:
+            cache_root (str)
+            content_types (dict): by file extension
+
+        Returns:
+            (int) the number of files indexed.
+        '''
+        real_root = path.realpath(cache_root)
+        files = []
+        links = []
+        for dp, dirnames, filenames in os.walk(real_root):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            for name in filenames:
+                if not is_derivative(name):
+                    continue
+                fp = path.join(dp, name)
+                rel_fp = path.relpath(fp, real_root)
+                if path.islink(fp):
+                    target = path.realpath(fp)
+                    if path.exists(target):
+                        links.append((rel_fp, path.relpath(target, real_root)))
+                else:
+                    st = os.stat(fp)
+                    content_type = content_types.get(name.rpartition('.')[2])
+                    files.append(
+                        (rel_fp, st.st_size, st.st_atime, st.st_mtime, content_type)
+                    )
+
+        conn = self._connection()
+        with conn:
+            conn.execute('DELETE FROM files')
+            conn.execute('DELETE FROM links')
+            conn.executemany(
+                'INSERT INTO files (path, size, atime, mtime, content_type) '
+                'VALUES (?, ?, ?, ?, ?)',
+                files
+            )
+            conn.executemany(
+                'INSERT INTO links (path, target) VALUES (?, ?)', links
+            )
+        return len(files)
+
+    def rebuild_infos(self, cache_root):
+        '''
+        Replace the info entries in the index with those found under
+        ``cache_root`` (the root of an InfoCache): info.bin records, and
+        info.json files written by older versions.
+
+        Returns:
+            (int) the number of entries indexed.
+        '''
+        infos = []
+        for scheme in ('http', 'https'):
+            for dp, _, filenames in os.walk(path.join(cache_root, scheme)):
+                if 'info.bin' in filenames:
+                    fp = path.join(dp, 'info.bin')
+                    has_profile = False  # (it's in the record)
+                elif 'info.json' in filenames:
+                    fp = path.join(dp, 'info.json')
+                    has_profile = 'profile.icc' in filenames
+                else:
+                    continue
+                infos.append((
+                    path.relpath(fp, cache_root),
+                    path.getmtime(fp),
+                    int(has_profile)
+                ))
+
+        conn = self._connection()
+        with conn:
+            conn.execute('DELETE FROM infos')
+            conn.executemany(
+                'INSERT INTO infos (path, mtime, has_profile) VALUES (?, ?, ?)',
+                infos
+            )
+        return len(infos)
+
+
+def main(argv=None):
+    # Avoid circular imports at module level (the caches import this module).
+    from loris.img import ImageCache
+    from loris.img_info import InfoCache
+    from loris.webapp import read_config
+
+    parser = argparse.ArgumentParser(
+        description='Build the indexes of the Loris image and info caches '
+                    'from the files in them.'
+    )
+    parser.add_argument('-c', '--config', default=CONFIG_FILE_DEFAULT,
+        help='Loris configuration file [default: %(default)s]')
+    args = parser.parse_args(argv)
+    config = read_config(args.config)
+
+    indexed = False
+    start = time.time()
+    img_cache = ImageCache.from_config(config['img.ImageCache'])
+    if img_cache.index is not None:
+        n = img_cache.rebuild_index()
+        sys.stderr.write('Indexed %d images (%d bytes) in %s\n' % (
+            n, img_cache.index.total_size(), img_cache.cache_root))
+        indexed = True
+
+    info_cache = InfoCache.from_config(config['img_info.InfoCache'])
+    if info_cache.index is not None:
+        n = info_cache.index.rebuild_infos(info_cache.root)
+        sys.stderr.write('Indexed %d infos in %s\n' % (
+            n, info_cache.root))
+        indexed = True
+
+    if not indexed:
+        sys.stderr.write('Neither cache uses an index (see use_index)\n')
+        return 1
+    sys.stderr.write('Done in %.1fs\n' % (time.time() - start))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
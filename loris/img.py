@@ -3,11 +3,16 @@
 
 from __future__ import absolute_import
 
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
 import errno
+import hashlib
 from logging import getLogger
 from os import path
 import os
+import threading
+import time
 
 try:
     from urllib.parse import quote_plus, unquote
@@ -16,11 +21,49 @@ except ImportError:  # Python 2
 
 import attr
 
+from loris import constants
+from loris.cache_index import CacheIndex
 from loris.parameters import RegionParameter, RotationParameter, SizeParameter
-from loris.utils import mkdir_p, safe_rename, symlink
+from loris.utils import (
+    KeyedLock, lock_file, lock_file_path, mkdir_p, safe_rename, symlink
+)
 
 logger = getLogger(__name__)
 
+# Files looked up in the index at a time while evicting.
+EVICTION_BATCH = 500
+
+
+def image_etag(rel_fp, mtime, size):
+    """
+    A strong ETag (quoted, as it goes in a header) for a cached image, from
+    its path in the cache, modification time and size. Images are renamed
+    into place when they are (re)rendered, so a new rendering gets a new
+    ETag.
+    """
+    key = '%s\0%.6f\0%d' % (rel_fp, mtime, size)
+    return '"%s"' % hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+@attr.s(slots=True, frozen=True)
+class CacheEntry(object):
+    """An image in the ImageCache."""
+    fp = attr.ib()
+    last_mod = attr.ib()
+    size = attr.ib()
+    content_type = attr.ib()
+    etag = attr.ib(default=None)
+    rel_fp = attr.ib(default=None)  # relative to the cache root
+
+
+@attr.s(slots=True, frozen=True)
+class MemoryCacheEntry(object):
+    """An image in the MemoryImageCache."""
+    data = attr.ib()
+    last_mod = attr.ib()
+    content_type = attr.ib()
+    etag = attr.ib(default=None)
+
 
 @attr.s(slots=True, frozen=True)
 class ImageRequest(object):
@@ -114,23 +157,115 @@ class ImageRequest(object):
 
 class ImageCache(dict):
     '''
+    Args:
+        cache_root (str)
+        use_lock_files (bool): see render_lock()
+        use_index (bool): keep an index of the files in the cache (see
+            loris.cache_index), so that looking an image up is one query
+            in the index rather than several filesystem calls.
+        high_watermark (int): if set, the index also records when each file
+            was last used, and when the total grows past this many bytes, a
+            background thread deletes the least recently used files (and
+            the symlinks to them) until it is under...
+        low_watermark (int): ...this many bytes [default: 90% of
+            high_watermark].
+        eviction_interval (int): seconds between checks of the total.
+        index_fp (str): the index database [default: .index.sqlite in
+            cache_root].
     '''
-    def __init__(self, cache_root):
+    def __init__(self, cache_root, use_lock_files=False, use_index=False,
+                 high_watermark=None, low_watermark=None, eviction_interval=10,
+                 index_fp=None):
         self.cache_root = cache_root
+        self.use_lock_files = use_lock_files
+        self._render_locks = KeyedLock()
+
+        self.index = None
+        self.high_watermark = high_watermark
+        if use_index or high_watermark:
+            self.index = CacheIndex(
+                index_fp or path.join(cache_root, '.index.sqlite')
+            )
+            self._real_root = path.realpath(cache_root)
+            self._eviction_lock = threading.Lock()
+        if high_watermark:
+            self.low_watermark = low_watermark or int(high_watermark * 0.9)
+            self.eviction_interval = eviction_interval
+            self._evictor_pid = None
+            self._evictor_lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        '''From the [img.ImageCache] section of the configuration.'''
+        return cls(
+            config['cache_dp'],
+            use_lock_files=config.get('use_lock_files', False),
+            use_index=config.get('use_index', False),
+            high_watermark=config.get('high_watermark'),
+            low_watermark=config.get('low_watermark'),
+            eviction_interval=config.get('eviction_interval', 10),
+            index_fp=config.get('index_fp'),
+        )
 
     def __contains__(self, image_request):
+        if self.index is not None:
+            return self.index.lookup(self._request_rel_path(image_request)) is not None
         return path.exists(self.get_request_cache_path(image_request))
 
     def __getitem__(self, image_request):
-        try:
-            cache_fp = self.get_request_cache_path(image_request)
-            last_mod = datetime.utcfromtimestamp(path.getmtime(cache_fp))
-            return (cache_fp, last_mod)
-        except OSError as err:
-            if err.errno == errno.ENOENT:
-                raise KeyError(image_request)
-            else:
-                raise
+        entry = self.get_entry(image_request)
+        if entry is None:
+            raise KeyError(image_request)
+        return (entry.fp, entry.last_mod)
+
+    def get_entry(self, image_request):
+        '''
+        Returns (CacheEntry): the cached image for the request, or None. With
+        an index, this makes no filesystem calls; if opening the file then
+        fails, pass the request to discard().
+        '''
+        if self.index is None:
+            try:
+                cache_fp = self.get_request_cache_path(image_request)
+                mtime = path.getmtime(cache_fp)
+                size = path.getsize(cache_fp)
+            except OSError as err:
+                if err.errno == errno.ENOENT:
+                    return None
+                else:
+                    raise
+            # (the canonical path would need a realpath())
+            rel_fp = self._request_rel_path(image_request)
+        else:
+            row = self.index.lookup(self._request_rel_path(image_request))
+            if row is None:
+                return None
+            rel_fp, size, mtime, _ = row
+            cache_fp = path.join(self._real_root, rel_fp)
+            if self.high_watermark:
+                self.index.touch(rel_fp)
+                self._start_evictor()
+        return CacheEntry(
+            fp=cache_fp,
+            last_mod=datetime.utcfromtimestamp(mtime),
+            size=size,
+            content_type=self._content_type(image_request),
+            etag=image_etag(rel_fp, mtime, size),
+            rel_fp=rel_fp
+        )
+
+    def discard(self, image_request):
+        '''Forget an indexed image whose file has gone.'''
+        if self.index is not None:
+            logger.warn('%s is indexed but not in %s; removing it from the index',
+                image_request.cache_path, self.cache_root)
+            self.index.discard(self._request_rel_path(image_request))
+
+    def _request_rel_path(self, image_request):
+        return path.normpath(unquote(image_request.cache_path))
+
+    def _content_type(self, image_request):
+        return constants.FORMATS_BY_EXTENSION.get(image_request.format)
 
     def store(self, image_request, image_info, canonical_fp):
         # Because we're working with files, it's more practical to put derived
@@ -150,9 +285,14 @@ class ImageCache(dict):
         if not image_request.is_canonical(image_info):
             requested_fp = self.get_request_cache_path(image_request)
             symlink(src=canonical_fp, dst=requested_fp)
+            if self.index is not None:
+                self.index.add_link(
+                    self._request_rel_path(image_request),
+                    self._rel_path(canonical_fp)
+                )
 
     def __delitem__(self, image_request):
-        # if we ever decide to start cleaning our own cache...
+        # Files are removed by evict(), least recently used first.
         pass
 
     def get(self, image_request):
@@ -172,6 +312,28 @@ class ImageCache(dict):
         canonical_fp = image_request.canonical_cache_path(image_info=image_info)
         return path.realpath(path.join(self.cache_root, unquote(canonical_fp)))
 
+    @contextmanager
+    def render_lock(self, image_request, image_info):
+        '''Serialise the rendering of one derivative.
+
+        The lock is keyed on the canonical cache path, so any number of
+        (possibly non-canonical) requests for the same image share it. The
+        first caller renders the image; the rest block here until it has
+        been moved into the cache, and should then find it there.
+
+        With ``use_lock_files`` the lock is also held on a file under
+        ``cache_root``, which extends the guarantee to other processes (e.g.
+        several mod_wsgi or gunicorn workers sharing one cache).
+        '''
+        key = image_request.canonical_cache_path(image_info)
+        with self._render_locks.lock(key):
+            if self.use_lock_files:
+                lock_fp = lock_file_path(path.join(self.cache_root, '.locks'), key)
+                with lock_file(lock_fp):
+                    yield
+            else:
+                yield
+
     def create_dir_and_return_file_path(self, image_request, image_info):
         target_fp = self.get_canonical_cache_path(image_request, image_info)
         target_dp = path.dirname(target_fp)
@@ -184,4 +346,181 @@ class ImageCache(dict):
             image_info=image_info
         )
         safe_rename(temp_fp, target_fp)
+        if self.index is not None:
+            st = os.stat(target_fp)
+            self.index.add(
+                self._rel_path(target_fp),
+                st.st_size,
+                st.st_mtime,
+                self._content_type(image_request)
+            )
+            if self.high_watermark:
+                self._start_evictor()
         return target_fp
+
+    def rebuild_index(self):
+        '''Index the files in the cache (see CacheIndex.rebuild).'''
+        return self.index.rebuild(self.cache_root, constants.FORMATS_BY_EXTENSION)
+
+    def _rel_path(self, fp):
+        return path.relpath(fp, self._real_root)
+
+    def _start_evictor(self):
+        # Started on first use, in the process serving requests (a thread
+        # started before a server forks its workers wouldn't survive).
+        if self._evictor_pid == os.getpid():
+            return
+        with self._evictor_lock:
+            if self._evictor_pid != os.getpid():
+                evictor = threading.Thread(
+                    target=self._evict_periodically, name='ImageCache evictor'
+                )
+                evictor.daemon = True
+                evictor.start()
+                self._evictor_pid = os.getpid()
+
+    def _evict_periodically(self):
+        while True:
+            time.sleep(self.eviction_interval)
+            try:
+                self.index.flush()
+                if self.index.total_size() > self.high_watermark:
+                    self.evict()
+            except Exception as e:
+                logger.exception('Cache eviction failed: %r', e)
+
+    def evict(self, to_size=None):
+        '''
+        Delete the least recently used files, and any symlinks to them,
+        until the cache is no bigger than ``to_size`` bytes [default: the
+        low watermark]. Files used during eviction are kept.
+
+        Returns:
+            (int, int): the number of files and bytes removed.
+        '''
+        to_size = self.low_watermark if to_size is None else to_size
+        removed = freed = 0
+        # Only one eviction at a time, across threads and processes: each
+        # would otherwise remove the whole excess.
+        with self._eviction_lock, \
+                lock_file(path.join(self.cache_root, '.locks', 'evict')):
+            self.index.flush()
+            while True:
+                # (re-read, as files are added while we evict)
+                excess = self.index.total_size() - to_size
+                if excess <= 0:
+                    break
+                batch = self.index.least_recently_used(EVICTION_BATCH)
+                if not batch:
+                    break
+                for rel_fp, size, atime in batch:
+                    links = self.index.remove(rel_fp, atime)
+                    if links is None:
+                        continue
+                    for rel in [rel_fp] + links:
+                        try:
+                            os.unlink(path.join(self._real_root, rel))
+                        except OSError as err:
+                            if err.errno != errno.ENOENT:
+                                raise
+                    removed += 1
+                    freed += size
+                    excess -= size
+                    if excess <= 0:
+                        break
+        if removed:
+            logger.info('Evicted %d files (%d bytes) from %s',
+                removed, freed, self.cache_root)
+        return (removed, freed)
+
+
+class MemoryImageCache(object):
+    '''
+    Keeps the bytes of small derivatives (thumbnails and the like) in
+    memory, in front of the ImageCache, so that the most requested ones are
+    served without touching the disk. When the total grows past ``max_size``
+    bytes, the least recently used images are dropped.
+
+    Entries are keyed by request path, so every form of a request that is
+    asked for is held separately.
+
+    Args:
+        max_size (int): bytes of image data to hold.
+        max_file_size (int): larger images aren't held.
+
+    Attributes:
+        size (int): bytes of image data held.
+        hits (int), misses (int): lookups that found, and didn't find, an
+            image.
+    '''
+    def __init__(self, max_size, max_file_size=131072):
+        self.max_size = max_size
+        self.max_file_size = min(max_file_size, max_size)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        '''
+        From the [img.ImageCache] section of the configuration, or None if
+        memory_cache_size isn't set.
+        '''
+        max_size = config.get('memory_cache_size', 0)
+        if not max_size:
+            return None
+        return cls(
+            max_size,
+            max_file_size=config.get('memory_cache_max_file_size', 131072)
+        )
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, image_request):
+        return image_request.request_path in self._entries
+
+    def will_hold(self, size):
+        '''Whether an image of ``size`` bytes would be held.'''
+        return size <= self.max_file_size
+
+    def get(self, image_request):
+        '''Returns a MemoryCacheEntry, or None.'''
+        key = image_request.request_path
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries[key] = entry  # now the most recently used
+            self.hits += 1
+            return entry
+
+    def put(self, image_request, data, last_mod, content_type, etag=None):
+        '''Holds ``data`` (bytes), if it isn't too big.'''
+        if not self.will_hold(len(data)):
+            return
+        key = image_request.request_path
+        entry = MemoryCacheEntry(data, last_mod, content_type, etag)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old.data)
+            self._entries[key] = entry
+            self.size += len(data)
+            while self.size > self.max_size:
+                _, dropped = self._entries.popitem(last=False)
+                self.size -= len(dropped.data)
+
+    def discard(self, image_request):
+        with self._lock:
+            entry = self._entries.pop(image_request.request_path, None)
+            if entry is not None:
+                self.size -= len(entry.data)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
@@ -4,13 +4,17 @@
 from __future__ import absolute_import
 
 from collections import OrderedDict
-from datetime import datetime
+from datetime import datetime, timedelta
 from logging import getLogger
 from math import ceil
 from threading import Lock
+import errno
+import hashlib
 import json
+import numbers
 import os
 import struct
+from tempfile import NamedTemporaryFile
 
 try:
     from urllib.parse import unquote
@@ -20,15 +24,21 @@ except ImportError:  # Python 2
 import attr
 from PIL import Image
 
+from loris.cache_index import CacheIndex
 from loris.constants import COMPLIANCE, CONTEXT, OPTIONAL_FEATURES, PROTOCOL
-from loris.jp2_extractor import JP2Extractor, JP2ExtractionError
+from loris.jp2_extractor import (
+    JP2Extractor, JP2ExtractionError, JP2TruncatedError
+)
 from loris.loris_exception import ImageInfoException
-from loris.utils import mkdir_p
+from loris.shared_cache import SharedCache
+from loris.utils import mkdir_p, safe_rename
 
 logger = getLogger(__name__)
 
 STAR_DOT_JSON = '*.json'
 
+EPOCH = datetime(1970, 1, 1)
+
 PIL_MODES_TO_QUALITIES = {
     # Thanks to http://stackoverflow.com/a/1996609/714478
     '1' : ['default','bitonal'],
@@ -66,6 +76,82 @@ class EnhancedJSONEncoder(json.JSONEncoder):
         return obj
 
 
+# Cached infos are stored as a binary record (see ImageInfo.to_record): a
+# header with the dimensions, the rest of the info as tagged values, and the
+# color profile, length-prefixed.
+RECORD_MAGIC = b'LrII'
+RECORD_VERSION = 1
+# magic, version, width, height
+RECORD_HEADER = struct.Struct('>4sBII')
+# a length or count
+RECORD_LENGTH = struct.Struct('>I')
+RECORD_INT = struct.Struct('>q')
+RECORD_FLOAT = struct.Struct('>d')
+
+
+def _pack_value(value, out):
+    """Appends the encoding of a JSON-like value to the list ``out``."""
+    if value is None:
+        out.append(b'N')
+    elif value is True or value is False:
+        out.append(b'T' if value else b'F')
+    elif isinstance(value, numbers.Integral):
+        out.append(b'i' + RECORD_INT.pack(value))
+    elif isinstance(value, float):
+        out.append(b'd' + RECORD_FLOAT.pack(value))
+    elif isinstance(value, (bytes, type(u''))):
+        if not isinstance(value, bytes):
+            value = value.encode('utf-8')
+        out.append(b's' + RECORD_LENGTH.pack(len(value)) + value)
+    elif isinstance(value, (list, tuple)):
+        out.append(b'l' + RECORD_LENGTH.pack(len(value)))
+        for item in value:
+            _pack_value(item, out)
+    elif isinstance(value, dict):
+        out.append(b'm' + RECORD_LENGTH.pack(len(value)))
+        for k, v in value.items():
+            _pack_value(k, out)
+            _pack_value(v, out)
+    else:
+        raise ImageInfoException('Cannot store %r in an info record' % (value,))
+
+
+def _unpack_value(buf, offset):
+    """Returns (value, offset of the next value)."""
+    tag = buf[offset:offset + 1]
+    offset += 1
+    if tag == b'N':
+        return (None, offset)
+    elif tag == b'T':
+        return (True, offset)
+    elif tag == b'F':
+        return (False, offset)
+    elif tag == b'i':
+        return (RECORD_INT.unpack_from(buf, offset)[0], offset + RECORD_INT.size)
+    elif tag == b'd':
+        return (RECORD_FLOAT.unpack_from(buf, offset)[0], offset + RECORD_FLOAT.size)
+    length = RECORD_LENGTH.unpack_from(buf, offset)[0]
+    offset += RECORD_LENGTH.size
+    if tag == b's':
+        end = offset + length
+        if end > len(buf):
+            raise ValueError('truncated string')
+        return (buf[offset:end].decode('utf-8'), end)
+    elif tag == b'l':
+        items = []
+        for _ in range(length):
+            item, offset = _unpack_value(buf, offset)
+            items.append(item)
+        return (items, offset)
+    elif tag == b'm':
+        d = {}
+        for _ in range(length):
+            k, offset = _unpack_value(buf, offset)
+            d[k], offset = _unpack_value(buf, offset)
+        return (d, offset)
+    raise ValueError('unknown tag %r' % (tag,))
+
+
 class ImageInfo(JP2Extractor, object):
     '''Info about the image.
     See: <http://iiif.io/api/image/>
@@ -103,6 +189,24 @@ class ImageInfo(JP2Extractor, object):
         self.logo = None
         self.license = None
         self.service = {}
+        self.set_extra(extra)
+
+        # If constructed from JSON, the pixel info will already be processed
+        if app:
+            try:
+                formats = app.transformers[src_format].target_formats
+            except KeyError:
+                raise ImageInfoException(
+                    "Didn't get a source format, or at least one we recognize (%r)." %
+                    src_format
+                )
+            # Finish setting up the info from the image file
+            self.from_image_file(formats, app.max_size_above_full)
+
+    def set_extra(self, extra):
+        '''Sets the auth rules, and any attributes overridden by
+        ``extra['extraInfo']``, from a resolver's extra info.
+        '''
         self.auth_rules = extra
 
         # The extraInfo parameter can be used to override specific attributes.
@@ -118,18 +222,6 @@ class ImageInfo(JP2Extractor, object):
                 "Invalid parameters in extraInfo: %s." % ', '.join(bad_attrs)
             )
 
-        # If constructed from JSON, the pixel info will already be processed
-        if app:
-            try:
-                formats = app.transformers[src_format].target_formats
-            except KeyError:
-                raise ImageInfoException(
-                    "Didn't get a source format, or at least one we recognize (%r)." %
-                    src_format
-                )
-            # Finish setting up the info from the image file
-            self.from_image_file(formats, app.max_size_above_full)
-
     @classmethod
     def from_json_fp(cls, path):
         """Contruct an instance from an existing file.
@@ -151,9 +243,11 @@ class ImageInfo(JP2Extractor, object):
             j (str): A valid JSON string.
 
         """
-        new_inst = ImageInfo()
-        j = json.loads(json_string)
+        return ImageInfo._from_dict(json.loads(json_string))
 
+    @staticmethod
+    def _from_dict(j):
+        new_inst = ImageInfo()
         new_inst.ident = j.get(u'@id')
         new_inst.width = j.get(u'width')
         new_inst.height = j.get(u'height')
@@ -174,11 +268,17 @@ class ImageInfo(JP2Extractor, object):
 
         return new_inst
 
-    def from_image_file(self, formats=[], max_size_above_full=200):
+    def from_image_file(self, formats=[], max_size_above_full=200, src=None):
         '''
         Args:
             ident (str): The URI for the image.
             formats ([str]): The derivative formats the application can produce.
+            src (file): read instead of src_img_fp, e.g. a JP2HeaderReader
+                with the start of a JP2 that hasn't been fetched yet (JP2s
+                only).
+        Raises:
+            JP2TruncatedError: if ``src`` is a JP2HeaderReader that doesn't
+                have enough of the file.
         '''
         # Assumes that the image exists and the format is supported. Exceptions
         # should be raised by the resolver if that's not the case.
@@ -199,7 +299,7 @@ class ImageInfo(JP2Extractor, object):
         )
 
         if self.src_format == 'jp2':
-            self._from_jp2(self.src_img_fp)
+            self._from_jp2(self.src_img_fp if src is None else src)
         elif self.src_format  in ('jpg','tif','png'):
             self._extract_with_pillow(self.src_img_fp)
         else:
@@ -220,19 +320,24 @@ class ImageInfo(JP2Extractor, object):
         self.sizes = []
 
     def _from_jp2(self, fp):
-        '''Get info about a JP2.
+        '''Get info about a JP2, from its path or an open file.
         '''
-        logger.debug('Extracting info from JP2 file: %s' % fp)
+        if not hasattr(fp, 'read'):
+            with open(fp, 'rb') as jp2:
+                return self._from_jp2(jp2)
+
+        logger.debug('Extracting info from JP2 file: %s', self.src_img_fp)
         self.profile.description['qualities'] = ['default', 'bitonal']
 
-        with open(fp, 'rb') as jp2:
-            try:
-                self.extract_jp2(jp2)
-            except JP2ExtractionError as err:
-                logger.warning(
-                    "Error extracting JP2 %s: %r", fp, str(err)
-                )
-                raise ImageInfoException("Invalid JP2 file")
+        try:
+            self.extract_jp2(fp)
+        except JP2TruncatedError:
+            raise
+        except JP2ExtractionError as err:
+            logger.warning(
+                "Error extracting JP2 %s: %r", self.src_img_fp, str(err)
+            )
+            raise ImageInfoException("Invalid JP2 file")
 
     def assign_color_profile(self, jp2):
         profile_size_bytes = jp2.read(4)
@@ -280,18 +385,108 @@ class ImageInfo(JP2Extractor, object):
         d = self._get_iiif_info()
         return json.dumps(d, cls=EnhancedJSONEncoder)
 
-    def to_full_info_json(self):
-        """creates the info JSON that gets cached in the InfoCache"""
+    def _get_full_info(self):
         d = self._get_iiif_info()
         d['_src_img_fp'] = self.src_img_fp
         d['_src_format'] = self.src_format
         d['_auth_rules'] = self.auth_rules
-        return json.dumps(d, cls=EnhancedJSONEncoder)
+        return d
+
+    def to_full_info_json(self):
+        """creates the info JSON that gets cached in the InfoCache"""
+        return json.dumps(self._get_full_info(), cls=EnhancedJSONEncoder)
+
+    def to_record(self):
+        """Serializes what is in the full info JSON, plus the color profile,
+        into the binary record that the InfoCache stores."""
+        out = [RECORD_HEADER.pack(
+            RECORD_MAGIC, RECORD_VERSION, self.width, self.height
+        )]
+        profile = EnhancedJSONEncoder().default(self.profile)
+        for value in (self.ident, self.src_img_fp, self.src_format, profile,
+                      self.tiles, self.sizes, self.service, self.auth_rules):
+            _pack_value(value, out)
+        color_profile_bytes = getattr(self, 'color_profile_bytes', None) or b''
+        out.append(RECORD_LENGTH.pack(len(color_profile_bytes)))
+        out.append(color_profile_bytes)
+        return b''.join(out)
+
+    @staticmethod
+    def from_record(record):
+        """Construct an instance from a record made by to_record().
+
+        Raises:
+            ImageInfoException: if it isn't a (current) record.
+        """
+        try:
+            magic, version, width, height = RECORD_HEADER.unpack_from(record, 0)
+            if magic != RECORD_MAGIC or version != RECORD_VERSION:
+                raise ValueError('not a version %d record' % RECORD_VERSION)
+            offset = RECORD_HEADER.size
+            values = []
+            for _ in range(8):
+                value, offset = _unpack_value(record, offset)
+                values.append(value)
+            profile_len = RECORD_LENGTH.unpack_from(record, offset)[0]
+            offset += RECORD_LENGTH.size
+            if offset + profile_len != len(record):
+                raise ValueError('bad length')
+        except (struct.error, ValueError) as e:  # (incl. UnicodeDecodeError)
+            raise ImageInfoException('Bad info record: %s' % (e,))
+
+        new_inst = ImageInfo()
+        new_inst.width = width
+        new_inst.height = height
+        (new_inst.ident, new_inst.src_img_fp, new_inst.src_format, profile,
+         new_inst.tiles, new_inst.sizes, new_inst.service,
+         new_inst.auth_rules) = values
+        new_inst.profile = Profile(*profile)
+        new_inst.color_profile_bytes = record[offset:] or None
+        return new_inst
+
+
+def iiif_json(info):
+    """Returns the IIIF JSON of an ImageInfo as bytes, and a strong ETag for
+    it (quoted, as it goes in a header)."""
+    data = info.to_iiif_json().encode('utf-8')
+    return (data, '"%s"' % hashlib.sha1(data).hexdigest())
+
+
+def _to_shared_record(info, lastmod):
+    """Prefixes an ImageInfo's record with its last modified time, for the
+    SharedCache."""
+    lastmod_ts = (lastmod - EPOCH).total_seconds()
+    return RECORD_FLOAT.pack(lastmod_ts) + info.to_record()
+
+
+def _from_shared_record(record):
+    lastmod_ts = RECORD_FLOAT.unpack_from(record, 0)[0]
+    info = ImageInfo.from_record(record[RECORD_FLOAT.size:])
+    return (info, EPOCH + timedelta(seconds=lastmod_ts))
+
+
+def _write_atomically(fp, data):
+    # A temp file of its own, in the same directory, for each writer: any
+    # thread (or process) may be storing the same info at once.
+    with NamedTemporaryFile(dir=os.path.dirname(fp),
+                            prefix=os.path.basename(fp) + '.',
+                            suffix='.tmp', delete=False) as f:
+        tmp_fp = f.name
+        try:
+            f.write(data)
+        except Exception:
+            f.close()
+            os.unlink(tmp_fp)
+            raise
+    safe_rename(tmp_fp, fp)
 
 
 class InfoCache(object):
     """A dict-like cache for ImageInfo objects. The n most recently used are
-    also kept in memory; all entries are on the file system.
+    also kept in memory; all entries are on the file system, each in a single
+    binary record (see ImageInfo.to_record). Optionally, entries are also
+    kept in a SharedCache, which all the processes using the cache read
+    from, so that each record is read once rather than once per process.
 
     One twist: you put in an ImageInfo object, but get back a two-tuple, the
     first member is the ImageInfo, the second member is the UTC date and time
@@ -302,29 +497,67 @@ class InfoCache(object):
     iterators, views, default, update, comparators, etc.
 
     Slots:
+        root (str): See below
         http_root (str): See below
         https_root (str): See below
         size (int): See below.
-        _dict (OrderedDict): The map.
+        index (CacheIndex): See below.
+        shared (SharedCache): See below.
+        _dict (OrderedDict): The map, of URL to (info, last modified,
+            (IIIF JSON, ETag) or None until it is asked for).
         _lock (Lock): The lock.
     """
-    __slots__ = ( 'http_root', 'https_root', 'size', '_dict', '_lock')
+    __slots__ = ( 'root', 'http_root', 'https_root', 'size', 'index', 'shared',
+        '_dict', '_lock')
 
-    def __init__(self, root, size=500):
+    def __init__(self, root, size=500, use_index=False, index_fp=None,
+                 shared_fp=None, shared_slots=8192, shared_slot_size=16384):
         """
         Args:
             root (str):
                 Path directory on the file system to be used for the cache.
             size (int):
                 Max entries before the we start popping (LRU).
+            use_index (bool):
+                Look cached infos up in a loris.cache_index.CacheIndex,
+                rather than checking for them on the file system.
+            index_fp (str):
+                The index database (default: .index.sqlite in root).
+            shared_fp (str):
+                If set, the file (preferably on a tmpfs) of a SharedCache
+                that is looked in after the in-memory entries, and before
+                the file system.
+            shared_slots (int), shared_slot_size (int):
+                The size of the SharedCache, if it is created. Infos that
+                don't fit in a slot (e.g. with a large color profile) are
+                read from the file system.
         """
+        self.root = root
         self.http_root = os.path.join(root, 'http')
         self.https_root = os.path.join(root, 'https')
         self.size = size
+        self.index = None
+        if use_index:
+            self.index = CacheIndex(index_fp or os.path.join(root, '.index.sqlite'))
+        self.shared = None
+        if shared_fp:
+            self.shared = SharedCache(shared_fp, shared_slots, shared_slot_size)
         self._dict = OrderedDict()  # keyed by URL, so we don't need
                                     # to separate HTTP and HTTPS
         self._lock = Lock()
 
+    @classmethod
+    def from_config(cls, config):
+        """From the [img_info.InfoCache] section of the configuration."""
+        return cls(
+            config['cache_dp'],
+            use_index=config.get('use_index', False),
+            index_fp=config.get('index_fp'),
+            shared_fp=config.get('shared_fp'),
+            shared_slots=config.get('shared_slots', 8192),
+            shared_slot_size=config.get('shared_slot_size', 16384),
+        )
+
     def _which_root(self, request):
         if request.url.startswith('https'):
             return self.https_root
@@ -335,7 +568,16 @@ class InfoCache(object):
     def ident_from_request(request):
         return '/'.join(request.path[1:].split('/')[:-1])
 
+    def _get_record_fp(self, request):
+        ident = InfoCache.ident_from_request(request)
+        cache_root = self._which_root(request)
+        path = os.path.join(cache_root, unquote(ident), 'info.bin')
+        return path
+
     def _get_info_fp(self, request):
+        """The info.json that older versions of Loris cached the info in
+        (along with a profile.icc). These are still read, but not written.
+        """
         ident = InfoCache.ident_from_request(request)
         cache_root = self._which_root(request)
         path = os.path.join(cache_root, unquote(ident), 'info.json')
@@ -354,29 +596,149 @@ class InfoCache(object):
         '''
         info_and_lastmod = None
         with self._lock:
-            info_and_lastmod = self._dict.get(request.url)
+            entry = self._dict.get(request.url)
+        if entry is not None:
+            info_and_lastmod = entry[:2]
+        if info_and_lastmod is None and self.shared is not None:
+            info_and_lastmod = self._get_shared(request)
+            if info_and_lastmod is not None:
+                self._remember(request, *info_and_lastmod)
         if info_and_lastmod is None:
-            info_fp = self._get_info_fp(request)
-            if os.path.exists(info_fp):
-                # from fs
-                info = ImageInfo.from_json_fp(info_fp)
-
-                icc_fp = self._get_color_profile_fp(request)
-                if os.path.exists(icc_fp):
-                    with open(icc_fp, "rb") as f:
-                        info.color_profile_bytes = f.read()
-                else:
-                    info.color_profile_bytes = None
-
-                lastmod = datetime.utcfromtimestamp(os.path.getmtime(info_fp))
-                info_and_lastmod = (info, lastmod)
+            if self.index is not None:
+                info_and_lastmod = self._get_indexed(request)
+            else:
+                info_and_lastmod = self._get_from_fs(request)
+            if info_and_lastmod is not None:
                 logger.debug('Info for %s read from file system', request)
                 # into mem:
-                self.__setitem__(request, info, _to_fs=False)
+                self._remember(request, *info_and_lastmod)
+                self._share(request, *info_and_lastmod)
         return info_and_lastmod
 
+    def get_iiif_json(self, request, info):
+        """Returns the IIIF JSON and ETag (see iiif_json) of ``info``, as
+        cached for ``request``. They are made the first time they are asked
+        for, and kept with the in-memory entry for as long as it holds the
+        same ImageInfo (so e.g. services that were added before it was
+        stored are in them).
+        """
+        with self._lock:
+            entry = self._dict.get(request.url)
+        if entry is not None and entry[0] is info and entry[2] is not None:
+            return entry[2]
+        json_and_etag = iiif_json(info)
+        if entry is not None and entry[0] is info:
+            with self._lock:
+                if self._dict.get(request.url) is entry:
+                    self._dict[request.url] = (info, entry[1], json_and_etag)
+        return json_and_etag
+
+    def _get_shared(self, request):
+        record = self.shared.get(request.url.encode('utf-8'))
+        if record is None:
+            return None
+        try:
+            return _from_shared_record(record)
+        except (struct.error, ImageInfoException) as e:
+            # e.g. a record left by another version of Loris; it will be
+            # replaced once the info has been read again.
+            logger.warn('Bad shared info record for %s: %s', request.url, e)
+            return None
+
+    def _share(self, request, info, lastmod):
+        if self.shared is None:
+            return
+        try:
+            record = _to_shared_record(info, lastmod)
+        except ImageInfoException as e:  # something a record can't store
+            logger.warn('Could not share info for %s: %s', request.url, e)
+            return
+        self.shared.put(request.url.encode('utf-8'), record)
+
+    def _read_record(self, record_fp):
+        """Returns (info, lastmod) from a record file, or None if there
+        isn't one (or it can't be read)."""
+        try:
+            with open(record_fp, 'rb') as f:
+                record = f.read()
+                mtime = os.fstat(f.fileno()).st_mtime
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        try:
+            info = ImageInfo.from_record(record)
+        except ImageInfoException as e:
+            logger.warn('Ignoring %s: %s', record_fp, e)
+            return None
+        return (info, datetime.utcfromtimestamp(mtime))
+
+    def _get_from_fs(self, request):
+        info_and_lastmod = self._read_record(self._get_record_fp(request))
+        if info_and_lastmod is not None:
+            return info_and_lastmod
+        return self._get_legacy_from_fs(request)
+
+    def _get_legacy_from_fs(self, request):
+        info_fp = self._get_info_fp(request)
+        if not os.path.exists(info_fp):
+            return None
+        info = ImageInfo.from_json_fp(info_fp)
+
+        icc_fp = self._get_color_profile_fp(request)
+        if os.path.exists(icc_fp):
+            with open(icc_fp, "rb") as f:
+                info.color_profile_bytes = f.read()
+        else:
+            info.color_profile_bytes = None
+
+        lastmod = datetime.utcfromtimestamp(os.path.getmtime(info_fp))
+        return (info, lastmod)
+
+    def _get_indexed(self, request):
+        record_fp = self._get_record_fp(request)
+        rel_fp = os.path.relpath(record_fp, self.root)
+        if self.index.lookup_info(rel_fp) is not None:
+            info_and_lastmod = self._read_record(record_fp)
+            if info_and_lastmod is None:
+                logger.warn('%s is indexed but unreadable; removing it from the index', record_fp)
+                self.index.remove_info(rel_fp)
+            return info_and_lastmod
+
+        info_fp = self._get_info_fp(request)
+        rel_fp = os.path.relpath(info_fp, self.root)
+        entry = self.index.lookup_info(rel_fp)
+        if entry is None:
+            return None
+        mtime, has_profile = entry
+        try:
+            info = ImageInfo.from_json_fp(info_fp)
+            info.color_profile_bytes = None
+            if has_profile:
+                with open(self._get_color_profile_fp(request), "rb") as f:
+                    info.color_profile_bytes = f.read()
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            logger.warn('%s is indexed but missing; removing it from the index', info_fp)
+            self.index.remove_info(rel_fp)
+            return None
+        return (info, datetime.utcfromtimestamp(mtime))
+
     def has_key(self, request):
-        return os.path.exists(self._get_info_fp(request))
+        with self._lock:
+            if request.url in self._dict:
+                return True
+        if self.shared is not None and \
+                self.shared.get(request.url.encode('utf-8')) is not None:
+            return True
+        fps = (self._get_record_fp(request), self._get_info_fp(request))
+        if self.index is not None:
+            return any(
+                self.index.lookup_info(os.path.relpath(fp, self.root)) is not None
+                for fp in fps
+            )
+        return any(os.path.exists(fp) for fp in fps)
 
     def __contains__(self, request):
         return self.has_key(request)
@@ -388,50 +750,57 @@ class InfoCache(object):
         else:
             return info_lastmod
 
-    def __setitem__(self, request, info, _to_fs=True):
-        info_fp = self._get_info_fp(request)
-        if _to_fs:
-            # to fs
-            logger.debug('request passed to __setitem__: %s', request)
-            dp = os.path.dirname(info_fp)
-            mkdir_p(dp)
-            logger.debug('Created %s', dp)
-
-            with open(info_fp, 'w') as f:
-                f.write(info.to_full_info_json())
-            logger.debug('Created %s', info_fp)
-
-
-            if info.color_profile_bytes:
-                icc_fp = self._get_color_profile_fp(request)
-                with open(icc_fp, 'wb') as f:
-                    f.write(info.color_profile_bytes)
-                logger.debug('Created %s', icc_fp)
+    def __setitem__(self, request, info):
+        record_fp = self._get_record_fp(request)
+        logger.debug('request passed to __setitem__: %s', request)
+        dp = os.path.dirname(record_fp)
+        mkdir_p(dp)
+        logger.debug('Created %s', dp)
+
+        # Written in full before it is renamed into place, so that other
+        # processes never read a partial file.
+        _write_atomically(record_fp, info.to_record())
+        logger.debug('Created %s', record_fp)
+
+        mtime = os.path.getmtime(record_fp)
+        if self.index is not None:
+            self.index.add_info(
+                os.path.relpath(record_fp, self.root),
+                mtime,
+                bool(info.color_profile_bytes)
+            )
 
         # into mem
-        # The info file cache on disk must already exist before
-        # this is called - it's where the mtime gets drawn from.
-        # aka, nothing outside of this class should be using
-        # to_fs=False
+        lastmod = datetime.utcfromtimestamp(mtime)
+        self._remember(request, info, lastmod)
+        self._share(request, info, lastmod)
+
+    def _remember(self, request, info, lastmod):
         if self.size > 0:
-            lastmod = datetime.utcfromtimestamp(os.path.getmtime(info_fp))
             with self._lock:
-                self._dict[request.url] = (info,lastmod)
+                self._dict[request.url] = (info, lastmod, None)
                 while len(self._dict) > self.size:
                     self._dict.popitem(last=False)
 
     def __delitem__(self, request):
         with self._lock:
             del self._dict[request.url]
+        if self.shared is not None:
+            self.shared.discard(request.url.encode('utf-8'))
 
-        info_fp = self._get_info_fp(request)
-        os.unlink(info_fp)
-
-        icc_fp = self._get_color_profile_fp(request)
-        if os.path.exists(icc_fp):
-            os.unlink(icc_fp)
-
-        os.removedirs(os.path.dirname(info_fp))
+        fps = (
+            self._get_record_fp(request),
+            self._get_info_fp(request),
+            self._get_color_profile_fp(request),
+        )
+        if self.index is not None:
+            for fp in fps[:2]:
+                self.index.remove_info(os.path.relpath(fp, self.root))
+        for fp in fps:
+            if os.path.exists(fp):
+                os.unlink(fp)
+
+        os.removedirs(os.path.dirname(fps[0]))
 
     def __len__(self):
         return len(self._dict)
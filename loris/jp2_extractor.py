@@ -9,8 +9,7 @@ Where appropriate, references are to ISO/IEC 15444-1:2000(E).
 
 """
 
-import collections
-from collections import deque
+import io
 import logging
 import os
 import struct
@@ -33,6 +32,32 @@ class JP2ExtractionError(LorisException):
     pass
 
 
+class JP2TruncatedError(JP2ExtractionError):
+    """Raised when the information we need isn't in the first bytes of a
+    JP2 that we have (see JP2HeaderReader)."""
+    pass
+
+
+class JP2HeaderReader(io.BytesIO):
+    """
+    The first bytes of a JP2 (e.g. fetched with an HTTP Range request), to
+    pass to JP2Extractor.extract_jp2.  Reading past the end raises
+    JP2TruncatedError, rather than returning short, so the caller knows to
+    get more of the file and try again.
+    """
+    def __init__(self, data):
+        super(JP2HeaderReader, self).__init__(data)
+        self.size = len(data)
+
+    def read(self, n=-1):
+        data = super(JP2HeaderReader, self).read(n)
+        if n is not None and n >= 0 and len(data) < n:
+            raise JP2TruncatedError(
+                "Needed more than the first %d bytes" % self.size
+            )
+        return data
+
+
 def _parse_length(jp2, box_name):
     """
     Internally, a JP2 is a series of boxes.  Within each box,
@@ -54,18 +79,93 @@ def _parse_length(jp2, box_name):
         )
 
 
-def _read_jp2_until_match(jp2, match):
+def _read_jp2_until_match(jp2, match, block_size=65536):
     """
     Continue to read bytes from ``jp2`` until ``match`` is encountered,
     at which point rewind so the stream starts just before ``match``.
+
+    Reads a block at a time and searches it with ``bytes.find``, keeping
+    enough of the previous block to find a match that straddles two.
+
     """
-    window = collections.deque([], len(match))
-    while b''.join(window) != match:
-        b = jp2.read(1)
-        c = struct.unpack('c', b)[0]
-        window.append(c)
+    # (read1 doesn't raise if a JP2HeaderReader has fewer bytes than asked)
+    read = getattr(jp2, 'read1', jp2.read)
+    buf = b''
+    while True:
+        block = read(block_size)
+        if not block:
+            # A JP2HeaderReader raises JP2TruncatedError here.
+            jp2.read(len(match))
+            raise JP2ExtractionError("Couldn't find %r" % match)
+        buf = buf[-(len(match) - 1):] + block if len(match) > 1 else block
+        index = buf.find(match)
+        if index != -1:
+            jp2.seek(index - len(buf), os.SEEK_CUR)
+            return
+
+
+def _read_box_header(jp2):
+    """
+    If ``jp2`` is at the start of a box, read its header, and return its type
+    and the length of its contents (None if it runs to the end of the file).
+
+    See § I.4.
 
-    jp2.seek(-len(match), os.SEEK_CUR)
+    """
+    header = jp2.read(8)
+    if len(header) < 8:
+        raise JP2ExtractionError("Unexpected end of file in a box header")
+    length, box_type = struct.unpack('>I4s', header)
+    if length == 1:
+        xl_length = jp2.read(8)
+        if len(xl_length) < 8:
+            raise JP2ExtractionError("Unexpected end of file in a box header")
+        length = struct.unpack('>Q', xl_length)[0] - 16
+    elif length == 0:
+        return (box_type, None)
+    else:
+        length -= 8
+    if length < 0:
+        raise JP2ExtractionError("Bad length in the %r box" % box_type)
+    return (box_type, length)
+
+
+def _find_box(jp2, box_type, end=None):
+    """
+    Skip over boxes, by their lengths, until one of type ``box_type``, and
+    leave ``jp2`` at the start of its contents.  Returns the position of
+    the end of the box (None if it runs to the end of the file).
+
+    Gives up with JP2ExtractionError at ``end`` (the end of the enclosing
+    box), or at the end of the file.
+
+    """
+    while end is None or jp2.tell() < end:
+        found, length = _read_box_header(jp2)
+        if found == box_type:
+            return None if length is None else jp2.tell() + length
+        if length is None:
+            break
+        jp2.seek(length, os.SEEK_CUR)
+    raise JP2ExtractionError("Couldn't find a %r box" % box_type)
+
+
+def _find_marker_segment(jp2, marker):
+    """
+    Skip over marker segments in the main header of a codestream, by their
+    lengths, until ``marker``, and leave ``jp2`` just after it.
+
+    See § A.1.
+
+    """
+    while True:
+        code = jp2.read(2)
+        if code == marker:
+            return
+        if len(code) < 2 or code[:1] != b'\xFF' or code == b'\xFF\x90':  # (SOT)
+            raise JP2ExtractionError("Couldn't find marker %r" % marker)
+        length = struct.unpack('>H', jp2.read(2))[0]
+        jp2.seek(length - 2, os.SEEK_CUR)
 
 
 class JP2Extractor(object):
@@ -351,8 +451,20 @@ class JP2Extractor(object):
         # This is a superbox containing other boxes which contain (among other
         # things) information about the dimensions and color space of
         # the image.  The type of this box is 'jp2h'.
-        _read_jp2_until_match(jp2, b'jp2h')
-        jp2.read(4)
+        #
+        # We skip over any boxes before it (e.g. XML or UUID boxes, which can
+        # be large) by their lengths.  If the lengths don't add up, we fall
+        # back to searching for the box type, as earlier versions did.
+        start = jp2.tell()
+        try:
+            jp2h_end = _find_box(jp2, b'jp2h')
+        except JP2TruncatedError:
+            raise
+        except JP2ExtractionError:
+            jp2.seek(start)
+            _read_jp2_until_match(jp2, b'jp2h')
+            jp2.read(4)
+            jp2h_end = None
 
         # The first box is the Image Header box, which is *always* the first
         # box in the JP2 Header box (see § I.5.3).  In particular, it gives
@@ -370,11 +482,19 @@ class JP2Extractor(object):
         #
         # Note: a JP2 Header box may contain more than one colr box; for now
         # we only use the first and ignore the rest.
-        _read_jp2_until_match(jp2, b'colr')
+        start = jp2.tell()
+        try:
+            _find_box(jp2, b'colr', end=jp2h_end)
+        except JP2TruncatedError:
+            raise
+        except JP2ExtractionError:
+            jp2.seek(start)
+            _read_jp2_until_match(jp2, b'colr')
+            jp2.seek(4, os.SEEK_CUR)
 
         # Then step back so we're at the start of the box, before the
         # 4-byte lenth.
-        jp2.seek(-4, os.SEEK_CUR)
+        jp2.seek(-8, os.SEEK_CUR)
 
         qualities, profile_bytes = self._parse_colour_specification_box(jp2)
         self.profile.description['qualities'] += qualities
@@ -388,12 +508,24 @@ class JP2Extractor(object):
         #
         # Specifically, we're interested in the Image and Tile Size (SIZ),
         # which includes the width and height of the reference grid and tiles.
-        # This starts with a marker code 'SIZ = 0xFF51'.
-        #
-        # There is only one SIZ per codestream, so it suffices to find the
-        # first instance (see § A.5).
-        _read_jp2_until_match(jp2, b'\xFF\x51')
-
+        # This starts with a marker code 'SIZ = 0xFF51'.  It comes straight
+        # after the start of codestream marker (SOC = 0xFF4F), and there is
+        # only one SIZ per codestream (see § A.5).
+        start = jp2.tell()
+        try:
+            if jp2h_end is None:
+                raise JP2ExtractionError("Didn't find the end of the jp2h box")
+            jp2.seek(jp2h_end)
+            _find_box(jp2, b'jp2c')
+            if jp2.read(2) != b'\xFF\x4F':
+                raise JP2ExtractionError("No SOC at the start of the codestream")
+        except JP2TruncatedError:
+            raise
+        except JP2ExtractionError:
+            jp2.seek(start)
+            _read_jp2_until_match(jp2, b'\xFF\x51')
+
+        siz_start = jp2.tell()
         tile_dimensions = self._parse_siz_marker_segment(jp2)
         if tile_dimensions.height == tile_dimensions.width:
             self.tiles.append({
@@ -407,9 +539,21 @@ class JP2Extractor(object):
 
         scaleFactors = []
 
-        window = deque(jp2.read(2), 2)
-        while ((window[0] != b'\xFF') or (window[1] != b'\x52')):  # (COD - required, see pg 14)
-            window.append(jp2.read(1))
+        # The coding style default (COD - required, see pg 14) is one of the
+        # marker segments after SIZ, which we skip over by their lengths
+        # (again, falling back to a search).
+        after_siz = jp2.tell()
+        try:
+            jp2.seek(siz_start + 2)
+            siz_length = struct.unpack('>H', jp2.read(2))[0]
+            jp2.seek(siz_start + 2 + siz_length)
+            _find_marker_segment(jp2, b'\xFF\x52')
+        except JP2TruncatedError:
+            raise
+        except (JP2ExtractionError, struct.error):
+            jp2.seek(after_siz)
+            _read_jp2_until_match(jp2, b'\xFF\x52')
+            jp2.read(2)
 
         jp2.read(7) # through Lcod (16), Scod (8), SGcod (32)
         levels = int(struct.unpack(">B", jp2.read(1))[0])
@@ -433,15 +577,13 @@ class JP2Extractor(object):
                 # Let's wait for that to come up....
                 self.tiles = []
 
-                for level in range(levels+1):
-                    i = int(bin(struct.unpack(">B", b)[0])[2:].zfill(8),2)
-                    x = i&15
-                    y = i >> 4
-                    w = 2**x
-                    h = 2**y
-                    b = jp2.read(1)
+                # One byte per resolution level: the exponents of the
+                # precinct height (high 4 bits) and width (low 4 bits).
+                precincts = bytearray(b + jp2.read(levels))
+                for level, i in enumerate(precincts):
+                    w = 2 ** (i & 15)
                     try:
-                        entry = next((i for i in self.tiles if i['width'] == w))
+                        entry = next((t for t in self.tiles if t['width'] == w))
                         entry['scaleFactors'].append(pow(2, level))
                     except StopIteration:
                         self.tiles.append({'width':w, 'scaleFactors':[pow(2, level)]})
@@ -6,15 +6,19 @@
 
 from __future__ import absolute_import
 
+from collections import OrderedDict
+from copy import deepcopy
 from logging import getLogger
-from os.path import join, exists, dirname
+from os.path import abspath, join, exists, dirname
 from os import makedirs, rename, remove, listdir
 from shutil import copy
 import tempfile
-from contextlib import closing
+from contextlib import closing, contextmanager
 import glob
 import json
 import os
+import threading
+import time
 
 try:
     from urllib.parse import unquote
@@ -22,23 +26,144 @@ except ImportError:  # Python 2
     from urllib import unquote
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from loris import constants
 from loris.identifiers import CacheNamer, IdentRegexChecker
 from loris.loris_exception import ResolverException
-from loris.utils import mkdir_p, safe_rename
+from loris.source_index import SourceIndex
+from loris.utils import (
+    KeyedLock, import_class, lock_file, lock_file_path, mkdir_p, safe_rename
+)
 from loris.img_info import ImageInfo
+from loris.jp2_extractor import JP2HeaderReader, JP2TruncatedError
 
 
 logger = getLogger(__name__)
 
 
+class NotFoundCache(object):
+    '''
+    Remembers identifiers that a resolver couldn't find, for ``ttl`` seconds,
+    so that requests for them (from crawlers, broken manifests...) don't
+    search the file system or go to the origin server every time. At most
+    ``max_size`` identifiers are remembered; the oldest are forgotten first.
+    With a ``ttl`` of 0 (the default), nothing is remembered.
+
+    When an image is ingested, its identifier can be forgotten with
+    discard(). Other processes can be told by touching ``reset_fp``: when
+    its modification time changes, everything is forgotten (it is looked at
+    at most once a second).
+
+    ``hits`` and ``misses`` count the lookups that did and didn't find an
+    identifier here.
+    '''
+    RESET_CHECK_INTERVAL = 1
+
+    def __init__(self, ttl=0, max_size=10000, reset_fp=None):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.reset_fp = reset_fp
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # ident -> expiry time, oldest first
+        self._lock = threading.Lock()
+        self._reset_mtime = self._get_reset_mtime()
+        self._reset_checked = time.time()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            ttl=config.get('not_found_ttl', 0),
+            max_size=config.get('not_found_max_size', 10000),
+            reset_fp=config.get('not_found_reset_fp')
+        )
+
+    def _get_reset_mtime(self):
+        if self.reset_fp is None:
+            return None
+        try:
+            return os.stat(self.reset_fp).st_mtime
+        except OSError:
+            return None
+
+    def _check_reset(self, now):
+        if self.reset_fp is None or now - self._reset_checked < self.RESET_CHECK_INTERVAL:
+            return
+        self._reset_checked = now
+        mtime = self._get_reset_mtime()
+        if mtime != self._reset_mtime:
+            logger.info('%s changed; forgetting unresolvable identifiers', self.reset_fp)
+            self._reset_mtime = mtime
+            self.clear()
+
+    def __contains__(self, ident):
+        if not self.ttl:
+            return False
+        now = time.time()
+        self._check_reset(now)
+        with self._lock:
+            expires = self._entries.get(ident)
+            if expires is not None and expires <= now:
+                del self._entries[ident]
+                expires = None
+            if expires is None:
+                self.misses += 1
+                return False
+            self.hits += 1
+            return True
+
+    def add(self, ident):
+        if not self.ttl:
+            return
+        now = time.time()
+        with self._lock:
+            self._entries.pop(ident, None)
+            self._entries[ident] = now + self.ttl
+            # (entries expire in the order they were added)
+            while self._entries and (
+                len(self._entries) > self.max_size or
+                next(iter(self._entries.values())) <= now
+            ):
+                self._entries.popitem(last=False)
+
+    def discard(self, ident):
+        with self._lock:
+            self._entries.pop(ident, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / float(lookups) if lookups else 0.0
+
+
 class _AbstractResolver(object):
+    '''
+    Every resolver has a NotFoundCache, ``not_found``, configured by
+    ``not_found_ttl`` (seconds; 0, the default, turns it off),
+    ``not_found_max_size`` and ``not_found_reset_fp``. Implementations
+    should look (unquoted) identifiers up in it before searching for them,
+    and add those they can't find.
+    '''
 
     def __init__(self, config):
         self.config = config
         if config:
             self.auth_rules_ext = self.config.get('auth_rules_ext', 'rules.json')
+        self.not_found = NotFoundCache.from_config(config or {})
+
+    def forget_not_found(self, ident):
+        '''Call when ``ident`` may have become resolvable (e.g. it has just
+        been ingested), so it isn't still reported as not found.'''
+        self.not_found.discard(unquote(ident))
 
     def is_resolvable(self, ident):
         """
@@ -96,6 +221,19 @@ class _AbstractResolver(object):
         else:
             return {}
 
+    def fetch_source(self, image_info):
+        """
+        Called before the pixels of a source are needed, for resolvers whose
+        resolve() can return an ImageInfo before the source file itself has
+        been fetched. Makes sure that ``image_info.src_img_fp`` exists.
+
+        Raises:
+            ResolverException if it can't be fetched, e.g. because it has
+            gone from the resolver's cache since the info was made (in which
+            case the caller should resolve the identifier again).
+        """
+        pass
+
     def fix_base_uri(self, base_uri):
         return base_uri
 
@@ -114,6 +252,11 @@ class SimpleFSResolver(_AbstractResolver):
     For this dumb version a constant path is prepended to the identfier
     supplied to get the path It assumes this 'identifier' ends with a file
     extension from which the format is then derived.
+
+    With ``source_index_fp`` set, files are looked up in a SourceIndex (see
+    loris.source_index) before the roots are searched. A file found in the
+    index is only used if there isn't one in an earlier root (which may not
+    have been indexed yet), so the index never changes which root wins.
     """
 
     def __init__(self, config):
@@ -122,6 +265,8 @@ class SimpleFSResolver(_AbstractResolver):
             self.source_roots = self.config['src_img_roots']
         else:
             self.source_roots = [self.config['src_img_root']]
+        self.source_index = SourceIndex.from_config(self.config)
+        self.source_index_roots = self.source_roots
 
     def raise_404_for_ident(self, ident):
         message = 'Source image not found for identifier: %s.' % (ident,)
@@ -130,10 +275,23 @@ class SimpleFSResolver(_AbstractResolver):
 
     def source_file_path(self, ident):
         ident = unquote(ident)
-        for directory in self.source_roots:
-            fp = join(directory, ident)
+        if ident in self.not_found:
+            return None
+        fps = [join(directory, ident) for directory in self.source_roots]
+        indexed_fp = None
+        if self.source_index is not None:
+            indexed_fp = self.source_index.find(fps)
+            if indexed_fp is not None:
+                # (only the roots before it need looking in)
+                fps = fps[:fps.index(indexed_fp)]
+        for fp in fps:
             if exists(fp):
+                if self.source_index is not None:
+                    self.source_index.add(fp)
                 return fp
+        if indexed_fp is not None:
+            return indexed_fp
+        self.not_found.add(ident)
 
     def is_resolvable(self, ident):
         return not self.source_file_path(ident) is None
@@ -175,7 +333,10 @@ class SimpleHTTPResolver(_AbstractResolver):
      * `source_suffix`, the url after the identifier (if applicable).
      * `default_format`, the format of images (will use content-type of response if not specified).
      * `head_resolvable` with value True, whether to make HEAD requests to verify object existence (don't set if using
-        Fedora Commons prior to 3.8).
+        Fedora Commons prior to 3.8). Otherwise checking an identifier
+        downloads it into the cache, so the request that usually follows
+        (e.g. for info.json) doesn't fetch it again; or, with
+        `jp2_header_fetch`, fetches just the first byte of a JP2.
      * `uri_resolvable` with value True, allows one to use full uri's to resolve to an image.
      * `user`, the username to make the HTTP request as.
      * `pw`, the password to make the HTTP request as.
@@ -184,7 +345,39 @@ class SimpleHTTPResolver(_AbstractResolver):
      self-signed certificate.
      * `cert`, path to an SSL client certificate to use for authentication. If `cert` and `key` are both present, they take precedence over `user` and `pw` for authentication.
      * `key`, path to an SSL client key to use for authentication.
+     * `pool_size`, connections kept open to each origin server (default 10).
+        Requests go through one pooled session, so connections (and TLS
+        sessions) are reused rather than opened for each fetch.
+     * `connect_timeout` and `read_timeout`, in seconds (defaults 10 and 60).
+     * `retries`, how many times to retry a request that fails to connect,
+        or gets a 502, 503 or 504 (default 3).
+     * `retry_backoff`, the backoff factor between retries: they wait
+        0, 2 * retry_backoff, 4 * retry_backoff... seconds (default 0.5).
+     * `not_found_ttl`, seconds for which an identifier that the origin
+        server said doesn't exist (404 or 410) is reported as not found
+        without asking again (default 0, i.e. off). See NotFoundCache.
+     * `chunk_size`, bytes read from the origin server at a time
+        (default 1048576).
+     * `range_parts`, how many ranges of a source of at least
+        `range_min_size` bytes (default 33554432) are downloaded at once,
+        if the origin server accepts range requests (default 4; 1 turns
+        this off).
+     * `jp2_header_fetch` with value True, to answer info requests for a
+        JP2 that isn't in the cache from its first bytes, fetched with a
+        Range request: `jp2_header_size` of them (default 65536), and twice
+        as many each time that isn't enough, up to `jp2_header_max_size`
+        (default 4194304), after which the whole file is fetched. The whole
+        file is only fetched when an image of it is requested (see
+        fetch_source()). The origin server must accept range requests.
+
+    Only one copy of each source is downloaded at a time, even by several
+    processes (a lock file under `cache_root`/.locks is held while it is);
+    other requests for it wait, then use the cached copy.
     '''
+    # Written to the cache directory of a source whose info was read from its
+    # header, with the identifier to fetch the rest of it with.
+    IDENT_FILE = 'loris_ident'
+
     def __init__(self, config):
         super(SimpleHTTPResolver, self).__init__(config)
 
@@ -208,10 +401,34 @@ class SimpleHTTPResolver(_AbstractResolver):
 
         self.ssl_check = self.config.get('ssl_check', True)
 
+        self.timeout = (
+            self.config.get('connect_timeout', 10),
+            self.config.get('read_timeout', 60)
+        )
+
+        self.chunk_size = self.config.get('chunk_size', 1024 * 1024)
+
+        self.range_parts = self.config.get('range_parts', 4)
+
+        self.range_min_size = self.config.get('range_min_size', 32 * 1024 * 1024)
+
+        self.jp2_header_fetch = self.config.get('jp2_header_fetch', False)
+
+        self.jp2_header_size = self.config.get('jp2_header_size', 64 * 1024)
+
+        self.jp2_header_max_size = self.config.get('jp2_header_max_size', 4 * 1024 * 1024)
+
+        self.session = self._make_session(
+            pool_size=self.config.get('pool_size', 10),
+            retries=self.config.get('retries', 3),
+            retry_backoff=self.config.get('retry_backoff', 0.5)
+        )
+
         self._ident_regex_checker = IdentRegexChecker(
             ident_regex=self.config.get('ident_regex')
         )
         self._cache_namer = CacheNamer()
+        self._fetch_locks = KeyedLock()
 
         if 'cache_root' in self.config:
             self.cache_root = self.config['cache_root']
@@ -226,6 +443,26 @@ class SimpleHTTPResolver(_AbstractResolver):
             logger.error(message)
             raise ResolverException(message)
 
+    @staticmethod
+    def _make_session(pool_size, retries, retry_backoff):
+        retry = Retry(
+            total=retries,
+            backoff_factor=retry_backoff,
+            status_forcelist=(502, 503, 504),
+            # (hand back the last response, rather than raise, if it is
+            # still one of those)
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_maxsize=pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def _request(self, method, url, **options):
+        options.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, **options)
+
     def request_options(self):
         # parameters to pass to all head and get requests;
         options = {}
@@ -237,31 +474,41 @@ class SimpleHTTPResolver(_AbstractResolver):
         return options
 
     def is_resolvable(self, ident):
+        quoted_ident = ident
         ident = unquote(ident)
 
         if not self._ident_regex_checker.is_allowed(ident):
             return False
 
-        fp = self.cache_dir_path(ident=ident)
-        if exists(fp):
+        if self.cached_file_for_ident(ident):
             return True
-        else:
-            try:
-                (url, options) = self._web_request_url(ident)
-            except ResolverException:
-                return False
+        if ident in self.not_found:
+            return False
 
-            try:
-                if self.head_resolvable:
-                    response = requests.head(url, **options)
-                    return response.ok
-                else:
-                    with closing(requests.get(url, stream=True, **options)) as response:
-                        return response.ok
-            except requests.ConnectionError:
-                return False
+        try:
+            (url, options) = self._web_request_url(ident)
+            if self.head_resolvable:
+                response = self._request('HEAD', url, **options)
+                self._check_found(ident, response)
+                return response.ok
+            if self.jp2_header_fetch and \
+                    self._fetch_jp2_header(ident, url, options, 0, 1) is not None:
+                # A JP2, whose info will be read from its header; don't
+                # download the rest of it until an image is asked for.
+                return True
+            # One GET both answers the question and fills the cache.
+            self.copy_to_cache(quoted_ident)
+            return True
+        except ResolverException:
+            return False
+        except (requests.ConnectionError, requests.Timeout):
+            return False
 
-        return False
+    def _check_found(self, ident, response):
+        # Only a 404 or 410 says the source doesn't exist. Other errors
+        # (e.g. 401, 403, 429, or any 5xx) may well be temporary.
+        if response.status_code in (404, 410):
+            self.not_found.add(ident)
 
     def get_format(self, ident, potential_format):
         if self.default_format is not None:
@@ -295,7 +542,11 @@ class SimpleHTTPResolver(_AbstractResolver):
     def cached_file_for_ident(self, ident):
         cache_dir = self.cache_dir_path(ident)
         if exists(cache_dir):
-            files = glob.glob(join(cache_dir, 'loris_cache.*'))
+            rules_fp = join(cache_dir, 'loris_cache.' + self.auth_rules_ext)
+            files = [
+                fp for fp in glob.glob(join(cache_dir, 'loris_cache.*'))
+                if fp != rules_fp
+            ]
             if files:
                 return files[0]
         return None
@@ -313,18 +564,46 @@ class SimpleHTTPResolver(_AbstractResolver):
             extension = self.get_format(ident, None)
         return extension
 
+    @contextmanager
+    def _fetch_lock(self, ident):
+        with self._fetch_locks.lock(ident):
+            lock_fp = lock_file_path(join(self.cache_root, '.locks'), ident)
+            with lock_file(lock_fp):
+                yield
+
     def copy_to_cache(self, ident):
+        '''
+        Downloads the source for ``ident`` into the cache, unless it is
+        already there (e.g. another request downloaded it while this one
+        waited for the lock).
+
+        Returns:
+            str: the path of the cached source.
+        '''
         ident = unquote(ident)
 
+        if ident in self.not_found:
+            raise ResolverException(
+                "Source image not found for identifier: %s." % ident
+            )
+
+        with self._fetch_lock(ident):
+            local_fp = self.cached_file_for_ident(ident)
+            if local_fp is not None:
+                logger.debug('Source for %s is already cached at %s', ident, local_fp)
+                return local_fp
+            return self._copy_to_cache(ident)
+
+    def _copy_to_cache(self, ident):
         #get source image and write to temporary file
         (source_url, options) = self._web_request_url(ident)
         assert source_url is not None
 
         cache_dir = self.cache_dir_path(ident)
-        mkdir_p(cache_dir)
 
-        with closing(requests.get(source_url, stream=True, **options)) as response:
+        with closing(self._request('GET', source_url, stream=True, **options)) as response:
             if not response.ok:
+                self._check_found(ident, response)
                 logger.warn(
                     "Source image not found at %s for identifier: %s. "
                     "Status code returned: %s.",
@@ -337,10 +616,15 @@ class SimpleHTTPResolver(_AbstractResolver):
 
             extension = self.cache_file_extension(ident, response)
             local_fp = join(cache_dir, "loris_cache." + extension)
+            mkdir_p(cache_dir)
 
             with tempfile.NamedTemporaryFile(dir=cache_dir, delete=False) as tmp_file:
-                for chunk in response.iter_content(2048):
-                    tmp_file.write(chunk)
+                try:
+                    self._download(response, source_url, options, tmp_file)
+                except Exception:
+                    tmp_file.close()
+                    remove(tmp_file.name)
+                    raise
 
         # Now rename the temp file to the desired file name if it still
         # doesn't exist (another process could have created it).
@@ -355,29 +639,224 @@ class SimpleHTTPResolver(_AbstractResolver):
             safe_rename(tmp_file.name, local_fp)
             logger.info("Copied %s to %s", source_url, local_fp)
 
+        self._fetch_rules(source_url, options, cache_dir)
+        return local_fp
+
+    def _fetch_rules(self, source_url, options, cache_dir):
         # Check for rules file associated with image file
         # These files are < 2k in size, so fetch in one go.
         # Assumes that the rules will be next to the image
         # cache_dir is image specific, so this is easy
 
-        bits = split(source_url)
+        bits = source_url.rsplit('/', 1)
         fn = bits[1].rsplit('.')[0] + "." + self.auth_rules_ext
         rules_url = bits[0] + '/' + fn
         try:
-            resp = requests.get(rules_url)
+            resp = self._request('GET', rules_url, **options)
             if resp.status_code == 200:
                 local_rules_fp = join(cache_dir, "loris_cache." + self.auth_rules_ext)
                 if not exists(local_rules_fp):
                     with open(local_rules_fp, 'w') as fh:
                         fh.write(resp.text)
-        except:
+        except requests.RequestException:
             # No connection available
             pass
 
-        return local_fp
+    def _download(self, response, url, options, tmp_file):
+        '''
+        Writes the body of ``response``, a streamed GET of ``url``, to
+        ``tmp_file``. If the origin server accepts range requests and the
+        file is big enough, the rest of it is fetched in ranges, in
+        parallel, while the first range is read from ``response``.
+        '''
+        try:
+            length = int(response.headers.get('content-length'))
+        except (TypeError, ValueError):
+            length = None
+        if length:
+            _preallocate(tmp_file, length)
+
+        if (length and length >= self.range_min_size and self.range_parts > 1 and
+                response.headers.get('accept-ranges') == 'bytes' and
+                response.headers.get('content-encoding', 'identity') == 'identity'):
+            part_size = -(-length // self.range_parts)
+            errors = []
+            ignored = []
+            threads = [
+                threading.Thread(
+                    target=self._fetch_range,
+                    args=(url, options, _if_range(response.headers),
+                          tmp_file.name, start, min(start + part_size, length),
+                          errors, ignored)
+                )
+                for start in range(part_size, length, part_size)
+            ]
+            for t in threads:
+                t.daemon = True
+                t.start()
+            chunks = response.iter_content(self.chunk_size)
+            try:
+                rest = _copy_range(chunks, tmp_file, part_size)
+            finally:
+                for t in threads:
+                    t.join()
+            if errors:
+                raise errors[0]
+            if ignored:
+                # The server sent the whole file rather than a range (it
+                # doesn't do ranges after all, or the file has changed), so
+                # read the rest of it from the first response.
+                logger.info('Range requests for %s were ignored; fetching '
+                            'the rest sequentially', url)
+                tmp_file.seek(part_size)
+                tmp_file.write(rest)
+                for chunk in chunks:
+                    tmp_file.write(chunk)
+                tmp_file.truncate()
+            else:
+                logger.debug('Fetched %s in %d ranges', url, len(threads) + 1)
+        else:
+            for chunk in response.iter_content(self.chunk_size):
+                tmp_file.write(chunk)
+            # (the body may have been shorter than we were told)
+            tmp_file.truncate()
+
+    def _fetch_range(self, url, options, if_range, fp, start, end, errors,
+                     ignored):
+        '''
+        Writes bytes [start, end) of ``url`` to the same place in ``fp``.
+        Appends the exception to ``errors`` if that fails, or ``start`` to
+        ``ignored`` if the server sends the whole file instead.
+        '''
+        headers = {'Range': 'bytes=%d-%d' % (start, end - 1)}
+        if if_range is not None:
+            # (gets the whole, changed, file rather than a piece of it)
+            headers['If-Range'] = if_range
+        try:
+            with closing(self._request('GET', url, stream=True, headers=headers,
+                                       **options)) as response:
+                if response.status_code == 200:
+                    ignored.append(start)
+                    return
+                content_range = response.headers.get('content-range', '')
+                if response.status_code != 206 or \
+                        not content_range.startswith('bytes %d-%d/' % (start, end - 1)):
+                    raise ResolverException(
+                        'Range %d-%d of %s failed (status %s, Content-Range %r).' %
+                        (start, end - 1, url, response.status_code, content_range)
+                    )
+                with open(fp, 'r+b') as f:
+                    f.seek(start)
+                    _copy_range(response.iter_content(self.chunk_size), f, end - start)
+        except Exception as e:
+            logger.warn('Fetching %s: %r', url, e)
+            errors.append(e)
+
+    def _fetch_jp2_header(self, ident, url, options, start, end):
+        '''
+        Fetches bytes [start, end) of the source at ``url``.
+
+        Returns:
+            (bytes, int) the bytes, and the size of the whole file; or None
+            if the server didn't send them, or the source isn't a JP2.
+        '''
+        headers = {'Range': 'bytes=%d-%d' % (start, end - 1)}
+        with closing(self._request('GET', url, stream=True, headers=headers,
+                                   **options)) as response:
+            if response.status_code != 206:
+                if response.status_code != 416:  # (asked past the end)
+                    self._check_found(ident, response)
+                return None
+            if start == 0 and self.cache_file_extension(ident, response) != 'jp2':
+                return None
+            try:
+                total = int(response.headers['content-range'].rsplit('/', 1)[1])
+            except (KeyError, ValueError):
+                return None
+            return (response.content, total)
+
+    def _resolve_from_jp2_header(self, app, ident, base_uri):
+        '''
+        Makes the ImageInfo of a JP2 from its first bytes, fetched with
+        Range requests, without fetching the rest of the file.
+
+        Returns:
+            ImageInfo, or None if that can't be done (e.g. it isn't a JP2,
+            or the server doesn't do range requests).
+        '''
+        quoted_ident = ident
+        ident = unquote(ident)
+        if app is None or 'jp2' not in app.transformers or ident in self.not_found:
+            return None
+        (url, options) = self._web_request_url(ident)
+        cache_dir = self.cache_dir_path(ident)
+        local_fp = join(cache_dir, 'loris_cache.jp2')
+
+        uri = self.fix_base_uri(base_uri)
+        formats = app.transformers['jp2'].target_formats
+
+        info = ImageInfo(None, uri, local_fp, 'jp2', {})
+        header = b''
+        size = self.jp2_header_size
+        while True:
+            fetched = self._fetch_jp2_header(ident, url, options, len(header), size)
+            if fetched is None:
+                return None
+            header += fetched[0]
+            try:
+                info.from_image_file(
+                    formats, app.max_size_above_full, src=JP2HeaderReader(header)
+                )
+                break
+            except JP2TruncatedError:
+                if len(header) >= fetched[1] or size >= self.jp2_header_max_size:
+                    logger.info('No JP2 header in the first %d bytes of %s',
+                        len(header), url)
+                    return None
+                size = min(size * 2, self.jp2_header_max_size)
+        logger.info('Read the info of %s from its first %d bytes', url, len(header))
+
+        # (so fetch_source knows what to fetch)
+        mkdir_p(cache_dir)
+        with open(join(cache_dir, self.IDENT_FILE), 'wb') as f:
+            f.write(quoted_ident.encode('utf-8'))
+
+        self._fetch_rules(url, options, cache_dir)
+        info.set_extra(self.get_extra_info(ident, local_fp))
+        return info
+
+    def fetch_source(self, image_info):
+        '''
+        Raises:
+            ResolverException: if the source has gone from the cache since
+                ``image_info`` was made (e.g. the cache cleaner has removed
+                it), so the info should be resolved again.
+        '''
+        if exists(image_info.src_img_fp):
+            return
+        cache_dir = dirname(abspath(image_info.src_img_fp))
+        if not cache_dir.startswith(abspath(self.cache_root) + os.sep):
+            return  # not one of ours
+        try:
+            with open(join(cache_dir, self.IDENT_FILE), 'rb') as f:
+                ident = f.read().decode('utf-8')
+        except IOError:
+            raise ResolverException(
+                "Source image %s is no longer in the cache." %
+                image_info.src_img_fp
+            )
+        local_fp = self.copy_to_cache(ident)
+        if local_fp != image_info.src_img_fp:
+            raise ResolverException(
+                "Source image for identifier %s is no longer a JP2." % ident
+            )
 
     def resolve(self, app, ident, base_uri):
         cached_file_path = self.cached_file_for_ident(ident)
+        if not cached_file_path and self.jp2_header_fetch:
+            info = self._resolve_from_jp2_header(app, ident, base_uri)
+            if info is not None:
+                return info
         if not cached_file_path:
             cached_file_path = self.copy_to_cache(ident)
         format_ = self.get_format(cached_file_path, None)
@@ -386,6 +865,44 @@ class SimpleHTTPResolver(_AbstractResolver):
         return ImageInfo(app, uri, cached_file_path, format_, extra)
 
 
+def _preallocate(f, length):
+    # Reserves the space up front, so a large file isn't fragmented, and
+    # runs out of space now rather than part way through.
+    f.flush()
+    try:
+        os.posix_fallocate(f.fileno(), 0, length)
+    except (AttributeError, OSError):  # Python 2, or not supported here
+        f.truncate(length)
+
+
+def _if_range(headers):
+    '''
+    The validator to send as If-Range with range requests for the rest of
+    a response with ``headers``: its ETag, unless that is weak (which
+    RFC 7233 doesn't allow there), else its Last-Modified, or None.
+    '''
+    etag = headers.get('etag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return headers.get('last-modified')
+
+
+def _copy_range(chunks, f, length):
+    '''
+    Writes the first ``length`` bytes of ``chunks`` to ``f``, and returns
+    the rest of the last chunk read.
+    '''
+    remaining = length
+    for chunk in chunks:
+        f.write(chunk[:remaining])
+        if len(chunk) >= remaining:
+            return chunk[remaining:]
+        remaining -= len(chunk)
+    raise ResolverException(
+        'Source image response ended %d bytes short.' % remaining
+    )
+
+
 class TemplateHTTPResolver(SimpleHTTPResolver):
     """
     An HTTP resolver that supports multiple configurable patterns for
@@ -412,7 +929,9 @@ class TemplateHTTPResolver(SimpleHTTPResolver):
 
         Each subsection MAY also contain other keys from the SimpleHTTPResolver
         configuration to provide a per-template override of each of these
-        options -- ``user``, ``pw``, ``ssl_check``, ``cert`` and ``key``.
+        options -- ``user``, ``pw``, ``ssl_check``, ``cert``, ``key``,
+        ``connect_timeout`` and ``read_timeout``.  Every template shares the
+        resolver's pool of connections.
 
     If a template is listed but has no pattern configured, the resolver
     will warn but not error.
@@ -438,6 +957,9 @@ class TemplateHTTPResolver(SimpleHTTPResolver):
     *   ``head_resolvable`` with value True, whether to make HEAD requests
         to validate object existence (don't set if using Fedora Commons
         prior to 3.8.)  [Currently must be the same for all templates.]
+    *   ``jp2_header_fetch``, ``jp2_header_size`` and
+        ``jp2_header_max_size``, to read the info of JP2s from their first
+        bytes.  [Also the same for all templates.]
 
     """
     def __init__(self, config):
@@ -502,6 +1024,11 @@ class TemplateHTTPResolver(SimpleHTTPResolver):
             options['auth'] = (conf['user'], conf['pw'])
         if 'ssl_check' in conf:
             options['verify'] = conf['ssl_check']
+        if 'connect_timeout' in conf or 'read_timeout' in conf:
+            options['timeout'] = (
+                conf.get('connect_timeout', self.timeout[0]),
+                conf.get('read_timeout', self.timeout[1])
+            )
         return (url, options)
 
 
@@ -522,8 +1049,12 @@ class SourceImageCachingResolver(_AbstractResolver):
         self.source_root = self.config['source_root']
 
     def is_resolvable(self, ident):
-        source_fp = self.source_file_path(ident)
-        return exists(source_fp)
+        if unquote(ident) in self.not_found:
+            return False
+        if exists(self.source_file_path(ident)):
+            return True
+        self.not_found.add(unquote(ident))
+        return False
 
     def source_file_path(self, ident):
         ident = unquote(ident)
@@ -625,6 +1156,11 @@ class PreferredSuffixResolver(SourceImageCachingResolver):
     Searches /source_root/ident + source_suffix, then /fallback_root/ident + fallback_suffix. 404 if neither are found.
     
     NB: source_suffix, fallback_suffix accept globbing patterns.
+
+    With ``source_index_fp`` set, both patterns are matched against a
+    SourceIndex (see loris.source_index). The roots are only globbed if
+    neither is in it, or (in case it is there but not indexed yet) for the
+    source_root pattern if only the fallback_root one is.
     
     """
 	    
@@ -635,22 +1171,38 @@ class PreferredSuffixResolver(SourceImageCachingResolver):
         self.fallback_root = self.config['fallback_root']
         self.fallback_suffix = self.config['fallback_suffix']
         self.cache_root = self.config['cache_root']
+        self.source_index = SourceIndex.from_config(self.config)
+        self.source_index_roots = [self.source_root, self.fallback_root]
         logger.debug("PreferredSuffixResolver loaded")
 
     def search_files(self,ident):
         # Glob-searches a directory path for filenames pattern, returns first match
 
-        pref = ident + self.source_suffix
-        match = glob.glob( join( self.source_root, pref ))
-        if match:
-           return match[0] 
-
-        fall = ident + self.fallback_suffix
-        match = glob.glob( join( self.fallback_root,fall ))
-        if match:
-            return match[0]
+        patterns = (
+            join(self.source_root, ident + self.source_suffix),
+            join(self.fallback_root, ident + self.fallback_suffix),
+        )
 
-        return ''
+        # The index is asked about both roots before either is globbed, but
+        # a match in the fallback root is only used once the source root
+        # has been globbed.
+        indexed_match = ''
+        if self.source_index is not None:
+            for i, pattern in enumerate(patterns):
+                match = self.source_index.glob(pattern)
+                if match:
+                    indexed_match = match[0]
+                    patterns = patterns[:i]
+                    break
+
+        for pattern in patterns:
+            match = glob.glob(pattern)
+            if match:
+                if self.source_index is not None:
+                    self.source_index.add(match[0])
+                return match[0]
+
+        return indexed_match
 
     def source_file_path(self, ident):
         ident = unquote(ident)
@@ -677,3 +1229,107 @@ class PreferredSuffixResolver(SourceImageCachingResolver):
         logger.info("Cached copy sent %s",cache_fp)
         
         return ImageInfo(app, uri, cache_fp, format_, extra)
+
+
+class MemoizingResolver(_AbstractResolver):
+    '''
+    Wraps another resolver, and remembers what it resolved each identifier
+    to (the source file, its format and its extra info) along with the
+    file's modification time and size. While those still match and the
+    entry is less than ``memo_ttl`` seconds old, resolve() and
+    is_resolvable() cost a single stat() of the file, rather than whatever
+    searching the wrapped resolver would do. At most ``memo_max_size``
+    identifiers are remembered; the least recently used are forgotten first.
+
+    The config MUST contain ``memoized_impl``, the class of the resolver to
+    wrap; the rest of the config is passed on to it, e.g.::
+
+        [resolver]
+        impl = 'loris.resolver.MemoizingResolver'
+        memoized_impl = 'loris.resolver.PreferredSuffixResolver'
+        memo_ttl = 300
+        ...
+
+    Only the file that the wrapped resolver returned is checked, so if that
+    is a copy in a cache, changes to the original (or to its rules file)
+    are seen once the entry is older than ``memo_ttl``.
+    '''
+    def __init__(self, config):
+        super(MemoizingResolver, self).__init__(config)
+        self.resolver = import_class(self.config['memoized_impl'])(config)
+        self.not_found = self.resolver.not_found
+        self.ttl = self.config.get('memo_ttl', 300)
+        self.max_size = self.config.get('memo_max_size', 10000)
+        self.hits = 0
+        self.misses = 0
+        # ident -> (src_img_fp, src_format, extra, mtime, size, expiry),
+        # least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _lookup(self, ident):
+        '''The entry for ``ident`` if the file it names hasn't changed.'''
+        with self._lock:
+            entry = self._entries.get(ident)
+            if entry is not None:
+                self._entries.pop(ident)
+        if entry is not None and entry[5] > time.time():
+            try:
+                stat = os.stat(entry[0])
+            except OSError:
+                stat = None
+            if stat is not None and (stat.st_mtime, stat.st_size) == entry[3:5]:
+                with self._lock:
+                    self._entries[ident] = entry
+                    self.hits += 1
+                return entry
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _remember(self, ident, info):
+        try:
+            stat = os.stat(info.src_img_fp)
+        except OSError:
+            return
+        entry = (
+            info.src_img_fp, info.src_format, info.auth_rules,
+            stat.st_mtime, stat.st_size, time.time() + self.ttl
+        )
+        with self._lock:
+            self._entries.pop(ident, None)
+            self._entries[ident] = entry
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def forget(self, ident):
+        '''Forgets what ``ident`` resolved to.'''
+        with self._lock:
+            self._entries.pop(unquote(ident), None)
+
+    def forget_not_found(self, ident):
+        self.forget(ident)
+        self.resolver.forget_not_found(ident)
+
+    def fetch_source(self, image_info):
+        self.resolver.fetch_source(image_info)
+
+    def is_resolvable(self, ident):
+        if self.ttl and self._lookup(unquote(ident)) is not None:
+            return True
+        return self.resolver.is_resolvable(ident)
+
+    def resolve(self, app, ident, base_uri):
+        if not self.ttl:
+            return self.resolver.resolve(app, ident, base_uri)
+        entry = self._lookup(unquote(ident))
+        if entry is None:
+            info = self.resolver.resolve(app, ident, base_uri)
+            self._remember(unquote(ident), info)
+            return info
+        src_img_fp, src_format, extra = entry[:3]
+        uri = self.resolver.fix_base_uri(base_uri)
+        return ImageInfo(app, uri, src_img_fp, src_format, deepcopy(extra))
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,352 @@
+# seed.py
+# -*- coding: utf-8 -*-
+'''
+Pre-generates ("seeds") the image cache with the tiles and sizes that IIIF
+viewers will ask for, so that the first person to open a newly ingested
+image doesn't wait for every tile to be rendered.
+
+Tiles are rendered into the cache by :meth:`Loris._make_images`, so they end
+up exactly where a request would look for them. Work is split into one batch
+per resolution level, and batches are spread over a pool of worker
+processes. Each worker runs one decoder at a time, so the number of workers
+caps the number of parallel decodes.
+
+Each batch goes to the transformer's ``transform_batch``, so for JP2s a
+level that is small enough is decoded once, and all of its tiles are cut
+from that one decode.
+
+Anything already in the cache is skipped, so an interrupted run can simply
+be started again.
+
+See ``bin/loris-seed`` (or ``python -m loris.seed --help``).
+'''
+from __future__ import absolute_import, division
+
+import argparse
+from logging import getLogger
+from math import ceil
+import multiprocessing
+from os import path
+import sys
+import time
+
+try:
+    from urllib.parse import quote_plus, unquote
+except ImportError:  # Python 2
+    from urllib import quote_plus, unquote
+
+from loris import img
+from loris.loris_exception import LorisException
+from loris.webapp import Loris, read_config
+
+logger = getLogger(__name__)
+
+CONFIG_FILE_DEFAULT = '/etc/loris2/loris2.conf'
+
+# Levels with more pixels than this are decoded a batch of tiles at a time,
+# rather than being held in memory whole (64 megapixels is ~200MB of RGB).
+MAX_LEVEL_PIXELS_DEFAULT = 64 * 1024 * 1024
+
+# Tiles per batch, for levels that aren't decoded whole. Tiles are listed
+# row by row, so a batch is a band of neighbouring tiles, which
+# transform_batch can decode together.
+BATCH_SIZE = 64
+
+
+def _scale_dim(dim, scale):
+    return int(ceil(dim / scale))
+
+
+def tile_regions(image_info):
+    '''
+    Enumerates the tile pyramid described by the ``tiles`` of an ImageInfo,
+    following the algorithm in the IIIF Image API (§ C.2 of v2.1).
+
+    Returns:
+        [(scale factor, [(region, size)])], smallest level first, where
+        region and size are IIIF URI segments, e.g. ('0,0,1024,1024', '256,').
+    '''
+    levels = {}
+    for tile in image_info.tiles or []:
+        tile_w = tile['width']
+        tile_h = tile.get('height', tile_w)
+        for scale in tile['scaleFactors']:
+            region_w = tile_w * scale
+            region_h = tile_h * scale
+            regions = levels.setdefault(scale, [])
+            for y in range(0, image_info.height, region_h):
+                for x in range(0, image_info.width, region_w):
+                    w = min(region_w, image_info.width - x)
+                    h = min(region_h, image_info.height - y)
+                    regions.append((
+                        '%d,%d,%d,%d' % (x, y, w, h),
+                        '%d,' % _scale_dim(w, scale)
+                    ))
+    return sorted(levels.items(), reverse=True)
+
+
+def size_regions(image_info):
+    '''Returns [('full', size)] for each of the ``sizes`` of an ImageInfo.'''
+    return [('full', '%d,' % s['width']) for s in image_info.sizes or []]
+
+
+def canonical_requests(ident, image_info, regions, quality, fmt):
+    '''
+    Returns an ImageRequest for each (region, size), in canonical form and
+    without duplicates, so that its cache path is where a rendered image
+    would be stored.
+    '''
+    requests = []
+    seen = set()
+    for region, size in regions:
+        r = img.ImageRequest(ident, region, size, '0', quality, fmt)
+        canonical = img.ImageRequest(
+            ident,
+            r.region_param(image_info).canonical_uri_value,
+            r.size_param(image_info).canonical_uri_value,
+            '0', quality, fmt
+        )
+        if canonical.cache_path not in seen:
+            seen.add(canonical.cache_path)
+            requests.append(canonical)
+    return requests
+
+
+def _render_batch(app, image_info, image_requests):
+    '''Renders each request into the cache. Returns (rendered, failed).'''
+    try:
+        app._make_images(image_requests, image_info)
+        return (len(image_requests), 0)
+    except (LorisException, IOError, OSError) as e:
+        logger.warn('Batch of %d failed (%r); rendering one at a time',
+            len(image_requests), e)
+
+    rendered = failed = 0
+    for image_request in image_requests:
+        try:
+            app._make_image(image_request, image_info)
+            rendered += 1
+        except (LorisException, IOError, OSError) as e:
+            logger.error('Could not render %s: %r',
+                image_request.request_path, e)
+            failed += 1
+    return (rendered, failed)
+
+
+def _seed_worker(config, max_level_pixels, tasks, results):
+    # Each worker runs a single decoder at a time, and decodes up to a whole
+    # level at once (this is the worker's own copy of the config).
+    for tf_config in config['transforms'].values():
+        if isinstance(tf_config, dict):
+            tf_config['decoder_pool_size'] = 1
+            tf_config['batch_max_pixels'] = max_level_pixels
+    app = Loris(config)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        task_id, image_info, image_requests = task
+        try:
+            rendered, failed = _render_batch(app, image_info, image_requests)
+        except Exception as e:  # don't lose the worker, or the result
+            logger.exception('Batch %s failed: %r', task_id, e)
+            rendered, failed = 0, len(image_requests)
+        results.put((task_id, rendered, failed))
+
+
+class Seeder(object):
+    '''
+    Seeds the image cache of the Loris configured by ``config``.
+
+    Args:
+        config (dict): a Loris configuration (see loris.webapp.read_config).
+        processes (int): worker processes, i.e. parallel decodes.
+        quality (str): quality of the derivatives to make.
+        fmt (str): format of the derivatives to make.
+        base_uri (str): prefix for identifiers in info.json @id.
+        max_level_pixels (int): largest JP2 level to decode whole.
+        progress (file): where progress is reported.
+    '''
+    def __init__(self, config, processes=None, quality='default', fmt='jpg',
+                 base_uri='http://localhost/',
+                 max_level_pixels=MAX_LEVEL_PIXELS_DEFAULT,
+                 progress=sys.stderr):
+        if not config['loris.Loris']['enable_caching']:
+            raise LorisException('Seeding needs enable_caching = True')
+
+        self.config = config
+        self.processes = processes or multiprocessing.cpu_count()
+        self.quality = quality
+        self.fmt = fmt
+        self.base_uri = base_uri
+        self.max_level_pixels = max_level_pixels
+        self.progress = progress
+        self.app = Loris(config)
+
+    def _report(self, message, *args):
+        if args:
+            message = message % args
+        self.progress.write(message + '\n')
+        self.progress.flush()
+
+    def _resolve(self, ident):
+        ident = quote_plus(unquote(ident))
+        return self.app.resolver.resolve(self.app, ident, self.base_uri + ident)
+
+    def _is_cached(self, image_request, image_info):
+        return path.exists(self.app.img_cache.get_canonical_cache_path(
+            image_request=image_request,
+            image_info=image_info
+        ))
+
+    def batches(self, ident, image_info):
+        '''
+        Returns [(label, [ImageRequest])] of everything for ``ident`` that
+        isn't in the cache yet, and the number of requests already cached.
+        '''
+        ident = quote_plus(unquote(ident))
+        levels = tile_regions(image_info)
+        levels.append(('sizes', size_regions(image_info)))
+
+        batches = []
+        cached = 0
+        done = set()
+        for scale, regions in levels:
+            requests = []
+            for r in canonical_requests(ident, image_info, regions, self.quality, self.fmt):
+                if r.cache_path in done:
+                    continue
+                done.add(r.cache_path)
+                if self._is_cached(r, image_info):
+                    cached += 1
+                else:
+                    requests.append(r)
+            if not requests:
+                continue
+
+            label = 'sizes' if scale == 'sizes' else 'scale %d' % scale
+            level_pixels = (
+                _scale_dim(image_info.width, scale) *
+                _scale_dim(image_info.height, scale)
+            ) if scale != 'sizes' else 0
+            if image_info.src_format == 'jp2' and level_pixels <= self.max_level_pixels:
+                batches.append((label, requests))
+            else:
+                for i in range(0, len(requests), BATCH_SIZE):
+                    batches.append((label, requests[i:i + BATCH_SIZE]))
+        return (batches, cached)
+
+    def seed(self, idents):
+        '''
+        Seeds the cache for each identifier.
+
+        Returns:
+            dict of counts: rendered, cached (skipped), failed, and
+            unresolved identifiers.
+        '''
+        totals = {'rendered': 0, 'cached': 0, 'failed': 0, 'unresolved': 0}
+        tasks = []
+        for ident in idents:
+            try:
+                image_info = self._resolve(ident)
+            except LorisException as e:
+                self._report('%s: could not resolve: %s', ident, e)
+                totals['unresolved'] += 1
+                continue
+            batches, cached = self.batches(ident, image_info)
+            totals['cached'] += cached
+            for label, requests in batches:
+                tasks.append(('%s %s' % (ident, label), image_info, requests))
+            self._report('%s: %d to render, %d already cached',
+                ident, sum(len(r) for _, r in batches), cached)
+
+        if tasks:
+            self._run(tasks, totals)
+        self._report('Done: %(rendered)d rendered, %(cached)d already cached, '
+            '%(failed)d failed, %(unresolved)d unresolved identifiers' % totals)
+        return totals
+
+    def _run(self, tasks, totals):
+        task_queue = multiprocessing.Queue()
+        results = multiprocessing.Queue()
+        for task in tasks:
+            task_queue.put(task)
+
+        # Workers start their own decoder processes, so they can't be
+        # (daemonic) multiprocessing.Pool workers.
+        workers = [
+            multiprocessing.Process(
+                target=_seed_worker,
+                args=(self.config, self.max_level_pixels, task_queue, results)
+            )
+            for _ in range(min(self.processes, len(tasks)))
+        ]
+        for w in workers:
+            task_queue.put(None)
+            w.start()
+
+        total = sum(len(t[2]) for t in tasks)
+        done = 0
+        start = time.time()
+        try:
+            for n in range(1, len(tasks) + 1):
+                task_id, rendered, failed = results.get()
+                totals['rendered'] += rendered
+                totals['failed'] += failed
+                done += rendered + failed
+                self._report('[%d/%d] %s: %d rendered, %d failed '
+                    '(%d/%d images, %.1f/s)', n, len(tasks), task_id,
+                    rendered, failed, done, total, done / (time.time() - start))
+        except KeyboardInterrupt:
+            self._report('Interrupted; run again to pick up where this left off')
+            for w in workers:
+                w.terminate()
+            raise
+        finally:
+            for w in workers:
+                w.join()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Render the IIIF tiles and sizes of images into the Loris cache.'
+    )
+    parser.add_argument('idents', nargs='+', metavar='IDENT',
+        help="identifier to seed ('-' reads identifiers from stdin, one per line)")
+    parser.add_argument('-c', '--config', default=CONFIG_FILE_DEFAULT,
+        help='Loris configuration file [default: %(default)s]')
+    parser.add_argument('-p', '--processes', type=int,
+        default=multiprocessing.cpu_count(),
+        help='worker processes, i.e. parallel decodes [default: %(default)s]')
+    parser.add_argument('--quality', default='default',
+        help='quality to render [default: %(default)s]')
+    parser.add_argument('--format', default='jpg', dest='fmt',
+        help='format to render [default: %(default)s]')
+    parser.add_argument('--base-uri', default='http://localhost/',
+        help='prefix for identifiers in info.json [default: %(default)s]')
+    parser.add_argument('--max-level-pixels', type=int,
+        default=MAX_LEVEL_PIXELS_DEFAULT,
+        help='largest JP2 level to decode in one go [default: %(default)s]')
+    args = parser.parse_args(argv)
+
+    idents = []
+    for ident in args.idents:
+        if ident == '-':
+            idents.extend(line.strip() for line in sys.stdin if line.strip())
+        else:
+            idents.append(ident)
+
+    seeder = Seeder(
+        read_config(args.config),
+        processes=args.processes,
+        quality=args.quality,
+        fmt=args.fmt,
+        base_uri=args.base_uri,
+        max_level_pixels=args.max_level_pixels,
+    )
+    totals = seeder.seed(idents)
+    return 1 if (totals['failed'] or totals['unresolved']) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
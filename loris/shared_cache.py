@@ -0,0 +1,155 @@
+# shared_cache.py
+# -*- coding: utf-8 -*-
+'''
+A fixed-size hash table of byte strings in a memory-mapped file, which every
+process that maps the same file shares (see :class:`loris.img_info.InfoCache`).
+
+The file is a header followed by ``slots`` slots of ``slot_size`` bytes each.
+A key hashes to exactly one slot, and a new entry simply replaces whatever
+was in its slot, so the table never needs to be resized or compacted; values
+too big for a slot aren't stored. Put it on a tmpfs (e.g. ``/dev/shm``) so
+that it is never written back to disk; only the pages that have been written
+to take up memory.
+
+Each slot starts with a sequence number, which writers make odd while they
+change the slot and even again when they are done. Readers don't lock: they
+copy the slot, and treat it as a miss if the sequence number was odd or
+changed while they did. Writers take an ``fcntl`` lock on the slot (plus a
+thread lock, as ``fcntl`` locks are per process).
+
+The first process to open the file sets it up. Processes that open it later
+use its layout, whatever they were configured with.
+'''
+from __future__ import absolute_import
+
+from contextlib import contextmanager
+import fcntl
+import hashlib
+from logging import getLogger
+import mmap
+import os
+import struct
+import threading
+
+from loris.utils import mkdir_p
+
+logger = getLogger(__name__)
+
+MAGIC = b'LorisSHT'
+VERSION = 1
+
+# magic, version, number of slots, slot size
+HEADER = struct.Struct('=8sIII')
+HEADER_SIZE = mmap.PAGESIZE
+
+# sequence number, key length, value length
+SLOT_HEADER = struct.Struct('=QII')
+SEQUENCE = struct.Struct('=Q')
+
+
+class SharedCache(object):
+    '''
+    Args:
+        fp (str): the file to map; created if it doesn't exist.
+        slots (int): number of entries the table can hold.
+        slot_size (int): bytes per entry, including the key and a 16 byte
+            header.
+    '''
+    def __init__(self, fp, slots=8192, slot_size=16384):
+        self.fp = fp
+        self._lock = threading.Lock()
+        self._fd, self.slots, self.slot_size = self._open(fp, slots, slot_size)
+        self._map = mmap.mmap(self._fd, HEADER_SIZE + self.slots * self.slot_size)
+
+    @staticmethod
+    def _open(fp, slots, slot_size):
+        mkdir_p(os.path.dirname(fp))
+        fd = os.open(fp, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.lockf(fd, fcntl.LOCK_EX)
+        try:
+            header = os.read(fd, HEADER.size)
+            if len(header) == HEADER.size:
+                magic, version, file_slots, file_slot_size = HEADER.unpack(header)
+                if magic == MAGIC and version == VERSION:
+                    if (file_slots, file_slot_size) != (slots, slot_size):
+                        logger.warn('%s has %d slots of %d bytes; using those',
+                            fp, file_slots, file_slot_size)
+                    return (fd, file_slots, file_slot_size)
+            logger.info('Creating %s (%d slots of %d bytes)', fp, slots, slot_size)
+            os.ftruncate(fd, 0)
+            os.ftruncate(fd, HEADER_SIZE + slots * slot_size)
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.write(fd, HEADER.pack(MAGIC, VERSION, slots, slot_size))
+            return (fd, slots, slot_size)
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN)
+
+    def _offset(self, key):
+        h = struct.unpack('=Q', hashlib.md5(key).digest()[:8])[0]
+        return HEADER_SIZE + (h % self.slots) * self.slot_size
+
+    def get(self, key):
+        '''Returns the value (bytes) stored under ``key`` (bytes), or None.'''
+        offset = self._offset(key)
+        seq, key_len, value_len = SLOT_HEADER.unpack_from(self._map, offset)
+        if seq & 1 or key_len != len(key) or \
+                SLOT_HEADER.size + key_len + value_len > self.slot_size:
+            return None
+        start = offset + SLOT_HEADER.size
+        if self._map[start:start + key_len] != key:
+            return None
+        value = self._map[start + key_len:start + key_len + value_len]
+        if SEQUENCE.unpack_from(self._map, offset)[0] != seq:
+            return None  # changed while we read it
+        return value
+
+    def put(self, key, value):
+        '''
+        Stores ``value`` (bytes) under ``key`` (bytes), replacing whatever
+        was in its slot. Returns False if it is too big to store.
+        '''
+        if SLOT_HEADER.size + len(key) + len(value) > self.slot_size:
+            return False
+        offset = self._offset(key)
+        with self._write(offset) as seq:
+            start = offset + SLOT_HEADER.size
+            self._map[start:start + len(key)] = key
+            self._map[start + len(key):start + len(key) + len(value)] = value
+            SLOT_HEADER.pack_into(self._map, offset, seq, len(key), len(value))
+        return True
+
+    def discard(self, key):
+        '''Removes ``key``, if it is stored.'''
+        offset = self._offset(key)
+        with self._write(offset) as seq:
+            key_len = SLOT_HEADER.unpack_from(self._map, offset)[1]
+            start = offset + SLOT_HEADER.size
+            if key_len == len(key) and self._map[start:start + key_len] == key:
+                SLOT_HEADER.pack_into(self._map, offset, seq, 0, 0)
+
+    @contextmanager
+    def _write(self, offset):
+        '''
+        Locks the slot at ``offset``, and marks it as being written (odd)
+        while the block changes it; the block is given that sequence
+        number to keep. Marks it as written (even) at the end, even if the
+        block fails, so readers re-check what is there.
+        '''
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, self.slot_size, offset)
+            try:
+                seq = SEQUENCE.unpack_from(self._map, offset)[0]
+                # (already odd if a writer died part way through)
+                seq = seq + 1 if seq % 2 == 0 else seq + 2
+                SEQUENCE.pack_into(self._map, offset, seq)
+                try:
+                    yield seq
+                finally:
+                    SEQUENCE.pack_into(self._map, offset, seq + 1)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, self.slot_size, offset)
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
@@ -0,0 +1,271 @@
+# source_index.py
+# -*- coding: utf-8 -*-
+'''
+An SQLite index of the files under the source roots of a filesystem resolver
+(:class:`loris.resolver.SimpleFSResolver` or
+:class:`loris.resolver.PreferredSuffixResolver`), so that finding the source
+of an identifier costs one indexed lookup and one ``stat()``, rather than
+probing every root or globbing whole directories, which can take tens of
+milliseconds on network storage.
+
+The index records every file, by its absolute path, and every directory,
+with its modification time. Adding or removing a file changes the
+modification time of the directory it is in, so :meth:`SourceIndex.update`
+only lists the directories whose modification time has changed since they
+were last listed; the rest of the tree costs one ``stat()`` per directory.
+
+Resolvers still look on the filesystem for identifiers the index doesn't
+have (e.g. images ingested since the last update), and add what they find.
+A file that the index has but that has gone is dropped from it.
+
+Run ``bin/loris-source_index`` to build the index, and again (e.g. from cron,
+or after ingesting images) to bring it up to date.
+'''
+from __future__ import absolute_import
+
+import argparse
+from fnmatch import fnmatchcase
+from logging import getLogger
+import os
+from os import path
+import sqlite3
+import sys
+import threading
+import time
+
+from loris.utils import import_class, mkdir_p
+
+logger = getLogger(__name__)
+
+CONFIG_FILE_DEFAULT = '/etc/loris2/loris2.conf'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    mtime REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent);
+
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    dir TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+'''
+
+
+def _text(fp):
+    # sqlite3 stores paths as text, and identifiers are text, but Python 2
+    # paths (e.g. from the configuration) may be bytes.
+    if isinstance(fp, bytes):
+        return fp.decode(sys.getfilesystemencoding() or 'utf-8')
+    return fp
+
+
+def _glob_matches(pattern, fp):
+    # As glob.glob: wildcards don't match across a '/'.
+    pattern_parts = pattern.split('/')
+    fp_parts = fp.split('/')
+    return len(pattern_parts) == len(fp_parts) and all(
+        fnmatchcase(f, p) for f, p in zip(fp_parts, pattern_parts)
+    )
+
+
+class SourceIndex(object):
+    '''
+    Args:
+        db_fp (str): the SQLite database; created if it doesn't exist.
+
+    Each thread (and process) gets its own connection.
+    '''
+    def __init__(self, db_fp):
+        self.db_fp = db_fp
+        self._local = threading.local()
+
+    @classmethod
+    def from_config(cls, config):
+        '''The index configured by ``source_index_fp``, or None.'''
+        db_fp = (config or {}).get('source_index_fp')
+        return cls(db_fp) if db_fp else None
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            mkdir_p(path.dirname(self.db_fp))
+            conn = sqlite3.connect(self.db_fp, timeout=60)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def find(self, fps):
+        '''
+        Returns the first of ``fps`` (absolute paths) that is indexed and
+        still exists, or None.
+        '''
+        fps = list(fps)
+        texts = [_text(fp) for fp in fps]
+        indexed = set(row[0] for row in self._connection().execute(
+            'SELECT path FROM files WHERE path IN (%s)' % ','.join('?' * len(fps)),
+            texts
+        ))
+        for fp, text in zip(fps, texts):
+            if text in indexed:
+                if path.exists(fp):
+                    return fp
+                self.discard(text)
+        return None
+
+    def glob(self, pattern):
+        '''
+        As glob.glob(pattern), for an absolute ``pattern``, but from the
+        index, and only files that still exist. Sorted.
+        '''
+        pattern = _text(pattern)
+        matches = []
+        for (fp,) in self._connection().execute(
+            'SELECT path FROM files WHERE path GLOB ? ORDER BY path', (pattern,)
+        ):
+            if not _glob_matches(pattern, fp):
+                continue
+            if path.exists(fp):
+                matches.append(fp)
+            else:
+                self.discard(fp)
+        return matches
+
+    def add(self, fp):
+        '''Record a file found since the last update.'''
+        fp = _text(fp)
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO files (path, dir) VALUES (?, ?)',
+                (fp, path.dirname(fp))
+            )
+
+    def discard(self, fp):
+        '''Forget a file that has gone.'''
+        fp = _text(fp)
+        conn = self._connection()
+        with conn:
+            conn.execute('DELETE FROM files WHERE path = ?', (fp,))
+
+    def __len__(self):
+        return self._connection().execute(
+            'SELECT COUNT(*) FROM files'
+        ).fetchone()[0]
+
+    def _remove_tree(self, conn, dp):
+        # Everything below dp sorts between dp + '/' and dp + '0'.
+        below = (dp + '/', dp + '0')
+        conn.execute('DELETE FROM files WHERE dir = ? OR (dir >= ? AND dir < ?)',
+            (dp,) + below)
+        conn.execute('DELETE FROM dirs WHERE path = ? OR (path >= ? AND path < ?)',
+            (dp,) + below)
+
+    def update(self, root, full=False):
+        '''
+        Bring the index of the tree under ``root`` up to date, listing only
+        the directories that have changed since they were last listed (or
+        every directory, if ``full``). Names starting with '.' are skipped.
+
+        Returns:
+            (int, int) the number of directories listed, and of files found
+            in them.
+        '''
+        # (listing a text path gives text names, on Python 2 too)
+        root = _text(path.abspath(root)).rstrip(u'/') or u'/'
+        conn = self._connection()
+        listed = found = 0
+        stack = [root]
+        while stack:
+            dp = stack.pop()
+            try:
+                mtime = os.stat(dp).st_mtime
+            except OSError:
+                with conn:
+                    self._remove_tree(conn, dp)
+                continue
+            children = [row[0] for row in conn.execute(
+                'SELECT path FROM dirs WHERE parent = ?', (dp,)
+            )]
+            row = conn.execute(
+                'SELECT mtime FROM dirs WHERE path = ?', (dp,)
+            ).fetchone()
+            if row is not None and row[0] == mtime and not full:
+                stack.extend(children)
+                continue
+
+            files = []
+            subdirs = []
+            for name in os.listdir(dp):
+                if isinstance(name, bytes):
+                    # (Python 2 gives bytes for a name it can't decode)
+                    logger.warning('Not indexing %r in %s: can\'t decode the name',
+                                   name, dp)
+                    continue
+                if name.startswith('.'):
+                    continue
+                fp = path.join(dp, name)
+                if path.isdir(fp):
+                    subdirs.append(fp)
+                else:
+                    files.append((fp, dp))
+            listed += 1
+            found += len(files)
+
+            with conn:
+                for gone in set(children) - set(subdirs):
+                    self._remove_tree(conn, gone)
+                conn.execute('DELETE FROM files WHERE dir = ?', (dp,))
+                conn.executemany(
+                    'INSERT OR REPLACE INTO files (path, dir) VALUES (?, ?)', files
+                )
+                conn.execute(
+                    'INSERT OR REPLACE INTO dirs (path, parent, mtime) VALUES (?, ?, ?)',
+                    (dp, path.dirname(dp), mtime)
+                )
+            stack.extend(subdirs)
+        return (listed, found)
+
+
+def main(argv=None):
+    # Avoid circular imports at module level (the resolvers import this module).
+    from loris.resolver import MemoizingResolver
+    from loris.webapp import read_config
+
+    parser = argparse.ArgumentParser(
+        description='Build, or bring up to date, the index of the source '
+                    'images of the Loris resolver.'
+    )
+    parser.add_argument('-c', '--config', default=CONFIG_FILE_DEFAULT,
+        help='Loris configuration file [default: %(default)s]')
+    parser.add_argument('--full', action='store_true',
+        help='list every directory, not just those that have changed')
+    args = parser.parse_args(argv)
+    config = read_config(args.config)
+
+    resolver = import_class(config['resolver']['impl'])(config['resolver'])
+    while isinstance(resolver, MemoizingResolver):
+        resolver = resolver.resolver
+    if getattr(resolver, 'source_index', None) is None:
+        sys.stderr.write('The resolver does not use a source index '
+                         '(see source_index_fp)\n')
+        return 1
+
+    start = time.time()
+    for root in resolver.source_index_roots:
+        listed, found = resolver.source_index.update(root, full=args.full)
+        sys.stderr.write('%s: listed %d directories, with %d files\n' % (
+            root, listed, found))
+    sys.stderr.write('%d files indexed; done in %.1fs\n' % (
+        len(resolver.source_index), time.time() - start))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
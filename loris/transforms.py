@@ -3,14 +3,21 @@
 
 from __future__ import absolute_import
 
+import fcntl
+import io
 import multiprocessing
 from logging import getLogger
 from math import ceil, log
+import os
 from os import path, unlink, devnull
 import platform
 import random
+import select
+import signal
 import string
 import subprocess
+import threading
+import time
 
 try:
     from cStringIO import BytesIO
@@ -18,7 +25,7 @@ except ImportError:  # Python 3
     from io import BytesIO
 
 from PIL import Image
-from PIL.ImageFile import Parser
+from PIL.ImageFile import ImageFile
 from PIL.ImageOps import mirror
 
 # This import is only used for converting embedded color profiles to sRGB,
@@ -31,11 +38,13 @@ except ImportError:
     has_imagecms = False
 
 from loris.loris_exception import ConfigError, TransformException
-from loris.parameters import FULL_MODE
+from loris.parameters import FULL_MODE, RegionParameter
 from loris.utils import mkdir_p
 
 logger = getLogger(__name__)
 
+BATCH_MAX_PIXELS = 64 * 1024 * 1024
+
 
 def _validate_color_profile_conversion_config(config):
     """
@@ -68,13 +77,32 @@ class _AbstractTransformer(object):
     def transform(self, target_fp, image_request, image_info):
         '''
         Args:
-            target_fp (str)
+            target_fp (str): or a file-like object with a ``name`` that
+                ends in the format's extension (see webapp.RenderStream).
             image_request (ImageRequest)
             image_info (ImageInfo)
         '''
         cn = self.__class__.__name__
         raise NotImplementedError('transform() not implemented for %s' % (cn,))
 
+    def transform_batch(self, target_fps, image_requests, image_info):
+        '''
+        Render several requests for the same image, e.g. the tiles a viewer
+        asks for at once. Transformers that can share work between requests
+        override this; by default each request is rendered in turn.
+
+        Args:
+            target_fps ([str]): one for each of the image_requests
+            image_requests ([ImageRequest])
+            image_info (ImageInfo)
+        '''
+        for target_fp, image_request in zip(target_fps, image_requests):
+            self.transform(target_fp, image_request, image_info)
+
+    @property
+    def batch_max_pixels(self):
+        return self.config.get('batch_max_pixels', BATCH_MAX_PIXELS)
+
     @property
     def map_profile_to_srgb(self):
         return self.config.get('map_profile_to_srgb', False)
@@ -92,7 +120,7 @@ class _AbstractTransformer(object):
 
         Args:
             im (PIL.Image)
-            target_fp (str)
+            target_fp (str or file)
             image_request (ImageRequest)
             image_info (ImageInfo)
             rotate (bool):
@@ -223,15 +251,364 @@ class PNG_Transformer(_PillowTransformer):
     pass
 
 
+def _region_rect(region_param):
+    '''(x0, y0, x1, y1) of a RegionParameter, in full resolution pixels.'''
+    return (
+        region_param.pixel_x,
+        region_param.pixel_y,
+        region_param.pixel_x + region_param.pixel_w,
+        region_param.pixel_y + region_param.pixel_h,
+    )
+
+
+def _bounding_rect(rects):
+    x0s, y0s, x1s, y1s = zip(*rects)
+    return (min(x0s), min(y0s), max(x1s), max(y1s))
+
+
+def _adjacent(a, b):
+    '''True if two rects overlap, or share (part of) an edge.'''
+    overlap_w = min(a[2], b[2]) - max(a[0], b[0])
+    overlap_h = min(a[3], b[3]) - max(a[1], b[1])
+    return overlap_w >= 0 and overlap_h >= 0 and (overlap_w > 0 or overlap_h > 0)
+
+
+def _merge_adjacent(jobs):
+    '''
+    Groups (rect, ...) tuples into clusters of overlapping or adjacent
+    rects, returned as [(bounding rect, [jobs])]. The bounding rect of an
+    irregular cluster (an L of tiles, say) includes some area that nothing
+    asked for, but a viewer's tiles normally fill a rectangle.
+    '''
+    clusters = []
+    for job in jobs:
+        rect, members = job[0], [job]
+        merged = True
+        while merged:
+            merged = False
+            for i, (other_rect, other_members) in enumerate(clusters):
+                if _adjacent(rect, other_rect):
+                    del clusters[i]
+                    rect = _bounding_rect((rect, other_rect))
+                    members = other_members + members
+                    merged = True
+                    break
+        clusters.append((rect, members))
+    return clusters
+
+
+# The decoder that this process (a DecoderPool worker) is running, if any.
+_worker_decoder = None
+
+
+def _init_worker():
+    '''
+    Runs in each DecoderPool worker as it starts, so that a worker that is
+    terminated kills its decoder on the way out, rather than leaving it
+    running without a parent.
+    '''
+    def on_sigterm(signum, frame):
+        decoder = _worker_decoder
+        if decoder is not None and decoder.poll() is None:
+            decoder.kill()
+            decoder.wait()
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, on_sigterm)
+
+
+def _kill(proc):
+    try:
+        proc.kill()
+    except OSError:  # (it has just exited)
+        pass
+
+
+def _run_decoder(decoder_cmd, env, timeout=None):
+    '''
+    Run a JP2 decoder to completion.
+
+    This runs inside a :class:`DecoderPool` worker, so it has to be a
+    module-level function. The decoder writes its output to a named pipe
+    that is read by the process that submitted the job.
+
+    Args:
+        decoder_cmd ([str]): argv for kdu_expand or opj_decompress
+        env (dict): environment for the decoder
+        timeout (int): seconds after which the decoder is killed. By then
+            the process that submitted the job has given up on it, and
+            nothing is reading the named pipe.
+
+    Returns:
+        (exit status, stderr)
+    '''
+    global _worker_decoder
+    logger.debug('Calling: %s', ' '.join(decoder_cmd))
+    with open(devnull, 'w') as fnull:
+        decoder_proc = subprocess.Popen(decoder_cmd, bufsize=-1,
+            stdout=fnull, stderr=subprocess.PIPE, env=env)
+    _worker_decoder = decoder_proc
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, _kill, (decoder_proc,))
+        timer.daemon = True
+        timer.start()
+    try:
+        _, stderrdata = decoder_proc.communicate()
+    finally:
+        _worker_decoder = None
+        if timer is not None:
+            timer.cancel()
+    return (decoder_proc.returncode, stderrdata)
+
+
+try:
+    _readonly_buffer = buffer
+except NameError:  # Python 3
+    _readonly_buffer = bytes
+
+# PNM magic number -> PIL mode
+PNM_MODES = {b'P5': 'L', b'P6': 'RGB'}
+
+# Linux lets us grow a pipe's buffer, so that each read gets more data.
+F_SETPIPE_SZ = 1031
+PIPE_SIZE = 1024 * 1024
+
+
+class _FIFOReader(object):
+    '''
+    Reads a PNM image from the named pipe a decoder is writing to.
+
+    The pipe is opened without blocking, and every read waits with
+    ``select()``, so that a decoder that dies before (or while) writing, or
+    one that runs past ``deadline``, raises a TransformException rather than
+    leaving the reader hanging.
+
+    Args:
+        fifo_fp (str): path to the named pipe.
+        deadline (float): time.time() by which the image must be read.
+        check_decoder (callable): called while waiting; should raise if the
+            decoder has exited.
+    '''
+    def __init__(self, fifo_fp, deadline, check_decoder=lambda: None):
+        self.fifo_fp = fifo_fp
+        self.deadline = deadline
+        self.check_decoder = check_decoder
+
+    def _wait(self, f):
+        while True:
+            remaining = self.deadline - time.time()
+            if remaining <= 0:
+                raise TransformException('transform process timed out')
+            readable, _, _ = select.select([f], [], [], min(remaining, 0.1))
+            if readable:
+                return
+            self.check_decoder()
+
+    def _readinto(self, f, view):
+        while True:
+            self._wait(f)
+            n = f.readinto(view)
+            if n is not None:  # None means the select() was spurious
+                return n
+
+    def _read_header(self, f):
+        '''Returns the magic number, width, height and maxval.'''
+        tokens = []
+        byte = bytearray(1)
+        token = b''
+        in_comment = False
+        while len(tokens) < 4:
+            if not self._readinto(f, memoryview(byte)):
+                raise TransformException('Decoder output ended in PNM header')
+            c = bytes(byte)
+            if in_comment:
+                in_comment = c not in b'\r\n'
+            elif c == b'#':
+                in_comment = True
+            elif c.isspace():
+                if token:
+                    tokens.append(token)
+                    token = b''
+            else:
+                token += c
+        # A single whitespace character (already consumed) precedes the data.
+        magic, width, height, maxval = tokens
+        if magic not in PNM_MODES:
+            raise TransformException('Unsupported PNM type: %r' % magic)
+        return (magic, int(width), int(height), int(maxval))
+
+    def read(self):
+        '''Returns a PIL.Image.'''
+        fd = os.open(self.fifo_fp, os.O_RDONLY | os.O_NONBLOCK)
+        with io.open(fd, 'rb', buffering=0) as f:
+            try:
+                fcntl.fcntl(fd, F_SETPIPE_SZ, PIPE_SIZE)
+            except (IOError, OSError):
+                pass
+            magic, width, height, maxval = self._read_header(f)
+            mode = PNM_MODES[magic]
+            sample_bytes = 1 if maxval < 256 else 2
+            buf = bytearray(width * height * len(mode) * sample_bytes)
+            view = memoryview(buf)
+            filled = 0
+            while filled < len(buf):
+                n = self._readinto(f, view[filled:])
+                if not n:
+                    raise TransformException(
+                        'Decoder output ended after %d of %d bytes' %
+                        (filled, len(buf))
+                    )
+                filled += n
+
+        size = (width, height)
+        if sample_bytes == 1:
+            # Pillow maps single-band buffers without copying; RGB has to be
+            # unpacked into its own 4-byte pixels, from a read-only buffer.
+            data = buf if mode == 'L' else _readonly_buffer(buf)
+            return Image.frombuffer(mode, size, data, 'raw', mode, 0, 1)
+        # 16-bit samples: scale them down to 8 bits, treating the
+        # interleaved samples as a single band.
+        im = Image.frombytes('I', (width * len(mode), height), bytes(buf), 'raw', 'I;16B')
+        im = im.point(lambda i: i * (255.0 / maxval)).convert('L')
+        return Image.frombuffer(mode, size, im.tobytes(), 'raw', mode, 0, 1)
+
+
+class DecoderPool(object):
+    '''
+    A pool of long-lived worker processes that JP2 decodes are run in.
+
+    Workers are forked once and then reused, rather than forking a new
+    process for every request. The pool is started lazily, so that it is
+    created in whichever process actually serves requests (e.g. after a
+    pre-forking server has forked). If a job times out, the pool is
+    replaced, and the old one is terminated once its other jobs are done.
+
+    Args:
+        size (int): number of worker processes.
+        timeout (int): seconds to wait for a job before giving up on it.
+        max_jobs_per_worker (int): recycle each worker after this many jobs
+            (None means never).
+    '''
+    def __init__(self, size, timeout, max_jobs_per_worker=None):
+        self.size = size
+        self.timeout = timeout
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self._pool = None
+        self._jobs = []
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        # (called with self._lock held)
+        if self._pool is None or self._pid != os.getpid():
+            logger.debug('Starting decoder pool with %d workers', self.size)
+            self._pool = multiprocessing.Pool(
+                processes=self.size,
+                initializer=_init_worker,
+                maxtasksperchild=self.max_jobs_per_worker
+            )
+            self._jobs = []
+            self._pid = os.getpid()
+        return self._pool
+
+    def submit(self, func, *args):
+        '''Start ``func(*args)`` in a worker. Returns a job to :meth:`wait` on.
+        '''
+        with self._lock:
+            job = self._get_pool().apply_async(func, args)
+            self._jobs = [j for j in self._jobs if not j.ready()]
+            self._jobs.append(job)
+        return job
+
+    def wait(self, job, timeout=None):
+        '''Wait for a job from :meth:`submit` and return its result.
+
+        Raises:
+            TransformException if the job takes longer than ``timeout``
+            (by default, the pool's timeout).
+        '''
+        timeout = self.timeout if timeout is None else timeout
+        try:
+            return job.get(timeout)
+        except multiprocessing.TimeoutError:
+            logger.info('Decoder job timed out after %ss', timeout)
+            self.give_up(job)
+            raise TransformException('transform process timed out')
+
+    def give_up(self, job):
+        '''
+        Stop waiting for ``job``. There's no way to cancel a single job in a
+        multiprocessing pool, so to get its worker back, new jobs go to a
+        new pool, and the old pool is terminated once every other job in it
+        has finished (or had as long as the pool's timeout to do so).
+        '''
+        with self._lock:
+            if not any(j is job for j in self._jobs):
+                return  # (its pool has already been replaced)
+            pool, jobs = self._pool, self._jobs
+            self._pool, self._jobs = None, []
+        others = [j for j in jobs if j is not job]
+        logger.info('Replacing decoder pool; %d other jobs left in it',
+            len(others))
+        retirer = threading.Thread(
+            target=self._retire, args=(pool, others), name='DecoderPool retirer'
+        )
+        retirer.daemon = True
+        retirer.start()
+
+    def _retire(self, pool, jobs):
+        pool.close()
+        deadline = time.time() + self.timeout
+        for job in jobs:
+            job.wait(max(deadline - time.time(), 0))
+        pool.terminate()
+
+    def run(self, func, *args):
+        '''Run ``func(*args)`` in a worker and return the result.
+
+        Raises:
+            TransformException if the job takes longer than ``timeout``.
+        '''
+        return self.wait(self.submit(func, *args))
+
+    def terminate(self):
+        with self._lock:
+            pool = self._pool
+            self._pool, self._jobs = None, []
+        if pool is not None:
+            pool.terminate()
+
+
 class _AbstractJP2Transformer(_AbstractTransformer):
     '''
     Shared methods and configuration for the Kakadu and OpenJPEG transformers.
 
+    Decoding is done in a :class:`DecoderPool`, which can be configured with:
+
+        decoder_pool_size (int): number of workers [default: number of CPUs]
+        decoder_pool_max_jobs (int): recycle a worker after this many decodes
+        timeout (int): seconds a single decode may take [default: 120]
+
+        batch_max_pixels (int): the largest area (at the decoded
+            resolution) that transform_batch() decodes in one go
+            [default: 64 megapixels]
+
     Exits if OSError is raised during init.
     '''
+    # True if every decode is of a whole resolution level anyway, in which
+    # case transform_batch() decodes each level just once.
+    _decodes_whole_levels = False
+
     def __init__(self, config):
-        self.mkfifo = config['mkfifo']
         self.tmp_dp = config['tmp_dp']
+        self.transform_timeout = config.get('timeout', 120)
+        self.decoder_pool = DecoderPool(
+            size=config.get('decoder_pool_size', multiprocessing.cpu_count()),
+            timeout=self.transform_timeout,
+            max_jobs_per_worker=config.get('decoder_pool_max_jobs', None)
+        )
 
         try:
             mkdir_p(self.tmp_dp)
@@ -245,7 +622,7 @@ class _AbstractJP2Transformer(_AbstractTransformer):
 
         super(_AbstractJP2Transformer, self).__init__(config)
 
-    def _make_tmp_fp(self, fmt='bmp'):
+    def _make_tmp_fp(self, fmt='pnm'):
         n = ''.join(random.choice(string.ascii_lowercase) for x in range(5))
         return '%s.%s' % (path.join(self.tmp_dp, n), fmt)
 
@@ -261,20 +638,189 @@ class _AbstractJP2Transformer(_AbstractTransformer):
                     self._scale_dim(full_h,s) >= req_h])
 
     def _scales_to_reduce_arg(self, image_request, image_info):
+        '''The number of resolution levels to discard when decoding.
+
+        This works for any region, by comparing the size of the region (in
+        full resolution pixels) with the requested size: both decoders take
+        the region in full resolution terms and apply the reduction after.
+
+        Returns (str): e.g. '2', or None if the image can't be reduced.
+        '''
         # Scales from JP2 levels, so even though these are from the tiles
         # info.json, it's easier than using the sizes from info.json
         scales = [s for t in image_info.tiles for s in t['scaleFactors']]
-        is_full_region = image_request.region_param(image_info).mode == FULL_MODE
-        arg = None
-        if scales and is_full_region:
-            full_w = image_info.width
-            full_h = image_info.height
-            req_w = image_request.size_param(image_info).w
-            req_h = image_request.size_param(image_info).h
-            closest_scale = self._get_closest_scale(req_w, req_h, full_w, full_h, scales)
-            reduce_arg = int(log(closest_scale, 2))
-            arg = str(reduce_arg)
-        return arg
+        size_param = image_request.size_param(image_info)
+        if not scales or size_param.mode == FULL_MODE:
+            return None
+        region_param = image_request.region_param(image_info)
+        closest_scale = self._get_closest_scale(
+            size_param.w, size_param.h,
+            region_param.pixel_w, region_param.pixel_h,
+            scales
+        )
+        if closest_scale == 1:
+            return None
+        return str(int(log(closest_scale, 2)))
+
+    def _region_to_reduced_box(self, region_param, scale):
+        return self._rect_to_reduced_box(_region_rect(region_param), scale)
+
+    def _rect_to_reduced_box(self, rect, scale):
+        x0, y0, x1, y1 = rect
+        return (x0 // scale, y0 // scale,
+                self._scale_dim(x1, scale), self._scale_dim(y1, scale))
+
+    def _decode_region(self, image_info, region_param, reduce_arg):
+        '''Decode (part of) the image to a PIL.Image.
+
+        Args:
+            image_info (ImageInfo)
+            region_param (RegionParameter): None for the whole image.
+            reduce_arg (str): resolution levels to discard, or None.
+        '''
+        cn = self.__class__.__name__
+        raise NotImplementedError('_decode_region() not implemented for %s' % (cn,))
+
+    def transform(self, target_fp, image_request, image_info):
+        im = self._decode_region(
+            image_info,
+            image_request.region_param(image_info),
+            self._scales_to_reduce_arg(image_request, image_info)
+        )
+        self._derive_decoded(im, target_fp, image_request, image_info)
+
+    def transform_batch(self, target_fps, image_requests, image_info):
+        '''
+        Requests are grouped by the resolution level they are decoded at, and
+        within a level, overlapping or adjacent regions (e.g. neighbouring
+        tiles) are merged. Each merged area is decoded once, and every
+        request in it is cut from that decode. Areas of more than
+        ``batch_max_pixels`` (at the decoded resolution) are split up again.
+        '''
+        levels = {}
+        for target_fp, image_request in zip(target_fps, image_requests):
+            reduce_arg = self._scales_to_reduce_arg(image_request, image_info)
+            region_param = image_request.region_param(image_info)
+            levels.setdefault(reduce_arg, []).append(
+                (_region_rect(region_param), target_fp, image_request)
+            )
+
+        for reduce_arg, jobs in levels.items():
+            scale = 2 ** int(reduce_arg or 0)
+            if self._decodes_whole_levels:
+                full = (0, 0, image_info.width, image_info.height)
+                clusters = [(full, jobs)]
+            else:
+                clusters = self._fit_clusters(_merge_adjacent(jobs), scale)
+            for rect, members in clusters:
+                self._transform_cluster(rect, members, reduce_arg, image_info)
+
+    def _fit_clusters(self, clusters, scale):
+        '''Split clusters until each is no more than batch_max_pixels
+        at the given scale (or holds a single request).'''
+        fitted = []
+        while clusters:
+            rect, members = clusters.pop()
+            x0, y0, x1, y1 = self._rect_to_reduced_box(rect, scale)
+            if len(members) == 1 or (x1 - x0) * (y1 - y0) <= self.batch_max_pixels:
+                fitted.append((rect, members))
+                continue
+            # halve along the longer side
+            axis = 0 if (rect[2] - rect[0]) >= (rect[3] - rect[1]) else 1
+            members = sorted(members, key=lambda m: m[0][axis])
+            half = len(members) // 2
+            for part in (members[:half], members[half:]):
+                clusters.append((_bounding_rect(m[0] for m in part), part))
+        return fitted
+
+    def _transform_cluster(self, rect, members, reduce_arg, image_info):
+        if len(members) == 1:
+            _, target_fp, image_request = members[0]
+            self.transform(target_fp, image_request, image_info)
+            return
+
+        scale = 2 ** int(reduce_arg or 0)
+        if rect == (0, 0, image_info.width, image_info.height):
+            region_param = None
+        else:
+            region_param = RegionParameter('%d,%d,%d,%d' % (
+                rect[0], rect[1], rect[2] - rect[0], rect[3] - rect[1]
+            ), image_info)
+        logger.debug('decoding %r once for %d requests', rect, len(members))
+        im = self._decode_region(image_info, region_param, reduce_arg)
+
+        x0, y0, x1, y1 = self._rect_to_reduced_box(rect, scale)
+        if im.size != (x1 - x0, y1 - y0):
+            # The decoder rounded the region differently from us (this can
+            # happen for regions that aren't aligned to the reduced grid), so
+            # we can't be sure where each request is in the decode.
+            logger.info('decoded %r as %r rather than %r; decoding %d '
+                'requests separately', rect, im.size, (x1 - x0, y1 - y0),
+                len(members))
+            for _, target_fp, image_request in members:
+                self.transform(target_fp, image_request, image_info)
+            return
+
+        for member_rect, target_fp, image_request in members:
+            box = self._rect_to_reduced_box(member_rect, scale)
+            cut = im.crop((box[0] - x0, box[1] - y0, box[2] - x0, box[3] - y0))
+            self._derive_decoded(cut, target_fp, image_request, image_info)
+
+    def _decode(self, decoder_cmd, fifo_fp):
+        '''Run the decoder in the pool and read the PNM it writes to
+        ``fifo_fp`` straight into a buffer that backs the returned image.
+        '''
+        deadline = time.time() + self.transform_timeout
+        os.mkfifo(fifo_fp)
+        try:
+            job = self.decoder_pool.submit(
+                _run_decoder, decoder_cmd, self.env, self.transform_timeout
+            )
+
+            def check_decoder():
+                if job.ready():
+                    returncode = self._log_exit(decoder_cmd, job.get())
+                    raise TransformException(
+                        '%s exited with %d without writing an image' %
+                        (decoder_cmd[0], returncode)
+                    )
+
+            try:
+                im = _FIFOReader(fifo_fp, deadline, check_decoder).read()
+            except TransformException:
+                logger.info('giving up on %s', ' '.join(decoder_cmd))
+                if not job.ready():
+                    self.decoder_pool.give_up(job)
+                raise
+            self._log_exit(decoder_cmd, self.decoder_pool.wait(
+                job, timeout=max(deadline - time.time(), 1)
+            ))
+        finally:
+            unlink(fifo_fp)
+        return im
+
+    def _log_exit(self, decoder_cmd, result):
+        returncode, stderrdata = result
+        if returncode != 0:
+            logger.error('%s exited with %d: %s',
+                decoder_cmd[0], returncode, stderrdata)
+        return returncode
+
+    def _derive_decoded(self, im, target_fp, image_request, image_info):
+        try:
+            if self.map_profile_to_srgb and image_info.color_profile_bytes:
+                emb_profile = BytesIO(image_info.color_profile_bytes)
+                im = self._map_im_profile_to_srgb(im, emb_profile)
+        except PyCMSError as err:
+            logger.warn('Error converting %r to sRGB: %r', im, err)
+
+        self._derive_with_pil(
+            im=im,
+            target_fp=target_fp,
+            image_request=image_request,
+            image_info=image_info,
+            crop=False
+        )
 
 class OPJ_JP2Transformer(_AbstractJP2Transformer):
     def __init__(self, config):
@@ -305,7 +851,7 @@ class OPJ_JP2Transformer(_AbstractJP2Transformer):
         Returns (str): e.g. 'x0,y0,x1,y1'
         '''
         arg = None
-        if region_param.mode != 'full':
+        if region_param is not None and region_param.mode != FULL_MODE:
             x0 = region_param.pixel_x
             y0 = region_param.pixel_y
             x1 = region_param.pixel_x + region_param.pixel_w
@@ -314,67 +860,21 @@ class OPJ_JP2Transformer(_AbstractJP2Transformer):
         logger.debug('opj region parameter: %s', arg)
         return arg
 
-    def transform(self, target_fp, image_request, image_info):
-        # opj writes to this:
+    def _opj_cmd(self, image_info, region_param, reduce_arg, fifo_fp):
+        opj_cmd = [self.opj_decompress, '-i', image_info.src_img_fp]
+        region_arg = self._region_to_opj_arg(region_param)
+        if region_arg:
+            opj_cmd += ['-d', region_arg]
+        if reduce_arg:
+            opj_cmd += ['-r', reduce_arg]
+        opj_cmd += ['-o', fifo_fp]
+        return opj_cmd
+
+    def _decode_region(self, image_info, region_param, reduce_arg):
+        # opj writes to this, as a PGM or PPM depending on the image:
         fifo_fp = self._make_tmp_fp()
-
-        # make the named pipe
-        mkfifo_call = '%s %s' % (self.mkfifo, fifo_fp)
-        logger.debug('Calling %s', mkfifo_call)
-        resp = subprocess.check_call(mkfifo_call, shell=True)
-        if resp != 0:
-            logger.error('Problem with mkfifo')
-        # how to handle CalledProcessError; would have to be a 500?
-
-        # opj_decompress command
-        i = '-i "%s"' % (image_info.src_img_fp,)
-        o = '-o %s' % (fifo_fp,)
-        region_arg = self._region_to_opj_arg(image_request.region_param(image_info))
-        reg = '-d %s' % (region_arg,) if region_arg else ''
-        reduce_arg = self._scales_to_reduce_arg(image_request, image_info)
-        red = '-r %s' % (reduce_arg,) if reduce_arg else ''
-
-        opj_cmd = ' '.join((self.opj_decompress,i,reg,red,o))
-
-        logger.debug('Calling: %s', opj_cmd)
-
-        # Start the shellout. Blocks until the pipe is empty
-        # TODO: If this command hangs, the server never returns.
-        # Surely that can't be right!
-        with open(devnull, 'w') as fnull:
-            opj_decompress_proc = subprocess.Popen(opj_cmd, shell=True, bufsize=-1,
-                stderr=fnull, stdout=fnull, env=self.env)
-
-        with open(fifo_fp, 'rb') as f:
-            # read from the named pipe
-            p = Parser()
-            while True:
-                s = f.read(1024)
-                if not s:
-                    break
-                p.feed(s)
-            im = p.close() # a PIL.Image
-
-        # finish opj
-        opj_exit = opj_decompress_proc.wait()
-        if opj_exit != 0:
-            map(logger.error, opj_decompress_proc.stderr)
-        unlink(fifo_fp)
-
-        try:
-            if self.map_profile_to_srgb and image_info.color_profile_bytes:
-                emb_profile = BytesIO(image_info.color_profile_bytes)
-                im = self._map_im_profile_to_srgb(im, emb_profile)
-        except PyCMSError as err:
-            logger.warn('Error converting %r to sRGB: %r', im, err)
-
-        self._derive_with_pil(
-            im=im,
-            target_fp=target_fp,
-            image_request=image_request,
-            image_info=image_info,
-            crop=False
-        )
+        opj_cmd = self._opj_cmd(image_info, region_param, reduce_arg, fifo_fp)
+        return self._decode(opj_cmd, fifo_fp)
 
 class KakaduJP2Transformer(_AbstractJP2Transformer):
 
@@ -385,7 +885,6 @@ class KakaduJP2Transformer(_AbstractJP2Transformer):
             'LD_LIBRARY_PATH' : config['kdu_libs'],
             'PATH' : config['kdu_expand']
         }
-        self.transform_timeout = config.get('timeout', 120)
         super(KakaduJP2Transformer, self).__init__(config)
 
     @staticmethod
@@ -405,87 +904,145 @@ class KakaduJP2Transformer(_AbstractJP2Transformer):
         Args:
             region_param (params.RegionParam)
 
-        Returns (str): e.g. '\{0.5,0.5\},\{0.5,0.5\}'
+        Returns (str): e.g. '{0.5,0.5},{0.5,0.5}'
         '''
         arg = None
-        if region_param.mode != 'full':
+        if region_param is not None and region_param.mode != FULL_MODE:
             top = region_param.decimal_y
             left = region_param.decimal_x
             height = region_param.decimal_h
             width = region_param.decimal_w
 
-            arg = '\{%s,%s\},\{%s,%s\}' % (top, left, height, width)
+            arg = '{%s,%s},{%s,%s}' % (top, left, height, width)
         logger.debug('kdu region parameter: %s', arg)
         return arg
 
-    def _run_transform(self, target_fp, image_request, image_info, kdu_cmd, fifo_fp):
-        try:
-            # Start the kdu shellout. Blocks until the pipe is empty
-            kdu_expand_proc = subprocess.Popen(kdu_cmd, shell=True, bufsize=-1,
-                stderr=subprocess.PIPE, env=self.env)
-            with open(fifo_fp, 'rb') as f:
-                # read from the named pipe
-                p = Parser()
-                while True:
-                    s = f.read(1024)
-                    if not s:
-                        break
-                    p.feed(s)
-                im = p.close() # a PIL.Image
-        finally:
-            _, stderrdata = kdu_expand_proc.communicate()
-            kdu_exit = kdu_expand_proc.returncode
-            if kdu_exit != 0:
-                map(logger.error, stderrdata)
-            unlink(fifo_fp)
+    def _kdu_cmd(self, image_info, region_param, reduce_arg, fifo_fp):
+        kdu_cmd = [
+            self.kdu_expand, '-quiet',
+            '-i', image_info.src_img_fp,
+            '-num_threads', str(self.num_threads),
+        ]
+        region_arg = self._region_to_kdu_arg(region_param)
+        if region_arg:
+            kdu_cmd += ['-region', region_arg]
+        if reduce_arg:
+            kdu_cmd += ['-reduce', reduce_arg]
+        kdu_cmd += ['-o', fifo_fp]
+        return kdu_cmd
+
+    def _pnm_format(self, image_info):
+        # kdu_expand only writes a PGM for one-component images (and only
+        # the first component of anything else), so it has to be told.
+        qualities = image_info.profile.description['qualities']
+        if 'gray' in qualities and 'color' not in qualities:
+            return 'pgm'
+        return 'ppm'
+
+    def _decode_region(self, image_info, region_param, reduce_arg):
+        fifo_fp = self._make_tmp_fp(self._pnm_format(image_info))
+        kdu_cmd = self._kdu_cmd(image_info, region_param, reduce_arg, fifo_fp)
+        return self._decode(kdu_cmd, fifo_fp)
+
+class PillowJP2Transformer(_AbstractJP2Transformer):
+    '''
+    Decodes JP2s inside the Python process, using Pillow's OpenJPEG plugin,
+    so there are no decoder processes, named pipes or BMP round trips.
 
-        try:
-            if self.map_profile_to_srgb and image_info.color_profile_bytes:
-                emb_profile = BytesIO(image_info.color_profile_bytes)
-                im = self._map_im_profile_to_srgb(im, emb_profile)
-        except PyCMSError as err:
-            logger.warn('Error converting %r to sRGB: %r', im, err)
+    Pillow can discard resolution levels (``Image.reduce``) but cannot
+    decode a sub-area of the codestream, so a region is cut from the whole
+    image after it has been decoded at the chosen resolution. That makes it
+    fastest for thumbnails and reduced sizes, and slowest for small regions
+    of very large images; see misc/jp2_transformer_benchmark.py.
 
-        self._derive_with_pil(
-            im=im,
-            target_fp=target_fp,
-            image_request=image_request,
-            image_info=image_info,
-            crop=False
-        )
+    Pillow must be built with OpenJPEG (2.0 or later) support.
+    '''
+    _decodes_whole_levels = True
 
-    def transform(self, target_fp, image_request, image_info):
-        fifo_fp = self._make_tmp_fp()
-        mkfifo_call = '%s %s' % (self.mkfifo, fifo_fp)
-        subprocess.check_call(mkfifo_call, shell=True)
-
-        # kdu command
-        q = '-quiet'
-        t = '-num_threads %s' % self.num_threads
-        i = '-i "%s"' % image_info.src_img_fp
-        o = '-o %s' % fifo_fp
-        reduce_arg = self._scales_to_reduce_arg(image_request, image_info)
-        red = '-reduce %s' % (reduce_arg,) if reduce_arg else ''
-        region_arg = self._region_to_kdu_arg(image_request.region_param(image_info))
-        reg = '-region %s' % (region_arg,) if region_arg else ''
-        kdu_cmd = ' '.join((self.kdu_expand,q,i,t,reg,red,o))
-
-        process = multiprocessing.Process(
-            target=self._run_transform,
-            kwargs={
-                'target_fp': target_fp,
-                'image_request': image_request,
-                'image_info': image_info,
-                'kdu_cmd': kdu_cmd,
-                'fifo_fp': fifo_fp
-            }
-        )
-        process.start()
-        process.join(self.transform_timeout)
-        if process.is_alive():
-            logger.info('terminating process for %s, %s',
-                image_info.src_img_fp, target_fp)
-            process.terminate()
-            if path.exists(fifo_fp):
-                unlink(fifo_fp)
-            raise TransformException('transform process timed out')
+    def __init__(self, config):
+        # None of the decoder pool or temporary directory setup in
+        # _AbstractJP2Transformer applies here.
+        _AbstractTransformer.__init__(self, config)
+
+    def _load_reduced(self, im, reduce_level):
+        # Pillow 4.3 rounds the reduced dimensions to the nearest pixel, but
+        # OpenJPEG rounds them up, so some levels fail to decode with "broken
+        # data stream". Size the decoder tile ourselves and load it directly.
+        scale = 2 ** reduce_level
+        size = (self._scale_dim(im.size[0], scale),
+                self._scale_dim(im.size[1], scale))
+        decoder, _, offset, args = im.tile[0]
+        args = (args[0], reduce_level, im.layers, args[3], args[4])
+        im.tile = [(decoder, (0, 0) + size, offset, args)]
+        im.size = size
+        ImageFile.load(im)
+
+    def _decode_region(self, image_info, region_param, reduce_arg):
+        reduce_level = int(reduce_arg) if reduce_arg else 0
+        with open(image_info.src_img_fp, 'rb') as f:
+            im = Image.open(f)
+            self._load_reduced(im, reduce_level)
+
+        if region_param is not None and region_param.mode != FULL_MODE:
+            box = self._region_to_reduced_box(region_param, 2 ** reduce_level)
+            logger.debug('cropping reduced image to: %r', box)
+            im = im.crop(box)
+        return im
+
+
+class _Batch(object):
+    def __init__(self):
+        self.target_fps = []
+        self.image_requests = []
+        self.done = threading.Event()
+        self.failed = False
+
+
+class TransformBatcher(object):
+    '''
+    Collects the transform() calls that different threads make for the same
+    source image within ``window`` seconds of each other, and runs them as
+    one transform_batch(). When a viewer asks for a screenful of tiles at
+    once, those that arrive together share their decodes.
+
+    The first call for an image waits out the window and then renders the
+    whole batch; later calls wait for it. If the batch fails, each request
+    is retried on its own, so it gets its own result (or exception).
+    '''
+    def __init__(self, window):
+        self.window = window
+        self._batches = {}
+        self._lock = threading.Lock()
+
+    def transform(self, transformer, target_fp, image_request, image_info):
+        key = (id(transformer), image_info.src_img_fp)
+        with self._lock:
+            batch = self._batches.get(key)
+            leader = batch is None
+            if leader:
+                batch = self._batches[key] = _Batch()
+            batch.target_fps.append(target_fp)
+            batch.image_requests.append(image_request)
+
+        if leader:
+            time.sleep(self.window)
+            with self._lock:
+                del self._batches[key]
+            try:
+                if len(batch.image_requests) > 1:
+                    logger.debug('rendering %d requests for %s together',
+                        len(batch.image_requests), image_info.src_img_fp)
+                transformer.transform_batch(
+                    batch.target_fps, batch.image_requests, image_info
+                )
+            except Exception as e:
+                logger.warn('batch of %d requests for %s failed: %r',
+                    len(batch.image_requests), image_info.src_img_fp, e)
+                batch.failed = True
+            finally:
+                batch.done.set()
+        else:
+            batch.done.wait()
+
+        if batch.failed:
+            transformer.transform(target_fp, image_request, image_info)
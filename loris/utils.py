@@ -2,15 +2,23 @@
 
 from __future__ import absolute_import
 
+from contextlib import contextmanager
 import errno
+import fcntl
+import hashlib
 import logging
 import os
 import shutil
+import threading
 import uuid
 
 
 logger = logging.getLogger(__name__)
 
+# Lock files are striped: each key hashes onto one of this many files,
+# which keeps the number of files in a lock directory bounded.
+LOCK_FILE_STRIPES = 1024
+
 
 def mkdir_p(path):
     """Create a directory if it doesn't already exist."""
@@ -23,6 +31,14 @@ def mkdir_p(path):
             raise
 
 
+def import_class(qname):
+    """Import and return the class named by ``qname``, e.g.
+    'loris.resolver.SimpleFSResolver'."""
+    module_name, class_name = qname.rsplit('.', 1)
+    module = __import__(module_name, fromlist=[class_name])
+    return getattr(module, class_name)
+
+
 def symlink(src, dst):
     """Create a symlink from ``src`` to ``dst``.
 
@@ -87,3 +103,66 @@ def safe_rename(src, dst):
             os.unlink(src)
         else:
             raise
+
+
+class KeyedLock(object):
+    """A set of in-process locks, one per key.
+
+    Locks are created on demand and discarded once nobody holds or waits
+    for them, so the set only ever contains keys that are currently busy.
+
+    """
+    def __init__(self):
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def lock(self, key):
+        with self._lock:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [threading.Lock(), 0]
+            entry[1] += 1
+
+        entry[0].acquire()
+        try:
+            yield
+        finally:
+            entry[0].release()
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[key]
+
+    def __len__(self):
+        return len(self._locks)
+
+
+def lock_file_path(dp, key):
+    """The lock file in ``dp`` that ``key`` hashes onto."""
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    digest = hashlib.sha1(key).hexdigest()
+    stripe = int(digest, 16) % LOCK_FILE_STRIPES
+    return os.path.join(dp, '%04d.lock' % stripe)
+
+
+@contextmanager
+def lock_file(path):
+    """Hold an exclusive ``flock()`` on ``path`` for the duration of the
+    block, creating the file (and any intermediate directories) if needed.
+
+    This gives mutual exclusion between processes; it offers none between
+    threads of the same process, so pair it with a :class:`KeyedLock`.
+
+    """
+    mkdir_p(os.path.dirname(path))
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
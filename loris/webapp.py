@@ -7,8 +7,11 @@ Implements IIIF 2.0 <http://iiif.io/api/image/2.0/> level 2
 '''
 from __future__ import absolute_import
 
+from collections import deque
 from datetime import datetime
 from decimal import getcontext
+import errno
+from functools import partial
 import logging
 from logging.handlers import RotatingFileHandler
 import os
@@ -16,23 +19,24 @@ from os import path, unlink
 import re
 from subprocess import CalledProcessError
 from tempfile import NamedTemporaryFile
+import threading
 try:
-    from urllib.parse import unquote, quote_plus
+    from urllib.parse import quote, unquote, quote_plus
 except ImportError:  # Python 2
-    from urllib import unquote, quote_plus
+    from urllib import quote, unquote, quote_plus
 
 import sys
 sys.path.append('.')
 
 from configobj import ConfigObj
-from werkzeug.http import parse_date, http_date
 
 from werkzeug.wrappers import (
     Request, Response, BaseResponse, CommonResponseDescriptorsMixin
 )
+from werkzeug.wsgi import wrap_file
 
 from loris import constants, img, transforms
-from loris.img_info import InfoCache
+from loris.img_info import InfoCache, iiif_json
 from loris.loris_exception import (
     ConfigError,
     ImageInfoException,
@@ -46,6 +50,18 @@ from loris.loris_exception import (
 
 getcontext().prec = 25 # Decimal precision. This should be plenty.
 
+# How cached images are sent (see the send_file option):
+#   python: werkzeug reads the file and writes it out
+#   wsgi: handed to the server's wsgi.file_wrapper (which may use sendfile())
+#   x-sendfile: an X-Sendfile header, for Apache's mod_xsendfile (or lighttpd)
+#   x-accel-redirect: an X-Accel-Redirect header, for nginx
+SEND_FILE_MODES = ('python', 'wsgi', 'x-sendfile', 'x-accel-redirect')
+
+# Formats that Pillow encodes front to back, without seeking back to fill
+# anything in, so they can be sent while they are being encoded (see the
+# stream_renders option).
+STREAMABLE_FORMATS = ('jpg', 'png', 'gif', 'webp')
+
 
 def get_debug_config(debug_jp2_transformer):
     # change a few things, read the config and set up logging
@@ -81,6 +97,8 @@ def get_debug_config(debug_jp2_transformer):
         config['transforms']['jp2']['kdu_expand'] = path.join(project_dp, kdu_expand)
         libkdu_dir = KakaduJP2Transformer.local_libkdu_dir()
         config['transforms']['jp2']['kdu_libs'] = path.join(project_dp, libkdu_dir)
+    elif debug_jp2_transformer == 'pillow':
+        config['transforms']['jp2']['impl'] = 'PillowJP2Transformer'
     else:
         raise ConfigError('Unrecognized debug JP2 transformer: %r' % debug_jp2_transformer)
 
@@ -221,6 +239,91 @@ class LorisResponse(BaseResponse, CommonResponseDescriptorsMixin):
         self.headers['Access-Control-Allow-Headers'] = "Authorization"
 
 
+class RenderStream(object):
+    '''A file-like target for a transformer that writes everything it is
+    given to ``temp_fp``, and also queues it to be sent as the body of a
+    response, so the response can start before the image is finished.
+
+    The transformer writes from one thread while the response iterates over
+    the stream in another. The renderer ends with finish(), or fail() (which
+    removes the temporary file) if it couldn't render the image.
+    '''
+    def __init__(self, temp_fp):
+        # Pillow works out the format from the name
+        self.name = temp_fp
+        self._f = open(temp_fp, 'wb')
+        self._written = 0
+        self._chunks = deque()
+        self._cond = threading.Condition()
+        self._done = False
+        self._error = None
+
+    def write(self, data):
+        self._f.write(data)
+        self._written += len(data)
+        self.send(bytes(data))
+
+    def tell(self):
+        return self._written
+
+    def flush(self):
+        self._f.flush()
+
+    def send(self, data):
+        '''Queues ``data`` for the response, without writing it to the file.'''
+        with self._cond:
+            self._chunks.append(data)
+            self._cond.notify_all()
+
+    def close_file(self):
+        if not self._f.closed:
+            self._f.close()
+
+    def discard_file(self):
+        self.close_file()
+        if path.exists(self.name):
+            unlink(self.name)
+
+    def finish(self):
+        self.close_file()
+        with self._cond:
+            self._done = True
+            self._cond.notify_all()
+
+    def fail(self, error):
+        self.discard_file()
+        with self._cond:
+            self._error = error
+            self._done = True
+            self._cond.notify_all()
+
+    def wait(self):
+        '''Blocks until there is something to send, or the render is over.
+        Raises the renderer's exception if it failed before then.
+        '''
+        with self._cond:
+            while not (self._chunks or self._done):
+                self._cond.wait()
+            if self._error is not None:
+                raise self._error
+
+    def __iter__(self):
+        while True:
+            with self._cond:
+                while not (self._chunks or self._done):
+                    self._cond.wait()
+                if self._chunks:
+                    data = b''.join(self._chunks)
+                    self._chunks.clear()
+                elif self._error is not None:
+                    # Too late for an error response; the server should
+                    # drop the connection rather than end the body cleanly.
+                    raise self._error
+                else:
+                    return
+            yield data
+
+
 class BadRequestResponse(LorisResponse):
     def __init__(self, message=None):
         if message is None:
@@ -346,16 +449,39 @@ class Loris(object):
         self.authorizer = self._load_authorizer()
         self.max_size_above_full = _loris_config.get('max_size_above_full', 200)
 
+        self.send_file = _loris_config.get('send_file', 'python')
+        if self.send_file not in SEND_FILE_MODES:
+            raise ConfigError(
+                'loris.Loris.send_file=%r, expected one of %s' %
+                (self.send_file, '/'.join(SEND_FILE_MODES))
+            )
+        self.x_accel_redirect_prefix = _loris_config.get(
+            'x_accel_redirect_prefix', '/loris-cache/'
+        )
+        self.stream_renders = _loris_config.get('stream_renders', False)
+
+        # Tile requests for the same JP2 that arrive within this many seconds
+        # of each other are rendered together (see transforms.TransformBatcher).
+        batch_window = _loris_config.get('transform_batch_window', 0)
+        self.transform_batcher = None
+        if batch_window:
+            self.transform_batcher = transforms.TransformBatcher(batch_window)
+
+        self.memory_cache = None
         if self.enable_caching:
-            self.info_cache = InfoCache(self.app_configs['img_info.InfoCache']['cache_dp'])
-            cache_dp = self.app_configs['img.ImageCache']['cache_dp']
-            self.img_cache = img.ImageCache(cache_dp)
+            self.memory_cache = img.MemoryImageCache.from_config(
+                self.app_configs['img.ImageCache']
+            )
+            self.info_cache = InfoCache.from_config(self.app_configs['img_info.InfoCache'])
+            self.img_cache = img.ImageCache.from_config(
+                self.app_configs['img.ImageCache']
+            )
 
     def _load_transformers(self):
         tforms = self.app_configs['transforms']
         source_formats = [k for k in tforms if isinstance(tforms[k], dict)]
         self.logger.debug('Source formats: %r', source_formats)
-        global_tranform_options = dict((k, v) for k, v in tforms.iteritems() if not isinstance(v, dict))
+        global_tranform_options = dict((k, v) for k, v in tforms.items() if not isinstance(v, dict))
         self.logger.debug('Global transform options: %r', global_tranform_options)
 
         transformers = {}
@@ -485,33 +611,44 @@ class Loris(object):
             msg = '%s \n(This is likely a permissions problem)' % e
             return ServerSideErrorResponse(msg)
 
+        if self.enable_caching:
+            data, etag = self.info_cache.get_iiif_json(request, info)
+        else:
+            data, etag = iiif_json(info)
+
         r = LorisResponse()
         r.set_acao(request, self.cors_regex)
-        ims_hdr = request.headers.get('If-Modified-Since')
-        ims = parse_date(ims_hdr)
-        last_mod = parse_date(http_date(last_mod)) # see note under get_img
+        # see note under get_img (with no cache, it's "now", as ever)
+        last_mod = (last_mod or datetime.utcnow()).replace(microsecond=0)
+        callback = request.args.get('callback', None)
+        conditional = True
 
         if self.authorizer and self.authorizer.is_protected(info):
             authed = self.authorizer.is_authorized(info, request)
             if authed['status'] == 'deny':
                 r.status_code = 401
-                # trash If-Mod-Since to ensure no 304
-                ims = None
+                # ignore If-Mod-Since and If-None-Match to ensure no 304
+                conditional = False
             elif authed['status'] == 'redirect':
                 r.status_code = 302
                 r.location = authed['location']
             # Otherwise we're okay
 
-        if ims and ims >= last_mod:
+        # (JSONP responses aren't the JSON the ETag is for)
+        not_modified = conditional and self._not_modified(
+            request, last_mod, etag if not callback else None
+        )
+        if not_modified:
             self.logger.debug('Sent 304 for %s ', ident)
             r.status_code = 304
+            if not callback:
+                r.headers['ETag'] = etag
         else:
             if last_mod:
                 r.last_modified = last_mod
-            callback = request.args.get('callback', None)
             if callback:
                 r.mimetype = 'application/javascript'
-                r.data = '%s(%s);' % (callback, info.to_iiif_json())
+                r.data = '%s(%s);' % (callback, data.decode('utf-8'))
             else:
                 if request.headers.get('accept') == 'application/ld+json':
                     r.content_type = 'application/ld+json'
@@ -519,22 +656,23 @@ class Loris(object):
                     r.content_type = 'application/json'
                     l = '<http://iiif.io/api/image/2/context.json>;rel="http://www.w3.org/ns/json-ld#context";type="application/ld+json"'
                     r.headers['Link'] = '%s,%s' % (r.headers['Link'], l)
-                r.data = info.to_iiif_json()
+                r.headers['ETag'] = etag
+                r.data = data
         return r
 
-    def _get_info(self,ident,request,base_uri):
-        if self.enable_caching:
-            in_cache = request in self.info_cache
+    def _get_info(self,ident,request,base_uri,fresh=False):
+        if self.enable_caching and not fresh:
+            cached = self.info_cache.get(request)
         else:
-            in_cache = False
+            cached = None
 
         #Checking for src_format in ImageInfo signals that it's not old cache data:
         #   src_format didn't used to be in the Info cache, but now it is.
         #   If we don't see src_format, that means it's old cache data, so just
         #   ignore it and cache new ImageInfo.
         #   TODO: remove src_format check in Loris 4.0.
-        if in_cache and self.info_cache[request][0].src_format:
-            return self.info_cache[request]
+        if cached and cached[0].src_format:
+            return cached
         else:
 
             info = self.resolver.resolve(self, ident, base_uri)
@@ -590,10 +728,12 @@ class Loris(object):
 
         self.logger.debug('Image Request Path: %s', image_request.request_path)
 
+        in_memory = cached = stream = None
         if self.enable_caching:
-            in_cache = image_request in self.img_cache
-        else:
-            in_cache = False
+            if self.memory_cache is not None:
+                in_memory = self.memory_cache.get(image_request)
+            if in_memory is None:
+                cached = self.img_cache.get_entry(image_request)
 
         try:
             # We need the info to check authorization,
@@ -610,37 +750,41 @@ class Loris(object):
                 r.status_code = 401
                 return r
 
-        if in_cache:
-            fp, img_last_mod = self.img_cache[image_request]
-            ims_hdr = request.headers.get('If-Modified-Since')
-            # The stamp from the FS needs to be rounded using the same precision
-            # as when went sent it, so for an accurate comparison turn it into
-            # an http date and then parse it again :-( :
-            img_last_mod = parse_date(http_date(img_last_mod))
-            self.logger.debug("Time from FS (default, rounded): %s", img_last_mod)
-            self.logger.debug("Time from IMS Header (parsed): %s", parse_date(ims_hdr))
-            # ims_hdr = parse_date(ims_hdr) # catch parsing errors?
-            if ims_hdr and parse_date(ims_hdr) >= img_last_mod:
-                self.logger.debug('Sent 304 for %s ', fp)
+        if in_memory or cached:
+            entry = in_memory or cached
+            # HTTP dates are to the second, so for an accurate comparison
+            # the stamp from the FS needs to be rounded the same way.
+            img_last_mod = entry.last_mod.replace(microsecond=0)
+            if entry.etag:
+                r.headers['ETag'] = entry.etag
+            if self._not_modified(request, img_last_mod, entry.etag):
+                self.logger.debug('Sent 304 for %s ', image_request.request_path)
                 r.status_code = 304
                 return r
+            elif in_memory:
+                self.logger.debug('Sent %s from memory', image_request.request_path)
+                r.content_type = in_memory.content_type
+                r.status_code = 200
+                r.last_modified = img_last_mod
+                r.headers['Content-Length'] = len(in_memory.data)
+                r.response = [in_memory.data]
             else:
-                r.content_type = constants.FORMATS_BY_EXTENSION[target_fmt]
+                if not self._send_cached(request, r, image_request, cached):
+                    # The index was out of date; render it again.
+                    self.img_cache.discard(image_request)
+                    return self.get_img(request, ident, region, size, rotation,
+                                        quality, target_fmt, base_uri)
+                r.content_type = cached.content_type
                 r.status_code = 200
                 r.last_modified = img_last_mod
-                r.headers['Content-Length'] = path.getsize(fp)
-                r.response = open(fp, 'rb')
-
-                # hand the Image object its info
-                info = self._get_info(ident, request, base_uri)[0]
 
-                self._set_canonical_link(
-                    request=request,
-                    response=r,
-                    image_request=image_request,
-                    image_info=info
-                )
-                return r
+            self._set_canonical_link(
+                request=request,
+                response=r,
+                image_request=image_request,
+                image_info=info
+            )
+            return r
         else:
             try:
                 # 1. Get the info
@@ -666,10 +810,21 @@ class Loris(object):
                         return r
 
                 # 5. Make an image
-                fp = self._make_image(
-                    image_request=image_request,
-                    image_info=info
-                )
+                try:
+                    self.resolver.fetch_source(info)
+                except ResolverException:
+                    # The info may have outlived the resolver's copy of the
+                    # source (e.g. the cache cleaner has removed it), so
+                    # resolve it again, once.
+                    info = self._get_info(ident, request, base_uri, fresh=True)[0]
+                    self.resolver.fetch_source(info)
+                if self._can_stream(image_request):
+                    stream = self._stream_image(image_request, info)
+                else:
+                    fp = self._make_image(
+                        image_request=image_request,
+                        image_info=info
+                    )
 
             except ResolverException as re:
                 return NotFoundResponse(str(re))
@@ -694,24 +849,101 @@ possible that there was a problem with the source file
                 return ServerSideErrorResponse(msg)
         r.content_type = constants.FORMATS_BY_EXTENSION[target_fmt]
         r.status_code = 200
-        r.last_modified = datetime.utcfromtimestamp(path.getctime(fp))
-        r.headers['Content-Length'] = path.getsize(fp)
         self._set_canonical_link(
             request=request,
             response=r,
             image_request=image_request,
             image_info=info
         )
-        r.response = open(fp, 'rb')
 
-        if not self.enable_caching:
-            r.call_on_close(lambda: unlink(fp))
+        if stream is not None:
+            # The length, modification time and ETag aren't known until the
+            # image is in the cache, so this response goes without them.
+            self.logger.debug('Streaming %s', image_request.request_path)
+            r.response = stream
+            return r
+
+        # (as it will be found in the cache from now on)
+        entry = self.img_cache.get_entry(image_request) if self.enable_caching else None
+        if entry is not None and self._send_cached(request, r, image_request, entry):
+            r.last_modified = entry.last_mod
+            r.headers['ETag'] = entry.etag
+        else:
+            r.last_modified = datetime.utcfromtimestamp(path.getctime(fp))
+            r.headers['Content-Length'] = path.getsize(fp)
+            r.response = open(fp, 'rb')
+            if not self.enable_caching:
+                r.call_on_close(lambda: unlink(fp))
 
         return r
 
+    @staticmethod
+    def _not_modified(request, last_mod, etag):
+        """Whether the conditional headers of ``request`` (if any) match an
+        image last modified at ``last_mod`` (to the second) with ``etag``.
+        If-None-Match takes precedence over If-Modified-Since.
+        """
+        if request.if_none_match and etag:
+            return request.if_none_match.contains_weak(etag.strip('"'))
+        ims = request.if_modified_since
+        return ims is not None and ims >= last_mod
+
+    def _send_cached(self, request, response, image_request, entry):
+        """Sets the body of ``response`` to the cached image ``entry``.
+
+        Images small enough for the memory cache are read and added to it.
+        Anything else is sent as ``send_file`` says; for the x-sendfile and
+        x-accel-redirect modes, the file isn't even opened, and the response
+        has no body of its own.
+
+        Returns:
+            False if the file has gone.
+        """
+        to_memory = (self.memory_cache is not None and
+                     self.memory_cache.will_hold(entry.size))
+
+        if not to_memory and self.send_file == 'x-sendfile':
+            response.headers['X-Sendfile'] = path.abspath(entry.fp)
+            response.automatically_set_content_length = False
+            return True
+        if not to_memory and self.send_file == 'x-accel-redirect':
+            rel_fp = entry.rel_fp
+            if not isinstance(rel_fp, bytes):
+                rel_fp = rel_fp.encode('utf-8')
+            response.headers['X-Accel-Redirect'] = (
+                self.x_accel_redirect_prefix + quote(rel_fp)
+            )
+            response.automatically_set_content_length = False
+            return True
+
+        try:
+            f = open(entry.fp, 'rb')
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        response.headers['Content-Length'] = entry.size
+        if to_memory:
+            with f:
+                data = f.read()
+            self.memory_cache.put(
+                image_request, data, entry.last_mod, entry.content_type, entry.etag
+            )
+            response.response = [data]
+        elif self.send_file == 'wsgi':
+            response.response = wrap_file(request.environ, f)
+            response.direct_passthrough = True
+        else:
+            response.response = f
+        return True
+
     def _make_image(self, image_request, image_info):
         """Call the appropriate transformer to create the image.
 
+        When caching is enabled, concurrent requests for the same derivative
+        are collapsed: only the first one runs the transformer, and the rest
+        wait for it and then pick its output up from the cache.
+
         Args:
             image_request (ImageRequest)
             image_info (ImageInfo)
@@ -719,35 +951,177 @@ possible that there was a problem with the source file
             (str) the file path of the new image
 
         """
+        if not self.enable_caching:
+            return self._render_image(image_request, image_info)
+
+        with self.img_cache.render_lock(image_request, image_info):
+            canonical_fp = self.img_cache.get_canonical_cache_path(
+                image_request=image_request,
+                image_info=image_info
+            )
+            if path.exists(canonical_fp):
+                self.logger.debug('%s was rendered while we waited', canonical_fp)
+                self.img_cache.store(
+                    image_request=image_request,
+                    image_info=image_info,
+                    canonical_fp=canonical_fp
+                )
+                return canonical_fp
+            return self._render_image(image_request, image_info)
+
+    def _can_stream(self, image_request):
+        return (self.stream_renders and self.enable_caching and
+                image_request.format in STREAMABLE_FORMATS)
+
+    def _stream_image(self, image_request, image_info):
+        """Renders the image into the cache in another thread, while the
+        encoded image is also sent as it is produced.
+
+        The transformer writes to a temporary file, exactly as _make_image
+        would, and it is only moved into the cache once it is complete. The
+        render carries on if the client goes away, so the cache still gets
+        the image.
+
+        Args:
+            image_request (ImageRequest)
+            image_info (ImageInfo)
+        Returns:
+            (RenderStream) for the body of the response, once there is
+            something to send; if the render fails before then, its
+            exception is raised here instead.
+        """
+        stream = RenderStream(self._make_temp_fp(image_request))
+        renderer = threading.Thread(
+            target=self._render_to_stream,
+            args=(image_request, image_info, stream)
+        )
+        renderer.daemon = True
+        renderer.start()
+        stream.wait()
+        return stream
+
+    def _render_to_stream(self, image_request, image_info, stream):
+        try:
+            with self.img_cache.render_lock(image_request, image_info):
+                canonical_fp = self.img_cache.get_canonical_cache_path(
+                    image_request=image_request,
+                    image_info=image_info
+                )
+                if path.exists(canonical_fp):
+                    self.logger.debug('%s was rendered while we waited', canonical_fp)
+                    stream.discard_file()
+                    self.img_cache.store(
+                        image_request=image_request,
+                        image_info=image_info,
+                        canonical_fp=canonical_fp
+                    )
+                    with open(canonical_fp, 'rb') as f:
+                        for data in iter(partial(f.read, 65536), b''):
+                            stream.send(data)
+                else:
+                    # (not batched: a failed batch is rendered again, which
+                    # would send the client a second copy)
+                    self.transformers[image_info.src_format].transform(
+                        target_fp=stream,
+                        image_request=image_request,
+                        image_info=image_info
+                    )
+                    stream.close_file()
+                    self._cache_image(image_request, image_info, stream.name)
+        except Exception as e:
+            self.logger.error('Rendering %s failed: %r', image_request.request_path, e)
+            stream.fail(e)
+        else:
+            stream.finish()
+
+    def _make_images(self, image_requests, image_info):
+        """Render several images of the same source into the cache at once,
+        so that the transformer can share work between them (see
+        transform_batch()). Images already in the cache are left as they are.
+
+        Unlike _make_image, this doesn't hold render locks while rendering
+        (several at once could deadlock against another batch); each image
+        is only checked for, and moved into the cache, under its lock.
+
+        Args:
+            image_requests ([ImageRequest])
+            image_info (ImageInfo)
+        Returns:
+            ([str]) the file paths of the images, in the cache
+
+        """
+        todo = [
+            r for r in image_requests
+            if not path.exists(self.img_cache.get_canonical_cache_path(
+                image_request=r,
+                image_info=image_info
+            ))
+        ]
+        if todo:
+            self.resolver.fetch_source(image_info)
+        temp_fps = [self._make_temp_fp(r) for r in todo]
+        transformer = self.transformers[image_info.src_format]
+        try:
+            transformer.transform_batch(temp_fps, todo, image_info)
+        except Exception:
+            for temp_fp in temp_fps:
+                if path.exists(temp_fp):
+                    unlink(temp_fp)
+            raise
+
+        for image_request, temp_fp in zip(todo, temp_fps):
+            with self.img_cache.render_lock(image_request, image_info):
+                self._cache_image(image_request, image_info, temp_fp)
+        return [
+            self.img_cache.get_canonical_cache_path(
+                image_request=r,
+                image_info=image_info
+            )
+            for r in image_requests
+        ]
+
+    def _make_temp_fp(self, image_request):
         temp_file = NamedTemporaryFile(
             dir=self.tmp_dp,
             suffix='.%s' % image_request.format,
             delete=False
         )
-        temp_fp = temp_file.name
+        temp_file.close()
+        return temp_file.name
 
-        transformer = self.transformers[image_info.src_format]
-        transformer.transform(
-            target_fp=temp_fp,
-            image_request=image_request,
-            image_info=image_info
-        )
+    def _render_image(self, image_request, image_info):
+        temp_fp = self._make_temp_fp(image_request)
 
-        if self.enable_caching:
-            temp_fp = self.img_cache.upsert(
-                image_request=image_request,
-                temp_fp=temp_fp,
-                image_info=image_info
+        transformer = self.transformers[image_info.src_format]
+        if self.transform_batcher and image_info.src_format == 'jp2':
+            self.transform_batcher.transform(
+                transformer, temp_fp, image_request, image_info
             )
-            # TODO: not sure how the non-canonical use case works
-            self.img_cache.store(
+        else:
+            transformer.transform(
+                target_fp=temp_fp,
                 image_request=image_request,
-                image_info=image_info,
-                canonical_fp=temp_fp
+                image_info=image_info
             )
 
+        if self.enable_caching:
+            temp_fp = self._cache_image(image_request, image_info, temp_fp)
+
         return temp_fp
 
+    def _cache_image(self, image_request, image_info, temp_fp):
+        cache_fp = self.img_cache.upsert(
+            image_request=image_request,
+            temp_fp=temp_fp,
+            image_info=image_info
+        )
+        # TODO: not sure how the non-canonical use case works
+        self.img_cache.store(
+            image_request=image_request,
+            image_info=image_info,
+            canonical_fp=cache_fp
+        )
+        return cache_fp
 
 if __name__ == '__main__':
     from werkzeug.serving import run_simple
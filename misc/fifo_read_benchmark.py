@@ -0,0 +1,94 @@
+# Compares the throughput of the two ways JP2 transformers have read a
+# decoder's output from a named pipe:
+#
+#   old: a BMP, read in 1KB chunks and fed to PIL.ImageFile.Parser
+#   new: a PNM, read with readinto() into a preallocated buffer
+#        (loris.transforms._FIFOReader)
+#
+# A child process stands in for the decoder, writing a synthetic image of the
+# given size, so this measures only the transfer into a PIL.Image. Run from
+# the root of the repository:
+#
+#   python misc/fifo_read_benchmark.py [width] [height] [L|RGB] [runs]
+from __future__ import print_function
+
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from PIL import Image
+from PIL.ImageFile import Parser
+
+from loris.transforms import _FIFOReader
+
+WIDTH = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+HEIGHT = int(sys.argv[2]) if len(sys.argv) > 2 else 6000
+MODE = sys.argv[3] if len(sys.argv) > 3 else 'RGB'
+RUNS = int(sys.argv[4]) if len(sys.argv) > 4 else 3
+
+
+def encoded(fmt):
+    im = Image.linear_gradient('L').resize((WIDTH, HEIGHT)).convert(MODE)
+    path = os.path.join(tempfile.gettempdir(), 'fifo_benchmark.%s' % fmt)
+    im.save(path, format=fmt)
+    with open(path, 'rb') as f:
+        data = f.read()
+    os.unlink(path)
+    return data
+
+
+def write(fifo_fp, data):
+    with open(fifo_fp, 'wb') as f:
+        f.write(data)
+
+
+def read_old(fifo_fp):
+    with open(fifo_fp, 'rb') as f:
+        p = Parser()
+        while True:
+            s = f.read(1024)
+            if not s:
+                break
+            p.feed(s)
+        return p.close()
+
+
+def read_new(fifo_fp):
+    return _FIFOReader(fifo_fp, time.time() + 600).read()
+
+
+def time_read(reader, data, dp):
+    fifo_fp = os.path.join(dp, 'fifo')
+    os.mkfifo(fifo_fp)
+    writer = multiprocessing.Process(target=write, args=(fifo_fp, data))
+    writer.start()
+    start = time.time()
+    im = reader(fifo_fp)
+    im.load()
+    elapsed = time.time() - start
+    writer.join()
+    os.unlink(fifo_fp)
+    assert im.size == (WIDTH, HEIGHT), im.size
+    return elapsed
+
+
+def main():
+    dp = tempfile.mkdtemp()
+    try:
+        for label, reader, fmt in (('old (BMP, 1KB reads)', read_old, 'BMP'),
+                                   ('new (PNM, readinto)', read_new, 'PPM')):
+            data = encoded(fmt)
+            secs = min(time_read(reader, data, dp) for _ in range(RUNS))
+            mb = len(data) / (1024.0 * 1024)
+            print('%-22s %8.1f MB in %6.3f s  %8.1f MB/s' % (label, mb, secs, mb / secs))
+    finally:
+        shutil.rmtree(dp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+# Compares the time taken to get the info of JP2s, the two ways
+# loris.jp2_extractor has looked for boxes and markers:
+#
+#   old: reading a byte at a time until the box type or marker turns up
+#   new: skipping over boxes and marker segments by their lengths, and
+#        searching blocks with bytes.find where that isn't possible
+#
+# Metadata boxes (XML, UUID) between the File Type and JP2 Header boxes are
+# what made the old way slow, so by default the corpus is the JP2s in
+# tests/img, each with an XML box and a UUID box of the given size (in MB)
+# added in front of its JP2 Header box. Other JP2s can be given instead.
+# Run from the root of the repository:
+#
+#   python misc/jp2_extractor_benchmark.py [metadata MB] [runs] [jp2 ...]
+from __future__ import print_function
+
+import collections
+import glob
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from loris.img_info import ImageInfo
+
+METADATA_MB = float(sys.argv[1]) if len(sys.argv) > 1 else 1
+RUNS = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+JP2S = sys.argv[3:]
+
+
+def _old_read_jp2_until_match(jp2, match):
+    window = collections.deque([], len(match))
+    while b''.join(window) != match:
+        b = jp2.read(1)
+        c = struct.unpack('c', b)[0]
+        window.append(c)
+    jp2.seek(-len(match), os.SEEK_CUR)
+
+
+class OldImageInfo(ImageInfo):
+    '''ImageInfo with extract_jp2 as it was, less the comments.'''
+
+    def extract_jp2(self, jp2):
+        self._check_signature_box(jp2)
+        self._check_file_type_box(jp2)
+
+        _old_read_jp2_until_match(jp2, b'jp2h')
+        jp2.read(4)
+        dimensions = self._get_dimensions_from_image_header_box(jp2)
+        self.height = dimensions.height
+        self.width = dimensions.width
+
+        _old_read_jp2_until_match(jp2, b'colr')
+        jp2.seek(-4, os.SEEK_CUR)
+        qualities, profile_bytes = self._parse_colour_specification_box(jp2)
+        self.profile.description['qualities'] += qualities
+        self.color_profile_bytes = profile_bytes
+
+        _old_read_jp2_until_match(jp2, b'\xFF\x51')
+        tile_dimensions = self._parse_siz_marker_segment(jp2)
+        if tile_dimensions.height == tile_dimensions.width:
+            self.tiles.append({'width': tile_dimensions.width})
+        else:
+            self.tiles.append({
+                'width': tile_dimensions.width,
+                'height': tile_dimensions.height
+            })
+
+        window = collections.deque(jp2.read(2), 2)
+        while ((window[0] != b'\xFF') or (window[1] != b'\x52')):
+            window.append(jp2.read(1))
+
+        jp2.read(7)
+        levels = int(struct.unpack(">B", jp2.read(1))[0])
+        scaleFactors = [pow(2, l) for l in range(0, levels + 1)]
+        self.tiles[0]['scaleFactors'] = scaleFactors
+        jp2.read(4)
+
+        b = jp2.read(1)
+        if ord(b) != 0xFF:
+            if self.tiles[0]['width'] == self.width \
+                and self.tiles[0].get('height') in (self.height, None):
+                self.tiles = []
+                for level in range(levels + 1):
+                    i = int(bin(struct.unpack(">B", b)[0])[2:].zfill(8), 2)
+                    w = 2 ** (i & 15)
+                    b = jp2.read(1)
+                    try:
+                        entry = next((t for t in self.tiles if t['width'] == w))
+                        entry['scaleFactors'].append(pow(2, level))
+                    except StopIteration:
+                        self.tiles.append({'width': w, 'scaleFactors': [pow(2, level)]})
+
+        self.sizes = [
+            {'width': width, 'height': height}
+            for width, height in self.sizes_for_scales(scaleFactors)
+        ]
+        self.sizes.sort(key=lambda size: max([size['width'], size['height']]))
+
+
+def with_metadata(src_fp, dp):
+    '''A copy of the JP2 at src_fp, with large XML and UUID boxes after
+    its File Type box.'''
+    with open(src_fp, 'rb') as f:
+        data = f.read()
+    size = int(METADATA_MB * 1024 * 1024)
+    xml = b'<rdf:Description rdf:about=""/>\n' * (size // 32)
+    uuid = b'\x00' * 16 + b'\x5a' * (size - 16)
+    boxes = b''.join(
+        struct.pack('>I4s', 8 + len(contents), box_type) + contents
+        for box_type, contents in ((b'xml ', xml), (b'uuid', uuid))
+    )
+    ftyp_end = 12 + struct.unpack('>I', data[12:16])[0]
+    fp = os.path.join(dp, os.path.basename(src_fp))
+    with open(fp, 'wb') as f:
+        f.write(data[:ftyp_end] + boxes + data[ftyp_end:])
+    return fp
+
+
+def extract(cls, fp):
+    return cls(src_img_fp=fp, src_format='jp2').from_image_file(['jpg'])
+
+
+def time_extract(cls, fp):
+    start = time.time()
+    info = extract(cls, fp)
+    return time.time() - start, info.to_iiif_json()
+
+
+def main():
+    dp = tempfile.mkdtemp()
+    try:
+        if JP2S:
+            corpus = JP2S
+        else:
+            here = os.path.dirname(os.path.abspath(__file__))
+            corpus = [
+                with_metadata(fp, dp) for fp in sorted(
+                    glob.glob(os.path.join(here, '..', 'tests', 'img', '*.jp2')) +
+                    glob.glob(os.path.join(here, '..', 'tests', 'img', '01', '02', 'gray.jp2'))
+                )
+            ]
+        totals = {'old': 0.0, 'new': 0.0}
+        for fp in corpus:
+            mb = os.path.getsize(fp) / (1024.0 * 1024)
+            results = {}
+            for label, cls in (('old', OldImageInfo), ('new', ImageInfo)):
+                timings = [time_extract(cls, fp) for _ in range(RUNS)]
+                secs = min(t for t, _ in timings)
+                results[label] = timings[0][1]
+                totals[label] += secs
+                print('%-40s %8.1f MB  %s %8.4f s' % (
+                    os.path.basename(fp)[:40], mb, label, secs))
+            assert results['old'] == results['new'], fp
+        print('total: old %.4f s, new %.4f s (%.0fx)' % (
+            totals['old'], totals['new'], totals['old'] / max(totals['new'], 1e-6)))
+    finally:
+        shutil.rmtree(dp)
+
+
+if __name__ == '__main__':
+    main()
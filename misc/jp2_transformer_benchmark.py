@@ -0,0 +1,73 @@
+# Times the JP2 transformers against each other for a few typical requests:
+# a thumbnail, a reduced full image, a tile and a small region at full
+# resolution. Run from the root of the repository:
+#
+#   python misc/jp2_transformer_benchmark.py [path/to/image.jp2] [runs] [pillow,opj,kdu]
+#
+# Requests a transformer can't handle are reported and skipped.
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import logging
+
+from loris import img_info, transforms, webapp
+from loris.img import ImageRequest
+
+JP2 = sys.argv[1] if len(sys.argv) > 1 else 'tests/img/01/02/gray.jp2'
+RUNS = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+NAMES = sys.argv[3].split(',') if len(sys.argv) > 3 else ['pillow', 'opj', 'kdu']
+
+REQUESTS = [
+    ('thumbnail', 'full', '!200,200'),
+    ('reduced', 'full', 'pct:50'),
+    ('tile', '1024,1024,1024,1024', '512,'),
+    ('region', '1000,1000,256,256', 'full'),
+]
+
+
+def transformer(name):
+    tforms = webapp.get_debug_config(name)['transforms']
+    config = dict(tforms['jp2'])
+    config.update((k, v) for k, v in tforms.items() if not isinstance(v, dict))
+    config['tmp_dp'] = tempfile.mkdtemp()
+    impl = getattr(transforms, config['impl'])
+    return impl(config), config['tmp_dp']
+
+
+def main():
+    logging.disable(logging.INFO)
+    info = img_info.ImageInfo(ident='file://%s' % JP2, src_img_fp=JP2, src_format='jp2')
+    info.from_image_file(formats=['jpg', 'png'])
+    out_dp = tempfile.mkdtemp()
+
+    for name in NAMES:
+        t, tmp_dp = transformer(name)
+        try:
+            for label, region, size in REQUESTS:
+                request = ImageRequest('id', region, size, '0', 'default', 'jpg')
+                target_fp = os.path.join(out_dp, '%s-%s.jpg' % (name, label))
+                run = lambda: t.transform(target_fp, request, info)
+                try:
+                    run()
+                except Exception as e:
+                    print('%-8s %-10s skipped: %r' % (name, label, e))
+                    continue
+                secs = min(timeit.repeat(run, number=1, repeat=RUNS))
+                print('%-8s %-10s %8.1f ms' % (name, label, secs * 1000))
+        finally:
+            if hasattr(t, 'decoder_pool'):
+                t.decoder_pool.terminate()
+            shutil.rmtree(tmp_dp)
+
+    shutil.rmtree(out_dp)
+
+
+if __name__ == '__main__':
+    main()
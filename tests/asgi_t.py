@@ -0,0 +1,146 @@
+#-*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+import sys
+import threading
+
+import pytest
+
+from tests import loris_t
+
+if sys.version_info >= (3, 5):
+    import asyncio
+    from loris import asgi
+
+pytestmark = pytest.mark.skipif(
+    sys.version_info < (3, 5), reason='ASGI needs Python 3.5 or later'
+)
+
+
+def _scope(path, query_string=b'', headers=()):
+    return {
+        'type': 'http',
+        'http_version': '1.1',
+        'method': 'GET',
+        'scheme': 'http',
+        'path': path,
+        'query_string': query_string,
+        'root_path': '',
+        'headers': list(headers),
+        'server': ('localhost', 80),
+        'client': ('127.0.0.1', 12345),
+    }
+
+
+class TestToEnviron(object):
+
+    def test_path_and_query_string(self):
+        environ = asgi.to_environ(_scope(u'/a b/é', b'x=1'), b'')
+        assert environ['PATH_INFO'] == u'/a b/é'.encode('utf-8').decode('latin-1')
+        assert environ['QUERY_STRING'] == 'x=1'
+        assert environ['SERVER_PORT'] == '80'
+
+    def test_headers(self):
+        environ = asgi.to_environ(_scope('/', headers=[
+            (b'if-none-match', b'"a"'),
+            (b'if-none-match', b'"b"'),
+            (b'content-type', b'text/plain'),
+        ]), b'')
+        assert environ['HTTP_IF_NONE_MATCH'] == '"a","b"'
+        assert environ['CONTENT_TYPE'] == 'text/plain'
+
+
+class ASGITest(loris_t.LorisTest):
+
+    def setUp(self):
+        super(ASGITest, self).setUp()
+        self.loop = asyncio.new_event_loop()
+        self.asgi_app = asgi.LorisASGI(self.app, workers=1, body_workers=1)
+
+    def tearDown(self):
+        self.asgi_app.shutdown()
+        self.loop.close()
+        super(ASGITest, self).tearDown()
+
+    def _call(self, scope, received):
+        received = list(received)
+        sent = []
+
+        def receive():
+            f = self.loop.create_future()
+            f.set_result(received.pop(0))
+            return f
+
+        def send(message):
+            sent.append(message)
+            f = self.loop.create_future()
+            f.set_result(None)
+            return f
+
+        self.loop.run_until_complete(self.asgi_app(scope, receive, send))
+        return sent
+
+    def _get(self, path, headers=()):
+        sent = self._call(_scope(path, headers=headers), [
+            {'type': 'http.request', 'body': b'', 'more_body': False}
+        ])
+        start = sent[0]
+        assert start['type'] == 'http.response.start'
+        assert sent[-1] == {'type': 'http.response.body', 'body': b''}
+        body = b''.join(m['body'] for m in sent[1:])
+        return start['status'], dict(start['headers']), body
+
+    def test_info(self):
+        status, headers, body = self._get('/%s/info.json' % self.test_jpeg_id)
+        assert status == 200
+        assert headers[b'content-type'] == b'application/json'
+        assert body == self.client.get('/%s/info.json' % self.test_jpeg_id).data
+
+    def test_image(self):
+        url = '/%s/full/pct:10/0/default.jpg' % self.test_jpeg_id
+        status, headers, body = self._get(url)
+        assert status == 200
+        assert headers[b'content-type'] == b'image/jpeg'
+        assert int(headers[b'content-length']) == len(body)
+        assert body == self.client.get(url).data
+
+    def test_conditional_request(self):
+        url = '/%s/full/pct:10/0/default.jpg' % self.test_jpeg_id
+        etag = self._get(url)[1][b'etag']
+        status, _, body = self._get(url, headers=[(b'if-none-match', etag)])
+        assert status == 304
+        assert body == b''
+
+    def test_bodies_are_read_outside_the_routing_threads(self):
+        threads = {}
+
+        def chunks():
+            threads['body'] = threading.current_thread()
+            yield b'abc'
+
+        def respond(environ):
+            threads['route'] = threading.current_thread()
+            return (chunks(), 200, [])
+
+        self.asgi_app._respond = respond
+        status, _, body = self._get('/anything')
+        assert (status, body) == (200, b'abc')
+        assert threads['body'] is not threads['route']
+
+    def test_not_found(self):
+        status, _, _ = self._get('/no/such/image.jpg/info.json')
+        assert status == 404
+
+    def test_disconnect_before_the_request_is_read(self):
+        sent = self._call(_scope('/'), [{'type': 'http.disconnect'}])
+        assert sent == []
+
+    def test_lifespan(self):
+        sent = self._call({'type': 'lifespan'}, [
+            {'type': 'lifespan.startup'},
+            {'type': 'lifespan.shutdown'},
+        ])
+        assert [m['type'] for m in sent] == [
+            'lifespan.startup.complete', 'lifespan.shutdown.complete'
+        ]
@@ -0,0 +1,125 @@
+# -*- encoding: utf-8
+
+from __future__ import absolute_import
+
+import os
+
+import pytest
+
+from loris.cache_index import CacheIndex, is_derivative
+
+
+@pytest.fixture
+def index(tmpdir):
+    return CacheIndex(str(tmpdir.join('index.sqlite')))
+
+
+class TestCacheIndex(object):
+
+    def test_total_follows_adds_and_removes(self, index):
+        index.add('a/full/full/0/default.jpg', 100, 1, 'image/jpeg', atime=1)
+        index.add('b/full/full/0/default.jpg', 50, 1, 'image/jpeg', atime=2)
+        assert index.total_size() == 150
+        assert len(index) == 2
+
+        # re-rendering replaces the size
+        index.add('a/full/full/0/default.jpg', 30, 1, 'image/jpeg', atime=3)
+        assert index.total_size() == 80
+
+        assert index.remove('b/full/full/0/default.jpg', atime=2) == []
+        assert index.total_size() == 30
+        assert len(index) == 1
+
+    def test_least_recently_used_follows_touches(self, index):
+        for i, name in enumerate('abc'):
+            index.add(name, 10, 1, 'image/jpeg', atime=i + 1)
+        index.touch('a')
+        assert [r[0] for r in index.least_recently_used(2)] == ['a', 'b']
+        index.flush()
+        assert [r[0] for r in index.least_recently_used(2)] == ['b', 'c']
+
+    def test_remove_returns_links(self, index):
+        index.add('a/full/full/0/default.jpg', 10, 1, 'image/jpeg', atime=1)
+        index.add_link('a/full/pct:100/0/default.jpg', 'a/full/full/0/default.jpg')
+        assert index.remove('a/full/full/0/default.jpg', atime=1) == [
+            'a/full/pct:100/0/default.jpg'
+        ]
+
+    def test_files_used_since_are_not_removed(self, index):
+        index.add('a', 10, 1, 'image/jpeg', atime=1)
+        index.add('a', 10, 1, 'image/jpeg', atime=5)
+        assert index.remove('a', atime=1) is None
+        assert len(index) == 1
+
+    def test_is_shared_between_instances(self, index):
+        index.add('a', 10, 1, 'image/jpeg')
+        assert CacheIndex(index.db_fp).total_size() == 10
+
+    def test_rebuild(self, index, tmpdir):
+        root = tmpdir.mkdir('cache')
+        canonical = root.join('id', 'full', '10,', '0', 'default.jpg')
+        canonical.write('x' * 10, ensure=True)
+        link = root.join('id', 'full', 'pct:10', '0', 'default.jpg')
+        link.dirpath().ensure(dir=True)
+        os.symlink(str(canonical), str(link))
+        root.join('http', 'id', 'info.json').write('{}', ensure=True)
+        root.join('.locks', '0001.lock').write('', ensure=True)
+        index.add('stale', 99, 1, 'image/jpeg')
+
+        assert index.rebuild(str(root), {'jpg': 'image/jpeg'}) == 1
+        assert index.total_size() == 10
+        assert index.lookup('id/full/pct:10/0/default.jpg') == (
+            'id/full/10,/0/default.jpg', 10, canonical.mtime(), 'image/jpeg'
+        )
+        assert index.remove('id/full/10,/0/default.jpg', atime=2 ** 40) == [
+            'id/full/pct:10/0/default.jpg'
+        ]
+
+    def test_lookup_by_path_or_link(self, index):
+        index.add('a/full/full/0/default.jpg', 10, 5, 'image/jpeg')
+        index.add_link('a/full/pct:100/0/default.jpg', 'a/full/full/0/default.jpg')
+        expected = ('a/full/full/0/default.jpg', 10, 5, 'image/jpeg')
+        assert index.lookup('a/full/full/0/default.jpg') == expected
+        assert index.lookup('a/full/pct:100/0/default.jpg') == expected
+        assert index.lookup('a/full/pct:50/0/default.jpg') is None
+
+    def test_discard_by_link(self, index):
+        index.add('a/full/full/0/default.jpg', 10, 1, 'image/jpeg')
+        index.add_link('a/full/pct:100/0/default.jpg', 'a/full/full/0/default.jpg')
+        index.discard('a/full/pct:100/0/default.jpg')
+        assert index.lookup('a/full/full/0/default.jpg') is None
+        assert index.lookup('a/full/pct:100/0/default.jpg') is None
+        assert index.total_size() == 0
+
+    def test_infos(self, index):
+        index.add_info('http/id/info.json', 5, True)
+        assert index.lookup_info('http/id/info.json') == (5, True)
+        assert index.lookup_info('https/id/info.json') is None
+        index.remove_info('http/id/info.json')
+        assert index.lookup_info('http/id/info.json') is None
+
+    def test_rebuild_infos(self, index, tmpdir):
+        root = tmpdir.mkdir('cache')
+        info = root.join('http', 'a', 'info.json')
+        info.write('{}', ensure=True)
+        root.join('http', 'a', 'profile.icc').write('icc')
+        root.join('https', 'b', 'info.json').write('{}', ensure=True)
+        root.join('b', 'full', 'full', '0', 'default.jpg').write('x', ensure=True)
+        root.join('http', 'c', 'info.bin').write('record', ensure=True)
+
+        assert index.rebuild_infos(str(root)) == 3
+        assert index.lookup_info('http/a/info.json') == (info.mtime(), True)
+        assert index.lookup_info('https/b/info.json')[1] is False
+        assert index.lookup_info('http/c/info.bin') is not None
+        assert len(index) == 0
+
+
+@pytest.mark.parametrize('name, expected', [
+    ('default.jpg', True),
+    ('gray.png', True),
+    ('info.json', False),
+    ('profile.icc', False),
+    ('default.jp2', False),
+])
+def test_is_derivative(name, expected):
+    assert is_derivative(name) == expected
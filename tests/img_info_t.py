@@ -6,7 +6,9 @@ from __future__ import absolute_import
 import os
 from os import path
 import json
+import shutil
 import tempfile
+import threading
 from datetime import datetime
 
 try:
@@ -14,6 +16,7 @@ try:
 except ImportError:  # Python 2
     from urllib import unquote
 
+import mock
 import pytest
 from werkzeug.datastructures import Headers
 
@@ -477,6 +480,70 @@ class InfoFunctional(loris_t.LorisTest):
         self.assertTrue(''.join(lh.split()) in link_header)
 
 
+class TestImageInfoRecord(loris_t.LorisTest):
+
+    def test_round_trip(self):
+        info = img_info.ImageInfo(self.app, self.test_jp2_gray_uri,
+            self.test_jp2_gray_fp, self.test_jp2_gray_fmt)
+        info.color_profile_bytes = b'not really a profile'
+        info.service = {u'@id': u'http://example.org/auth/\u00e9', u'n': 1.5}
+        info.auth_rules = {'allowed': [True, False, None, 2 ** 40]}
+        record = info.to_record()
+        new_info = img_info.ImageInfo.from_record(record)
+
+        assert new_info.to_full_info_json() == info.to_full_info_json()
+        assert new_info.color_profile_bytes == info.color_profile_bytes
+        assert new_info.tiles == info.tiles
+        assert new_info.auth_rules == info.auth_rules
+
+    def test_without_color_profile(self):
+        info = img_info.ImageInfo(self.app, self.test_jpeg_uri,
+            self.test_jpeg_fp, self.test_jpeg_fmt)
+        new_info = img_info.ImageInfo.from_record(info.to_record())
+        assert new_info.color_profile_bytes is None
+        assert new_info.to_full_info_json() == info.to_full_info_json()
+
+    def test_truncated_record(self):
+        info = img_info.ImageInfo(self.app, self.test_jpeg_uri,
+            self.test_jpeg_fp, self.test_jpeg_fmt)
+        with pytest.raises(ImageInfoException):
+            img_info.ImageInfo.from_record(info.to_record()[:-10])
+
+
+@pytest.mark.parametrize('record', [
+    b'',
+    b'{"width": 100}',
+    img_info.RECORD_HEADER.pack(img_info.RECORD_MAGIC, 99, 1, 1),
+])
+def test_bad_info_records(record):
+    with pytest.raises(ImageInfoException):
+        img_info.ImageInfo.from_record(record)
+
+
+def test_threads_can_write_the_same_record_at_once(tmpdir):
+    fp = str(tmpdir.join('info.bin'))
+    errors = []
+
+    def write(data):
+        try:
+            for _ in range(50):
+                img_info._write_atomically(fp, data)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [
+        threading.Thread(target=write, args=(b'x' * 10000,)) for _ in range(4)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+    assert os.listdir(str(tmpdir)) == ['info.bin']
+    with open(fp, 'rb') as f:
+        assert f.read() == b'x' * 10000
+
+
 class TestInfoCache(loris_t.LorisTest):
 
     def _cache_with_request(self):
@@ -502,7 +569,7 @@ class TestInfoCache(loris_t.LorisTest):
         expected_path = path.join(
             self.app.info_cache.http_root,
             unquote(self.test_jp2_color_id),
-            'info.json'
+            'info.bin'
         )
         self.assertTrue(path.exists(expected_path))
 
@@ -516,7 +583,7 @@ class TestInfoCache(loris_t.LorisTest):
         expected_path = path.join(
             self.app.info_cache.http_root,
             unquote(self.test_jp2_color_id),
-            'info.json'
+            'info.bin'
         )
         fs_first_time = datetime.utcfromtimestamp(os.path.getmtime(expected_path))
         # Push this entry out of the RAM cache with another
@@ -574,6 +641,53 @@ class TestInfoCache(loris_t.LorisTest):
         del cache[req]
         assert not os.path.exists(color_profile_fp)
 
+    def _cache_with_gray_request(self):
+        cache = img_info.InfoCache(root=self.SRC_IMAGE_CACHE)
+        req = webapp_t._get_werkzeug_request(path=self.test_jp2_gray_fp)
+        info = img_info.ImageInfo(self.app, self.test_jp2_gray_uri,
+            self.test_jp2_gray_fp, self.test_jp2_gray_fmt)
+        info.color_profile_bytes = b'not really a profile'
+        cache[req] = info
+        return (cache, req)
+
+    def test_info_is_stored_in_one_record(self):
+        cache, req = self._cache_with_gray_request()
+        dp = path.dirname(cache._get_record_fp(req))
+        assert os.listdir(dp) == ['info.bin']
+
+        # a new cache, so nothing is in memory
+        cache = img_info.InfoCache(root=self.SRC_IMAGE_CACHE)
+        with mock.patch('loris.img_info.os.path.exists', side_effect=AssertionError), \
+                mock.patch.object(img_info.ImageInfo, 'from_json',
+                                  side_effect=AssertionError):
+            info, _ = cache[req]
+        assert info.width == self.test_jp2_gray_dims[0]
+        assert info.color_profile_bytes == b'not really a profile'
+
+    def test_reads_info_json_written_by_older_versions(self):
+        cache, req = self._cache_with_gray_request()
+        info, last_mod = cache[req]
+        os.unlink(cache._get_record_fp(req))
+        with open(cache._get_info_fp(req), 'w') as f:
+            f.write(info.to_full_info_json())
+        with open(cache._get_color_profile_fp(req), 'wb') as f:
+            f.write(info.color_profile_bytes)
+
+        cache = img_info.InfoCache(root=self.SRC_IMAGE_CACHE)
+        legacy_info, _ = cache[req]
+        assert legacy_info.to_full_info_json() == info.to_full_info_json()
+        assert legacy_info.color_profile_bytes == info.color_profile_bytes
+
+        del cache[req]
+        assert not os.path.exists(cache._get_info_fp(req))
+
+    def test_unreadable_records_are_misses(self):
+        cache, req = self._cache_with_gray_request()
+        with open(cache._get_record_fp(req), 'wb') as f:
+            f.write(b'not a record')
+        cache = img_info.InfoCache(root=self.SRC_IMAGE_CACHE)
+        assert cache.get(req) is None
+
     def test_looking_up_missing_item_is_keyerror(self):
         cache = img_info.InfoCache(root=tempfile.mkdtemp())
         path = self.test_jp2_color_fp
@@ -581,3 +695,180 @@ class TestInfoCache(loris_t.LorisTest):
 
         with pytest.raises(KeyError):
             cache[req]
+
+
+class TestIndexedInfoCache(loris_t.LorisTest):
+
+    def setUp(self):
+        super(TestIndexedInfoCache, self).setUp()
+        self.root = tempfile.mkdtemp()
+        self.req = webapp_t._get_werkzeug_request(path=self.test_jp2_gray_fp)
+        info = img_info.ImageInfo(self.app, self.test_jp2_gray_uri,
+            self.test_jp2_gray_fp, self.test_jp2_gray_fmt)
+        info.from_image_file()
+        info.color_profile_bytes = b'not really a profile'
+        img_info.InfoCache(root=self.root, use_index=True)[self.req] = info
+
+    def tearDown(self):
+        super(TestIndexedInfoCache, self).tearDown()
+        shutil.rmtree(self.root)
+
+    def test_is_read_back_without_checking_for_files(self):
+        # a new cache, so nothing is in memory
+        cache = img_info.InfoCache(root=self.root, use_index=True)
+        # (opening the index checks that its directory exists)
+        cache.index.lookup_info('')
+        with mock.patch('loris.img_info.os.path.exists', side_effect=AssertionError):
+            info, last_mod = cache[self.req]
+            assert self.req in cache
+        assert info.width == self.test_jp2_gray_dims[0]
+        assert info.color_profile_bytes == b'not really a profile'
+        assert last_mod == datetime.utcfromtimestamp(
+            os.path.getmtime(cache._get_record_fp(self.req))
+        )
+
+    def test_files_missing_from_index_are_misses(self):
+        cache = img_info.InfoCache(root=self.root, use_index=True)
+        cache.index.remove_info(
+            os.path.relpath(cache._get_record_fp(self.req), self.root)
+        )
+        assert cache.get(self.req) is None
+
+    def test_missing_files_are_removed_from_index(self):
+        cache = img_info.InfoCache(root=self.root, use_index=True)
+        os.unlink(cache._get_record_fp(self.req))
+        assert cache.get(self.req) is None
+        assert self.req not in cache
+
+
+class TestSharedInfoCache(loris_t.LorisTest):
+
+    def setUp(self):
+        super(TestSharedInfoCache, self).setUp()
+        self.root = tempfile.mkdtemp()
+        self.shared_fp = os.path.join(self.root, 'shared')
+        self.req = webapp_t._get_werkzeug_request(path=self.test_jp2_gray_fp)
+        self.info = img_info.ImageInfo(self.app, self.test_jp2_gray_uri,
+            self.test_jp2_gray_fp, self.test_jp2_gray_fmt)
+        self.info.color_profile_bytes = b'not really a profile'
+
+    def tearDown(self):
+        super(TestSharedInfoCache, self).tearDown()
+        shutil.rmtree(self.root)
+
+    def _cache(self, **kwargs):
+        return img_info.InfoCache(root=self.root, shared_fp=self.shared_fp, **kwargs)
+
+    def test_other_processes_read_from_the_shared_cache(self):
+        self._cache()[self.req] = self.info
+        # another process's cache, with nothing in memory
+        other = self._cache()
+        with mock.patch.object(img_info.InfoCache, '_read_record',
+                               side_effect=AssertionError):
+            info, last_mod = other[self.req]
+        assert info.to_full_info_json() == self.info.to_full_info_json()
+        assert info.color_profile_bytes == b'not really a profile'
+        assert last_mod == datetime.utcfromtimestamp(
+            os.path.getmtime(other._get_record_fp(self.req))
+        )
+
+    def test_infos_read_from_disk_are_shared(self):
+        img_info.InfoCache(root=self.root)[self.req] = self.info
+        self._cache().get(self.req)
+        assert self._cache().shared.get(self.req.url.encode('utf-8')) is not None
+
+    def test_large_infos_are_read_from_disk(self):
+        self.info.color_profile_bytes = b'x' * 1024
+        self._cache(shared_slot_size=1024)[self.req] = self.info
+        other = self._cache()
+        assert other.shared.get(self.req.url.encode('utf-8')) is None
+        assert other[self.req][0].color_profile_bytes == b'x' * 1024
+
+    def test_records_from_another_version_are_read_again(self):
+        self.app.info_cache = self._cache()
+        url = '/%s/info.json' % self.test_jp2_gray_id
+        req = webapp_t._get_werkzeug_request(path=url)
+        assert self.client.get(url).status_code == 200
+
+        # as if left by another version of Loris, on disk and in the
+        # shared cache, with nothing in memory
+        old_record = img_info.RECORD_HEADER.pack(
+            img_info.RECORD_MAGIC, img_info.RECORD_VERSION + 1, 1, 1)
+        record_fp = self.app.info_cache._get_record_fp(req)
+        with open(record_fp, 'wb') as f:
+            f.write(old_record)
+        self.app.info_cache.shared.put(
+            req.url.encode('utf-8'), img_info.RECORD_FLOAT.pack(0) + old_record)
+        self.app.info_cache = self._cache()
+        assert self.app.info_cache.get(req) is None
+
+        resp = self.client.get(url)
+        assert resp.status_code == 200
+        assert json.loads(resp.data.decode('utf-8'))['width'] == \
+            self.test_jp2_gray_dims[0]
+        with open(record_fp, 'rb') as f:
+            info = img_info.ImageInfo.from_record(f.read())
+        assert info.width == self.test_jp2_gray_dims[0]
+        info, _ = self._cache()._get_shared(req)
+        assert info.width == self.test_jp2_gray_dims[0]
+
+
+class InfoETags(loris_t.LorisTest):
+
+    def setUp(self):
+        super(InfoETags, self).setUp()
+        self.url = '/%s/info.json' % self.test_jp2_gray_id
+
+    def test_info_has_a_strong_etag(self):
+        resp = self.client.get(self.url)
+        assert resp.status_code == 200
+        etag = resp.headers['ETag']
+        assert etag.startswith('"')
+        assert self.client.get(self.url).headers['ETag'] == etag
+
+    def test_if_none_match(self):
+        etag = self.client.get(self.url).headers['ETag']
+        with mock.patch.object(img_info.ImageInfo, 'to_iiif_json',
+                               side_effect=AssertionError):
+            resp = self.client.get(
+                self.url, headers=Headers([('If-None-Match', etag)])
+            )
+            assert resp.status_code == 304
+            assert resp.headers['ETag'] == etag
+
+            # and hits are served without serializing anything
+            resp = self.client.get(self.url)
+            assert resp.status_code == 200
+            assert resp.headers['ETag'] == etag
+
+    def test_if_none_match_with_another_etag(self):
+        resp = self.client.get(
+            self.url, headers=Headers([('If-None-Match', '"something else"')])
+        )
+        assert resp.status_code == 200
+        assert json.loads(resp.data.decode('utf-8'))['width'] == self.test_jp2_gray_dims[0]
+
+    def test_if_none_match_takes_precedence_over_if_modified_since(self):
+        first = self.client.get(self.url)
+        resp = self.client.get(self.url, headers=Headers([
+            ('If-None-Match', '"something else"'),
+            ('If-Modified-Since', first.headers['Last-Modified']),
+        ]))
+        assert resp.status_code == 200
+
+    def test_etag_follows_the_stored_info(self):
+        etag = self.client.get(self.url).headers['ETag']
+        req = webapp_t._get_werkzeug_request(path=self.url)
+        info, _ = self.app.info_cache[req]
+        new_info = img_info.ImageInfo.from_record(info.to_record())
+        new_info.service = {'@id': 'http://example.org/auth'}
+        self.app.info_cache[req] = new_info
+
+        resp = self.client.get(self.url)
+        assert resp.headers['ETag'] != etag
+        assert json.loads(resp.data.decode('utf-8'))['service'] == new_info.service
+
+    def test_jsonp_has_no_etag(self):
+        resp = self.client.get(self.url + '?callback=f')
+        assert resp.status_code == 200
+        assert 'ETag' not in resp.headers
@@ -2,9 +2,14 @@
 
 from __future__ import absolute_import
 
+import os
 from os.path import exists
+from os.path import getsize
 from os.path import islink
 from os.path import join
+from os.path import lexists
+import threading
+from time import sleep
 
 import mock
 import pytest
@@ -15,6 +20,7 @@ except ImportError:  # Python 2
     from urllib import unquote
 
 from loris import img, img_info
+from loris.utils import lock_file
 from tests import loris_t
 
 
@@ -126,3 +132,163 @@ class Test_ImageCache(loris_t.LorisTest):
         cache = img.ImageCache(cache_root='/tmp')
         request = img.ImageRequest('id1', 'full', 'full', '0', 'default', 'jpg')
         del cache[request]
+
+
+class Test_ImageCacheEviction(loris_t.LorisTest):
+
+    def setUp(self):
+        super(Test_ImageCacheEviction, self).setUp()
+        cache_root = self.app.img_cache.cache_root
+        self.app.img_cache = img.ImageCache(
+            cache_root,
+            high_watermark=10 ** 9,
+            eviction_interval=3600,
+            index_fp=join(cache_root, '.test-index.sqlite')
+        )
+        self.cache = self.app.img_cache
+
+    def _get(self, params):
+        resp = self.client.get('/%s/%s' % (self.test_jpeg_id, params))
+        self.assertEqual(resp.status_code, 200)
+
+    def _cache_fp(self, params):
+        return join(self.cache.cache_root, unquote(self.test_jpeg_id), params)
+
+    def test_renders_are_indexed(self):
+        self._get('full/100,/0/default.jpg')
+        self._get('full/pct:10/0/default.jpg')
+        self.assertEqual(len(self.cache.index), 2)
+        self.assertEqual(
+            self.cache.index.total_size(),
+            sum(getsize(self._cache_fp(p)) for p in ('full/100,/0/default.jpg',
+                                                     'full/360,/0/default.jpg'))
+        )
+
+    def test_evicts_least_recently_used_and_its_links(self):
+        self._get('full/100,/0/default.jpg')
+        self._get('full/pct:10/0/default.jpg')  # canonically full/360,
+        self._get('full/200,/0/default.jpg')
+        # served from the cache, so it's now the most recently used
+        self._get('full/100,/0/default.jpg')
+
+        keep = getsize(self._cache_fp('full/100,/0/default.jpg'))
+        self.cache.evict(to_size=keep)
+
+        self.assertTrue(exists(self._cache_fp('full/100,/0/default.jpg')))
+        self.assertFalse(exists(self._cache_fp('full/360,/0/default.jpg')))
+        self.assertFalse(lexists(self._cache_fp('full/pct:10/0/default.jpg')))
+        self.assertFalse(exists(self._cache_fp('full/200,/0/default.jpg')))
+        self.assertEqual(self.cache.index.total_size(), keep)
+
+        # and an evicted image is simply rendered again
+        self._get('full/pct:10/0/default.jpg')
+        self.assertTrue(exists(self._cache_fp('full/360,/0/default.jpg')))
+
+    def test_one_eviction_at_a_time_across_processes(self):
+        self._get('full/100,/0/default.jpg')
+        self._get('full/200,/0/default.jpg')
+        keep = getsize(self._cache_fp('full/200,/0/default.jpg'))
+
+        # (as another process's evictor would)
+        with lock_file(join(self.cache.cache_root, '.locks', 'evict')):
+            evictor = threading.Thread(
+                target=self.cache.evict, kwargs={'to_size': keep}
+            )
+            evictor.start()
+            evictor.join(0.2)
+            self.assertTrue(evictor.is_alive())
+            self.assertTrue(exists(self._cache_fp('full/100,/0/default.jpg')))
+        evictor.join()
+
+        self.assertFalse(exists(self._cache_fp('full/100,/0/default.jpg')))
+        self.assertTrue(exists(self._cache_fp('full/200,/0/default.jpg')))
+
+    def test_evicts_in_the_background_over_the_high_watermark(self):
+        self.cache.high_watermark = 1
+        self.cache.low_watermark = 0
+        self.cache.eviction_interval = 0.05
+        self._get('full/100,/0/default.jpg')
+        for _ in range(100):
+            if not exists(self._cache_fp('full/100,/0/default.jpg')):
+                break
+            sleep(0.05)
+        self.assertFalse(exists(self._cache_fp('full/100,/0/default.jpg')))
+        self.assertEqual(self.cache.index.total_size(), 0)
+
+
+class Test_IndexedImageCache(loris_t.LorisTest):
+
+    def setUp(self):
+        super(Test_IndexedImageCache, self).setUp()
+        cache_root = self.app.img_cache.cache_root
+        self.app.img_cache = img.ImageCache(
+            cache_root,
+            use_index=True,
+            index_fp=join(cache_root, '.test-index.sqlite')
+        )
+        self.request_path = '/%s/full/pct:10/0/default.jpg' % self.test_jpeg_id
+
+    def test_hits_are_served_from_the_index(self):
+        first = self.client.get(self.request_path)
+        with mock.patch('loris.img.path.getmtime', side_effect=AssertionError), \
+                mock.patch('loris.img.path.realpath', side_effect=AssertionError):
+            second = self.client.get(self.request_path)
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(second.headers['Content-Length'], str(len(first.data)))
+        self.assertEqual(second.headers['Content-Type'], 'image/jpeg')
+        self.assertEqual(second.headers['Last-Modified'],
+                         first.headers['Last-Modified'])
+
+    def test_files_deleted_behind_its_back_are_rendered_again(self):
+        first = self.client.get(self.request_path)
+        fp = join(self.app.img_cache.cache_root, unquote(self.test_jpeg_id),
+                  'full/360,/0/default.jpg')
+        os.unlink(fp)
+        second = self.client.get(self.request_path)
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.data, first.data)
+        self.assertTrue(exists(fp))
+
+
+class TestMemoryImageCache(object):
+
+    def _request(self, size):
+        return img.ImageRequest('id', 'full', size, '0', 'default', 'jpg')
+
+    def test_least_recently_used_are_dropped(self):
+        cache = img.MemoryImageCache(max_size=30, max_file_size=10)
+        for size in ('1,', '2,', '3,'):
+            cache.put(self._request(size), b'x' * 10, None, 'image/jpeg')
+        assert cache.get(self._request('1,')) is not None
+        cache.put(self._request('4,'), b'x' * 10, None, 'image/jpeg')
+        assert self._request('1,') in cache
+        assert self._request('2,') not in cache
+        assert cache.size == 30
+
+    def test_large_images_are_not_held(self):
+        cache = img.MemoryImageCache(max_size=30, max_file_size=10)
+        cache.put(self._request('1,'), b'x' * 11, None, 'image/jpeg')
+        assert len(cache) == 0
+
+    def test_replacing_an_entry_keeps_the_size(self):
+        cache = img.MemoryImageCache(max_size=30, max_file_size=10)
+        cache.put(self._request('1,'), b'x' * 10, None, 'image/jpeg')
+        cache.put(self._request('1,'), b'x' * 5, None, 'image/jpeg')
+        assert cache.size == 5
+        assert cache.get(self._request('1,')).data == b'x' * 5
+
+    def test_counts_hits_and_misses(self):
+        cache = img.MemoryImageCache(max_size=30)
+        cache.put(self._request('1,'), b'x', None, 'image/jpeg')
+        cache.get(self._request('1,'))
+        cache.get(self._request('1,'))
+        cache.get(self._request('2,'))
+        assert (cache.hits, cache.misses) == (2, 1)
+
+    def test_from_config(self):
+        assert img.MemoryImageCache.from_config({}) is None
+        cache = img.MemoryImageCache.from_config({
+            'memory_cache_size': 1000, 'memory_cache_max_file_size': 100
+        })
+        assert (cache.max_size, cache.max_file_size) == (1000, 100)
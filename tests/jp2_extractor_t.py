@@ -5,11 +5,22 @@ try:
 except ImportError:  # Python 2
     from StringIO import StringIO as BytesIO
 
+import os
+import struct
+
 from hypothesis import given
 from hypothesis.strategies import binary
 import pytest
 
-from loris.jp2_extractor import Dimensions, JP2Extractor, JP2ExtractionError
+from loris.img_info import ImageInfo
+from loris.jp2_extractor import (
+    Dimensions, JP2Extractor, JP2ExtractionError, JP2HeaderReader,
+    JP2TruncatedError, _read_jp2_until_match
+)
+
+GRAY_JP2 = os.path.join(
+    os.path.dirname(__file__), 'img', '01', '02', 'gray.jp2'
+)
 
 
 @pytest.fixture
@@ -298,3 +309,45 @@ class TestJP2Extractor(object):
         jp2 = BytesIO(b'\xFF\x51' + b'\x00' * 20 + xtsiz_ytsiz)
         dimensions = extractor._parse_siz_marker_segment(jp2)
         assert dimensions == expected_dimensions
+
+
+def _with_box_after_file_type_box(data, box_type, contents):
+    # The Signature box is 12 bytes, and the File Type box follows it.
+    ftyp_end = 12 + struct.unpack('>I', data[12:16])[0]
+    box = struct.pack('>I4s', 8 + len(contents), box_type) + contents
+    return data[:ftyp_end] + box + data[ftyp_end:]
+
+
+def _info(src):
+    # (JP2Extractor is a mixin, without attributes of its own)
+    return ImageInfo(src_format='jp2').from_image_file(['jpg'], src=src)
+
+
+class TestBoxScanning(object):
+
+    def test_match_across_blocks_is_found(self):
+        jp2 = BytesIO(b'abcdefgjp2hxyz')
+        _read_jp2_until_match(jp2, b'jp2h', block_size=4)
+        assert jp2.read(4) == b'jp2h'
+
+    def test_missing_match_is_error(self):
+        with pytest.raises(JP2ExtractionError):
+            _read_jp2_until_match(BytesIO(b'\x00' * 100), b'jp2h', block_size=8)
+
+    def test_missing_match_in_header_is_truncation(self):
+        with pytest.raises(JP2TruncatedError):
+            _read_jp2_until_match(JP2HeaderReader(b'\x00' * 100), b'jp2h')
+
+    def test_boxes_before_the_jp2_header_are_skipped(self):
+        with open(GRAY_JP2, 'rb') as f:
+            data = f.read()
+        # An XML box that would fool a search for the box types and markers.
+        xml = b'<x>jp2h colr \xFF\x51 \xFF\x52</x>' * 10000
+        info = _info(BytesIO(_with_box_after_file_type_box(data, b'xml ', xml)))
+        assert info.to_iiif_json() == _info(BytesIO(data)).to_iiif_json()
+
+    def test_truncated_header_is_truncation(self):
+        with open(GRAY_JP2, 'rb') as f:
+            data = f.read()
+        with pytest.raises(JP2TruncatedError):
+            _info(JP2HeaderReader(data[:100]))
@@ -8,6 +8,11 @@ from os.path import isfile
 from os.path import join
 from os.path import realpath
 from os.path import exists
+from os import listdir
+import os
+import shutil
+import threading
+from time import sleep, time
 import unittest
 
 try:
@@ -15,17 +20,25 @@ try:
 except ImportError:  # Python 2
     from urllib import quote_plus, unquote
 
+import mock
 import pytest
 import responses
 
+from loris.img_info import ImageInfo
+from loris.jp2_extractor import JP2HeaderReader
 from loris.loris_exception import ResolverException
 from loris.resolver import (
     _AbstractResolver,
+    MemoizingResolver,
+    NotFoundCache,
+    PreferredSuffixResolver,
     SimpleHTTPResolver,
     TemplateHTTPResolver,
     SourceImageCachingResolver,
     SimpleFSResolver
 )
+from loris.source_index import SourceIndex
+from loris.utils import lock_file, lock_file_path, mkdir_p
 from tests import loris_t
 
 
@@ -66,6 +79,66 @@ class Test_AbstractResolver(unittest.TestCase):
             resolver.resolve(app=None, ident='001.jpg', base_uri='example.org')
 
 
+class TestNotFoundCache(object):
+
+    def test_remembers_for_the_ttl(self):
+        cache = NotFoundCache(ttl=10)
+        assert 'a' not in cache
+        cache.add('a')
+        assert 'a' in cache
+        with mock.patch('loris.resolver.time.time', return_value=time() + 11):
+            assert 'a' not in cache
+        assert len(cache) == 0
+
+    def test_forgets_the_oldest_beyond_max_size(self):
+        cache = NotFoundCache(ttl=60, max_size=2)
+        for ident in ('a', 'b', 'c'):
+            cache.add(ident)
+        assert 'a' not in cache
+        assert 'b' in cache and 'c' in cache
+
+    def test_discard(self):
+        cache = NotFoundCache(ttl=60)
+        cache.add('a')
+        cache.discard('a')
+        cache.discard('b')
+        assert 'a' not in cache
+
+    def test_hit_rate(self):
+        cache = NotFoundCache(ttl=60)
+        assert cache.hit_rate == 0.0
+        cache.add('a')
+        'a' in cache
+        'a' in cache
+        'a' in cache
+        'b' in cache
+        assert (cache.hits, cache.misses) == (3, 1)
+        assert cache.hit_rate == 0.75
+
+    def test_zero_ttl_is_off(self):
+        cache = NotFoundCache(ttl=0)
+        cache.add('a')
+        assert 'a' not in cache
+
+    def test_off_by_default(self):
+        cache = NotFoundCache.from_config({})
+        cache.add('a')
+        assert 'a' not in cache
+
+    def test_touching_the_reset_file_forgets_everything(self, tmpdir):
+        reset_fp = tmpdir.join('ingested')
+        reset_fp.write('')
+        cache = NotFoundCache(ttl=60, reset_fp=str(reset_fp))
+        cache.add('a')
+        cache._reset_checked = 0
+        assert 'a' in cache
+
+        reset_fp.setmtime(reset_fp.mtime() + 5)
+        assert 'a' in cache  # (not looked at again within a second)
+        cache._reset_checked = 0
+        assert 'a' not in cache
+
+
 class Test_SimpleFSResolver(loris_t.LorisTest):
 
     def test_configured_resolver(self):
@@ -102,6 +175,27 @@ class Test_SimpleFSResolver(loris_t.LorisTest):
         resolver = SimpleFSResolver(config=config)
         assert not resolver.is_resolvable(ident='doesnotexist.jpg')
 
+    def test_unresolvable_idents_are_remembered(self):
+        resolver = SimpleFSResolver(config={
+            'src_img_root': self.test_img_dir, 'not_found_ttl': 60
+        })
+        with mock.patch('loris.resolver.exists', return_value=False) as exists:
+            assert not resolver.is_resolvable(ident='new.jpg')
+            with pytest.raises(ResolverException):
+                resolver.resolve(app=None, ident='new.jpg', base_uri='')
+        assert exists.call_count == 1
+
+    def test_forget_not_found(self):
+        resolver = SimpleFSResolver(config={
+            'src_img_root': self.test_img_dir, 'not_found_ttl': 60
+        })
+        ident = quote_plus(unquote(self.test_jpeg_id))
+        with mock.patch('loris.resolver.exists', return_value=False):
+            assert not resolver.is_resolvable(ident=ident)
+        assert not resolver.is_resolvable(ident=ident)
+        resolver.forget_not_found(ident)
+        assert resolver.is_resolvable(ident=ident)
+
 
 class Test_SourceImageCachingResolver(loris_t.LorisTest):
 
@@ -140,6 +234,175 @@ class Test_SourceImageCachingResolver(loris_t.LorisTest):
         resolver = SourceImageCachingResolver(config=config)
         assert not resolver.is_resolvable(ident='doesnotexist.jp2')
 
+    def test_unresolvable_idents_are_remembered(self):
+        config = {
+            'source_root' : '/var/loris/src',
+            'cache_root' : '/var/loris/cache',
+            'not_found_ttl': 60,
+        }
+        resolver = SourceImageCachingResolver(config=config)
+        with mock.patch('loris.resolver.exists', return_value=False) as exists:
+            for _ in range(3):
+                assert not resolver.is_resolvable(ident='doesnotexist.jp2')
+        assert exists.call_count == 1
+        assert resolver.not_found.hits == 2
+
+
+class Test_MemoizingResolver(loris_t.LorisTest):
+
+    def _resolver(self, **config):
+        config.setdefault('memoized_impl', 'loris.resolver.SimpleFSResolver')
+        config.setdefault('src_img_root', self.test_img_dir)
+        return MemoizingResolver(config)
+
+    def test_second_resolve_is_memoized(self):
+        resolver = self._resolver()
+        ii = resolver.resolve(self.app, self.test_jpeg_id, 'http://example.org/a')
+        with mock.patch.object(resolver.resolver, 'resolve') as resolve:
+            ii2 = resolver.resolve(self.app, self.test_jpeg_id, 'http://example.org/b')
+            assert resolver.is_resolvable(self.test_jpeg_id)
+        assert not resolve.called
+        assert ii2.src_img_fp == ii.src_img_fp == self.test_jpeg_fp
+        assert ii2.src_format == 'jpg'
+        assert ii2.ident == 'http://example.org/b'
+        assert (ii2.width, ii2.height) == self.test_jpeg_dims
+        assert resolver.hits == 2
+
+    def test_changed_source_is_resolved_again(self):
+        mkdir_p(self.app.tmp_dp)
+        fp = join(self.app.tmp_dp, 'changing.jpg')
+        shutil.copy(self.test_jpeg_fp, fp)
+        resolver = self._resolver(src_img_root=self.app.tmp_dp)
+        resolver.resolve(self.app, 'changing.jpg', '')
+        mtime = os.stat(fp).st_mtime
+        os.utime(fp, (mtime + 10, mtime + 10))
+        with mock.patch.object(resolver.resolver, 'resolve',
+                wraps=resolver.resolver.resolve) as resolve:
+            resolver.resolve(self.app, 'changing.jpg', '')
+            resolver.resolve(self.app, 'changing.jpg', '')
+        assert resolve.call_count == 1
+
+    def test_entries_expire(self):
+        resolver = self._resolver(memo_ttl=60)
+        resolver.resolve(self.app, self.test_jpeg_id, '')
+        with mock.patch('loris.resolver.time.time', return_value=time() + 61):
+            with mock.patch.object(resolver.resolver, 'resolve',
+                    wraps=resolver.resolver.resolve) as resolve:
+                resolver.resolve(self.app, self.test_jpeg_id, '')
+        assert resolve.call_count == 1
+
+    def test_least_recently_used_are_forgotten(self):
+        resolver = self._resolver(memo_max_size=1)
+        resolver.resolve(self.app, self.test_jpeg_id, '')
+        resolver.resolve(self.app, self.test_png_id, '')
+        assert len(resolver) == 1
+        assert not resolver.is_resolvable('doesnotexist.jpg')
+
+    def test_not_found_is_shared_with_the_wrapped_resolver(self):
+        resolver = self._resolver(not_found_ttl=60)
+        assert not resolver.is_resolvable('doesnotexist.jpg')
+        assert 'doesnotexist.jpg' in resolver.resolver.not_found
+        resolver.forget_not_found('doesnotexist.jpg')
+        assert 'doesnotexist.jpg' not in resolver.not_found
+        with pytest.raises(ResolverException):
+            resolver.resolve(self.app, 'doesnotexist.jpg', '')
+
+    def test_zero_ttl_turns_it_off(self):
+        resolver = self._resolver(memo_ttl=0)
+        resolver.resolve(self.app, self.test_jpeg_id, '')
+        assert len(resolver) == 0
+
+
+class TestSourceIndexLookups(object):
+
+    @pytest.fixture
+    def roots(self, tmpdir):
+        tmpdir.ensure('src', 'a', 'only_src.tif')
+        tmpdir.ensure('fallback', 'a', 'only_src.jp2')
+        tmpdir.ensure('fallback', 'a', 'only_fallback.jp2')
+        return (str(tmpdir.join('src')), str(tmpdir.join('fallback')))
+
+    @pytest.fixture
+    def index_fp(self, tmpdir, roots):
+        index_fp = str(tmpdir.join('sources.sqlite'))
+        for root in roots:
+            SourceIndex(index_fp).update(root)
+        return index_fp
+
+    def test_fs_resolver_looks_in_the_index(self, roots, index_fp):
+        resolver = SimpleFSResolver({
+            'src_img_roots': list(roots), 'source_index_fp': index_fp
+        })
+        expected = join(roots[0], 'a', 'only_src.tif')
+        with mock.patch('loris.resolver.exists') as exists:
+            assert resolver.source_file_path('a%2Fonly_src.tif') == expected
+        assert not exists.called
+
+    def test_fs_resolver_only_looks_in_roots_before_an_indexed_file(self, roots, index_fp):
+        resolver = SimpleFSResolver({
+            'src_img_roots': list(roots), 'source_index_fp': index_fp
+        })
+        expected = join(roots[1], 'a', 'only_fallback.jp2')
+        with mock.patch('loris.resolver.exists', return_value=False) as exists:
+            assert resolver.source_file_path('a%2Fonly_fallback.jp2') == expected
+        exists.assert_called_once_with(join(roots[0], 'a', 'only_fallback.jp2'))
+
+    def test_fs_resolver_prefers_new_files_in_earlier_roots(self, tmpdir, roots, index_fp):
+        tmpdir.ensure('src', 'a', 'only_fallback.jp2')
+        resolver = SimpleFSResolver({
+            'src_img_roots': list(roots), 'source_index_fp': index_fp
+        })
+        assert resolver.source_file_path('a%2Fonly_fallback.jp2') == \
+            join(roots[0], 'a', 'only_fallback.jp2')
+        assert resolver.source_index.find([join(roots[0], 'a', 'only_fallback.jp2')])
+
+    def test_fs_resolver_adds_what_the_index_missed(self, tmpdir, roots, index_fp):
+        tmpdir.ensure('src', 'new.jp2')
+        resolver = SimpleFSResolver({
+            'src_img_roots': list(roots), 'source_index_fp': index_fp
+        })
+        assert resolver.is_resolvable('new.jp2')
+        assert resolver.source_index.find([join(roots[0], 'new.jp2')])
+
+    def _suffix_resolver(self, tmpdir, roots, index_fp):
+        return PreferredSuffixResolver({
+            'source_root': roots[0], 'source_suffix': '.tif',
+            'fallback_root': roots[1], 'fallback_suffix': '.jp*',
+            'cache_root': str(tmpdir.join('cache')),
+            'source_index_fp': index_fp,
+        })
+
+    def test_suffix_resolver_globs_the_index(self, tmpdir, roots, index_fp):
+        resolver = self._suffix_resolver(tmpdir, roots, index_fp)
+        with mock.patch('glob.glob') as glob:
+            assert resolver.source_file_path('a/only_src') == \
+                join(roots[0], 'a', 'only_src.tif')
+        assert not glob.called
+
+    def test_suffix_resolver_globs_the_source_root_before_an_indexed_fallback(
+            self, tmpdir, roots, index_fp):
+        resolver = self._suffix_resolver(tmpdir, roots, index_fp)
+        with mock.patch('glob.glob', return_value=[]) as glob:
+            assert resolver.source_file_path('a/only_fallback') == \
+                join(roots[1], 'a', 'only_fallback.jp2')
+            assert resolver.format_from_ident('a/only_fallback') == 'jp2'
+        assert [c[0][0] for c in glob.call_args_list] == \
+            [join(roots[0], 'a', 'only_fallback.tif')] * 2
+
+    def test_suffix_resolver_prefers_new_files_in_the_source_root(
+            self, tmpdir, roots, index_fp):
+        tmpdir.ensure('src', 'a', 'only_fallback.tif')
+        resolver = self._suffix_resolver(tmpdir, roots, index_fp)
+        assert resolver.source_file_path('a/only_fallback') == \
+            join(roots[0], 'a', 'only_fallback.tif')
+
+    def test_suffix_resolver_globs_on_a_miss(self, tmpdir, roots, index_fp):
+        tmpdir.ensure('fallback', 'new.jpx')
+        resolver = self._suffix_resolver(tmpdir, roots, index_fp)
+        assert resolver.source_file_path('new') == join(roots[1], 'new.jpx')
+        assert resolver.source_index.glob(join(roots[1], 'new.*'))
+        assert resolver.source_file_path('missing') == ''
+
 
 @pytest.fixture
 def mock_responses():
@@ -386,10 +649,10 @@ class TestSimpleHTTPResolver(object):
         ('0004', False),
         ('doesnotexist.png', False),
     ])
-    def test_is_resolvable(self, mock_responses,
+    def test_is_resolvable(self, mock_responses, tmpdir,
                            head_resolvable, ident, expected_resolvable):
         config = {
-            'cache_root': '/var/cache/loris',
+            'cache_root': str(tmpdir),
             'source_prefix': 'http://sample.sample/',
             'uri_resolvable': True,
             'head_resolvable': head_resolvable,
@@ -414,9 +677,9 @@ class TestSimpleHTTPResolver(object):
         ('\d+', '0001', True),
         ('\d+Z', '0001', False),
     ])
-    def test_ident_regex_blocks_based_on_ident(self, mock_responses, ident_regex, ident, expected_resolvable):
+    def test_ident_regex_blocks_based_on_ident(self, mock_responses, tmpdir, ident_regex, ident, expected_resolvable):
         config = {
-            'cache_root': '/var/cache/loris',
+            'cache_root': str(tmpdir),
             'source_prefix': 'http://sample.sample/',
             'ident_regex': ident_regex,
         }
@@ -424,6 +687,379 @@ class TestSimpleHTTPResolver(object):
         assert resolver.is_resolvable(ident=ident) == expected_resolvable
 
 
+    def test_requests_share_a_pooled_session(self):
+        config = {
+            'cache_root': '/var/cache/loris',
+            'source_prefix': 'http://sample.sample/',
+            'pool_size': 4,
+            'retries': 2,
+        }
+        resolver = SimpleHTTPResolver(config=config)
+        adapter = resolver.session.get_adapter('https://sample.sample/0001')
+        assert adapter._pool_maxsize == 4
+        assert adapter.max_retries.total == 2
+        assert 503 in adapter.max_retries.status_forcelist
+
+    @pytest.mark.parametrize('config, expected_timeout', [
+        ({}, (10, 60)),
+        ({'connect_timeout': 1, 'read_timeout': 2}, (1, 2)),
+    ])
+    def test_requests_have_timeouts(self, tmpdir, config, expected_timeout):
+        config.update({
+            'cache_root': str(tmpdir),
+            'source_prefix': 'http://sample.sample/',
+            'head_resolvable': True,
+        })
+        resolver = SimpleHTTPResolver(config=config)
+        with mock.patch.object(resolver.session, 'request') as request:
+            request.return_value.ok = True
+            request.return_value.status_code = 200
+            assert resolver.is_resolvable(ident='0001')
+        request.assert_called_once_with(
+            'HEAD', 'http://sample.sample/0001',
+            timeout=expected_timeout, verify=True
+        )
+
+    @responses.activate
+    def test_is_resolvable_fills_the_cache(self, mock_responses, tmpdir):
+        config = {
+            'cache_root': str(tmpdir),
+            'source_prefix': 'http://sample.sample/',
+        }
+        resolver = SimpleHTTPResolver(config=config)
+        assert resolver.is_resolvable(ident='0001')
+        image_calls = [c for c in responses.calls if c.request.url.endswith('0001')]
+        assert len(image_calls) == 1
+
+        calls = len(responses.calls)
+        ii = resolver.resolve(app=None, ident='0001', base_uri='')
+        assert isfile(ii.src_img_fp)
+        assert len(responses.calls) == calls
+
+    @responses.activate
+    @pytest.mark.parametrize('head_resolvable', [True, False])
+    def test_not_found_is_remembered(self, mock_responses, tmpdir, head_resolvable):
+        responses.add(
+            responses.HEAD, 'http://sample.sample/DOESNOTEXIST', status=404
+        )
+        config = {
+            'cache_root': str(tmpdir),
+            'source_prefix': 'http://sample.sample/',
+            'head_resolvable': head_resolvable,
+            'not_found_ttl': 60,
+        }
+        resolver = SimpleHTTPResolver(config=config)
+        assert not resolver.is_resolvable(ident='DOESNOTEXIST')
+        assert not resolver.is_resolvable(ident='DOESNOTEXIST')
+        with pytest.raises(ResolverException):
+            resolver.resolve(app=None, ident='DOESNOTEXIST', base_uri='')
+        assert len(responses.calls) == 1
+        # (nothing cached, though there may be a lock file)
+        assert set(listdir(str(tmpdir))) <= {'.locks'}
+
+    @responses.activate
+    def test_not_found_is_forgotten_after_the_ttl(self, mock_responses, tmpdir):
+        config = {
+            'cache_root': str(tmpdir),
+            'source_prefix': 'http://sample.sample/',
+            'not_found_ttl': 10,
+        }
+        resolver = SimpleHTTPResolver(config=config)
+        assert not resolver.is_resolvable(ident='DOESNOTEXIST')
+        with mock.patch('loris.resolver.time.time', return_value=time() + 11):
+            assert not resolver.is_resolvable(ident='DOESNOTEXIST')
+        assert len(responses.calls) == 2
+
+    @responses.activate
+    @pytest.mark.parametrize('status, remembered', [
+        (404, True), (410, True), (401, False), (403, False), (429, False),
+    ])
+    def test_only_missing_sources_are_remembered(self, tmpdir, status, remembered):
+        responses.add(responses.GET, 'http://sample.sample/0001', status=status)
+        config = {
+            'cache_root': str(tmpdir),
+            'source_prefix': 'http://sample.sample/',
+            'not_found_ttl': 60,
+        }
+        resolver = SimpleHTTPResolver(config=config)
+        assert not resolver.is_resolvable(ident='0001')
+        assert ('0001' in resolver.not_found) == remembered
+
+    @responses.activate
+    def test_rules_are_fetched_with_the_same_options(self, tmpdir):
+        responses.add(
+            responses.GET, 'http://sample.sample/0001.tif',
+            body=b'not really a tiff', status=200, content_type='image/tiff'
+        )
+        responses.add(
+            responses.GET, 'http://sample.sample/0001.rules.json',
+            body='{"a": 1}', status=200, content_type='application/json'
+        )
+        config = {
+            'cache_root': str(tmpdir),
+            'source_prefix': 'http://sample.sample/',
+            'user': 'loris',
+            'pw': 'l3mur',
+        }
+        resolver = SimpleHTTPResolver(config=config)
+        local_fp = resolver.copy_to_cache('0001.tif')
+        rules_fp = join(dirname(local_fp), 'loris_cache.rules.json')
+        with open(rules_fp) as f:
+            assert f.read() == '{"a": 1}'
+        assert 'Authorization' in responses.calls[-1].request.headers
+
+
+    def _serve(self, body, ranges=True, etag=None, strict_if_range=False,
+               ignore_ranges=False):
+        def callback(request):
+            headers = {'Content-Type': 'image/tiff'}
+            if ranges:
+                headers['Accept-Ranges'] = 'bytes'
+            if etag is not None:
+                headers['ETag'] = etag
+            byte_range = request.headers.get('Range')
+            if_range = request.headers.get('If-Range')
+            # As servers must, send the whole file for an If-Range with a
+            # weak ETag.
+            honour_range = ranges and not ignore_ranges and not (
+                if_range and strict_if_range and if_range.startswith('W/')
+            )
+            if byte_range and honour_range:
+                start, end = map(int, byte_range.split('=')[1].split('-'))
+                headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, len(body))
+                return (206, headers, body[start:end + 1])
+            headers['Content-Length'] = str(len(body))
+            return (200, headers, body)
+        responses.add_callback(
+            responses.GET, 'http://sample.sample/0001.tif', callback=callback
+        )
+
+    def _resolver(self, tmpdir, **config):
+        config.update({
+            'cache_root': str(tmpdir),
+            'source_prefix': 'http://sample.sample/',
+            'range_min_size': 100,
+            'chunk_size': 64,
+        })
+        return SimpleHTTPResolver(config=config)
+
+    @responses.activate
+    def test_large_sources_are_fetched_in_ranges(self, tmpdir):
+        body = bytes(bytearray(i % 251 for i in range(1000)))
+        self._serve(body)
+        resolver = self._resolver(tmpdir, range_parts=4)
+        with open(resolver.copy_to_cache('0001.tif'), 'rb') as f:
+            assert f.read() == body
+        assert sorted(
+            c.request.headers.get('Range', '') for c in responses.calls
+            if c.request.url.endswith('.tif')
+        ) == ['', 'bytes=250-499', 'bytes=500-749', 'bytes=750-999']
+
+    @responses.activate
+    def test_weak_etags_are_not_sent_as_if_range(self, tmpdir):
+        body = bytes(bytearray(i % 251 for i in range(1000)))
+        self._serve(body, etag='W/"abc"', strict_if_range=True)
+        resolver = self._resolver(tmpdir, range_parts=4)
+        with open(resolver.copy_to_cache('0001.tif'), 'rb') as f:
+            assert f.read() == body
+        assert all('If-Range' not in c.request.headers for c in responses.calls)
+
+    @responses.activate
+    def test_strong_etags_are_sent_as_if_range(self, tmpdir):
+        body = b'x' * 1000
+        self._serve(body, etag='"abc"')
+        resolver = self._resolver(tmpdir, range_parts=4)
+        resolver.copy_to_cache('0001.tif')
+        assert [
+            c.request.headers.get('If-Range') for c in responses.calls
+            if 'Range' in c.request.headers
+        ] == ['"abc"'] * 3
+
+    @responses.activate
+    def test_ignored_ranges_are_fetched_sequentially(self, tmpdir):
+        body = bytes(bytearray(i % 251 for i in range(1000)))
+        self._serve(body, ignore_ranges=True)
+        resolver = self._resolver(tmpdir, range_parts=4)
+        with open(resolver.copy_to_cache('0001.tif'), 'rb') as f:
+            assert f.read() == body
+
+    @responses.activate
+    def test_small_sources_are_fetched_whole(self, tmpdir):
+        self._serve(b'x' * 99)
+        resolver = self._resolver(tmpdir, range_parts=4)
+        with open(resolver.copy_to_cache('0001.tif'), 'rb') as f:
+            assert f.read() == b'x' * 99
+        assert len(responses.calls) == 2  # (and the rules file)
+
+    @responses.activate
+    def test_failed_ranges_leave_nothing_behind(self, tmpdir):
+        self._serve(b'x' * 1000)
+        resolver = self._resolver(tmpdir)
+        with mock.patch('loris.resolver._copy_range', side_effect=[
+            None, None, None, ResolverException('short'),
+        ]):
+            with pytest.raises(ResolverException):
+                resolver.copy_to_cache('0001.tif')
+        cache_dir = resolver.cache_dir_path('0001.tif')
+        assert listdir(cache_dir) == []
+
+
+class Test_JP2HeaderFetch(loris_t.LorisTest):
+
+    url = 'http://sample.sample/gray.jp2'
+
+    def setUp(self):
+        super(Test_JP2HeaderFetch, self).setUp()
+        with open(self.test_jp2_gray_fp, 'rb') as f:
+            self.body = f.read()
+        self.resolver = SimpleHTTPResolver({
+            'cache_root': self.SRC_IMAGE_CACHE,
+            'source_prefix': 'http://sample.sample/',
+            'jp2_header_fetch': True,
+            'jp2_header_size': 64,
+        })
+
+    def _serve(self, ranges=True, before_whole_file=None):
+        def callback(request):
+            headers = {'Content-Type': 'image/jp2'}
+            byte_range = request.headers.get('Range')
+            if byte_range and ranges:
+                start, end = map(int, byte_range.split('=')[1].split('-'))
+                end = min(end, len(self.body) - 1)
+                headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, len(self.body))
+                return (206, headers, self.body[start:end + 1])
+            if before_whole_file is not None:
+                before_whole_file()
+            return (200, headers, self.body)
+        responses.add_callback(responses.GET, self.url, callback=callback)
+
+    def _fetched(self):
+        return [c.request.headers.get('Range') for c in responses.calls
+                if c.request.url == self.url]
+
+    @responses.activate
+    def test_info_comes_from_the_header(self):
+        self._serve()
+        info = self.resolver.resolve(self.app, 'gray.jp2', 'http://example.org/gray')
+        expected = ImageInfo(self.app, 'http://example.org/gray',
+                             self.test_jp2_gray_fp, 'jp2')
+        self.assertEqual(info.to_iiif_json(), expected.to_iiif_json())
+        self.assertFalse(exists(info.src_img_fp))
+        # (grown until the header was all there)
+        self.assertEqual(self._fetched(), ['bytes=0-63', 'bytes=64-127', 'bytes=128-255'])
+
+    @responses.activate
+    def test_fetch_source_gets_the_rest(self):
+        self._serve()
+        info = self.resolver.resolve(self.app, 'gray.jp2', '')
+        self.resolver.fetch_source(info)
+        with open(info.src_img_fp, 'rb') as f:
+            self.assertEqual(f.read(), self.body)
+        self.assertEqual(self._fetched()[-1], None)
+        self.assertEqual(
+            self.resolver.resolve(self.app, 'gray.jp2', '').src_img_fp,
+            info.src_img_fp
+        )
+
+    @responses.activate
+    def test_the_header_is_parsed_once_per_range(self):
+        self._serve()
+        with mock.patch('loris.resolver.JP2HeaderReader',
+                        wraps=JP2HeaderReader) as reader:
+            self.resolver.resolve(self.app, 'gray.jp2', '')
+        self.assertEqual(reader.call_count, 3)
+
+    @responses.activate
+    def test_fetch_source_of_a_cleaned_source_is_error(self):
+        self._serve()
+        info = self.resolver.resolve(self.app, 'gray.jp2', '')
+        self.resolver.fetch_source(info)
+        shutil.rmtree(dirname(info.src_img_fp))
+        with pytest.raises(ResolverException):
+            self.resolver.fetch_source(info)
+
+    @responses.activate
+    def test_concurrent_fetches_of_a_source_download_it_once(self):
+        downloading = threading.Event()
+        release = threading.Event()
+
+        def wait_for_release():
+            downloading.set()
+            release.wait(5)
+
+        self._serve(before_whole_file=wait_for_release)
+        info = self.resolver.resolve(self.app, 'gray.jp2', '')
+        fetchers = [
+            threading.Thread(target=self.resolver.fetch_source, args=(info,))
+            for _ in range(4)
+        ]
+        for fetcher in fetchers:
+            fetcher.start()
+        downloading.wait(5)
+        sleep(0.2)  # (for the others to reach the lock)
+        release.set()
+        for fetcher in fetchers:
+            fetcher.join()
+        self.assertEqual(self._fetched().count(None), 1)
+        with open(info.src_img_fp, 'rb') as f:
+            self.assertEqual(f.read(), self.body)
+
+    @responses.activate
+    def test_fetch_source_waits_for_another_process_to_download_it(self):
+        self._serve()
+        info = self.resolver.resolve(self.app, 'gray.jp2', '')
+        lock_fp = lock_file_path(join(self.SRC_IMAGE_CACHE, '.locks'), 'gray.jp2')
+        # (as another process downloading it would)
+        with lock_file(lock_fp):
+            fetcher = threading.Thread(
+                target=self.resolver.fetch_source, args=(info,)
+            )
+            fetcher.start()
+            fetcher.join(0.2)
+            self.assertTrue(fetcher.is_alive())
+            shutil.copy(self.test_jp2_gray_fp, info.src_img_fp)
+        fetcher.join()
+        self.assertEqual(self._fetched().count(None), 0)
+
+    @responses.activate
+    def test_is_resolvable_fetches_just_the_first_byte(self):
+        self._serve()
+        self.assertTrue(self.resolver.is_resolvable('gray.jp2'))
+        self.assertEqual(self._fetched(), ['bytes=0-0'])
+        self.assertIsNone(self.resolver.cached_file_for_ident('gray.jp2'))
+
+    @responses.activate
+    def test_without_ranges_the_whole_file_is_fetched(self):
+        self._serve(ranges=False)
+        info = self.resolver.resolve(self.app, 'gray.jp2', '')
+        self.assertTrue(exists(info.src_img_fp))
+        self.assertEqual(info.width, self.test_jp2_gray_dims[0])
+
+    @responses.activate
+    def test_images_are_rendered_from_the_whole_file(self):
+        self._serve()
+        self.app.resolver = self.resolver
+        resp = self.client.get('/gray.jp2/info.json')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self._fetched(), ['bytes=0-63', 'bytes=64-127', 'bytes=128-255'])
+        resp = self.client.get('/gray.jp2/full/pct:5/0/default.jpg')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self._fetched().count(None), 1)
+
+    @responses.activate
+    def test_images_are_rendered_after_the_source_is_cleaned(self):
+        self._serve()
+        self.app.resolver = self.resolver
+        resp = self.client.get('/gray.jp2/full/pct:5/0/default.jpg')
+        self.assertEqual(resp.status_code, 200)
+        # (as the cache cleaner would, leaving the info in the info cache)
+        shutil.rmtree(self.resolver.cache_dir_path('gray.jp2'))
+        shutil.rmtree(self.app.img_cache.cache_root)
+        resp = self.client.get('/gray.jp2/full/pct:5/0/default.jpg')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self._fetched().count(None), 2)
+
+
 class Test_TemplateHTTPResolver(object):
 
     config = {
@@ -525,6 +1161,16 @@ class Test_TemplateHTTPResolver(object):
         ('sample:0004', False),
         ('doesnotmatchatemplate', False),
     ])
-    def test_is_resolvable(self, mock_responses, ident, expected_resolvable):
-        resolver = TemplateHTTPResolver(self.config)
+    def test_is_resolvable(self, mock_responses, tmpdir, ident, expected_resolvable):
+        config = dict(self.config, cache_root=str(tmpdir))
+        resolver = TemplateHTTPResolver(config)
         assert resolver.is_resolvable(ident=ident) == expected_resolvable
+
+    def test_templates_can_override_timeouts(self):
+        new_config = copy.deepcopy(self.config)
+        new_config['a']['read_timeout'] = 300
+        resolver = TemplateHTTPResolver(new_config)
+        _, options = resolver._web_request_url('a:id1.jpg')
+        assert options['timeout'] == (10, 300)
+        _, options = resolver._web_request_url('b:id1.jpg')
+        assert 'timeout' not in options
@@ -0,0 +1,100 @@
+#-*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+from os.path import exists, join
+
+try:
+    from cStringIO import StringIO
+except ImportError:  # Python 3
+    from io import StringIO
+
+from loris import img, img_info, seed
+from tests import loris_t
+
+
+def _info(width, height, tiles, sizes=None):
+    info = img_info.ImageInfo(None)
+    info.width = width
+    info.height = height
+    info.tiles = tiles
+    info.sizes = sizes or []
+    return info
+
+
+class TestTileRegions(object):
+
+    def test_enumerates_each_level_smallest_first(self):
+        info = _info(1000, 700, [{'width': 256, 'scaleFactors': [1, 2, 4]}])
+        levels = seed.tile_regions(info)
+        assert [scale for scale, _ in levels] == [4, 2, 1]
+        assert [len(regions) for _, regions in levels] == [1, 4, 12]
+
+    def test_edge_tiles_are_cut_short(self):
+        info = _info(1000, 700, [{'width': 256, 'scaleFactors': [2]}])
+        regions = dict(seed.tile_regions(info))[2]
+        assert regions == [
+            ('0,0,512,512', '256,'),
+            ('512,0,488,512', '244,'),
+            ('0,512,512,188', '256,'),
+            ('512,512,488,188', '244,'),
+        ]
+
+    def test_rectangular_tiles(self):
+        info = _info(1000, 700, [{'width': 500, 'height': 350, 'scaleFactors': [1]}])
+        regions = dict(seed.tile_regions(info))[1]
+        assert len(regions) == 4
+        assert regions[-1] == ('500,350,500,350', '500,')
+
+    def test_no_tiles(self):
+        assert seed.tile_regions(_info(1000, 700, [])) == []
+
+
+class TestCanonicalRequests(object):
+
+    def test_requests_are_canonical_and_unique(self):
+        info = _info(1000, 700, [])
+        requests = seed.canonical_requests(
+            'id', info,
+            [('0,0,1000,700', '250,'), ('full', '250,'), ('0,0,500,500', '500,')],
+            'default', 'jpg'
+        )
+        assert [r.request_path for r in requests] == [
+            'id/full/250,/0/default.jpg',
+            'id/0,0,500,500/500,/0/default.jpg',
+        ]
+
+
+class SeederTest(loris_t.LorisTest):
+
+    def _seed(self, idents):
+        progress = StringIO()
+        seeder = seed.Seeder(self.app.app_configs, processes=1, progress=progress)
+        return seeder.seed(idents)
+
+    def test_seeds_tiles_and_sizes(self):
+        totals = self._seed(['01/02/gray.jp2'])
+        assert totals['failed'] == 0
+        assert totals['rendered'] > 0
+
+        cache_dp = self.app.app_configs['img.ImageCache']['cache_dp']
+        for path in ('0,0,1024,1024/256,', '2048,3072,429,128/215,', 'full/78,'):
+            assert exists(join(cache_dp, '01/02/gray.jp2', path, '0/default.jpg')), path
+
+    def test_seeded_tiles_are_in_the_cache(self):
+        self._seed(['01/02/gray.jp2'])
+        image_request = img.ImageRequest(
+            self.test_jp2_gray_id, '0,0,1024,1024', '256,', '0', 'default', 'jpg'
+        )
+        assert image_request in self.app.img_cache
+
+    def test_second_run_resumes(self):
+        first = self._seed(['01/02/gray.jp2'])
+        second = self._seed(['01/02/gray.jp2'])
+        assert second['rendered'] == 0
+        assert second['cached'] == first['rendered']
+
+    def test_unresolvable_idents_are_counted(self):
+        totals = self._seed(['no/such/image.jp2'])
+        assert totals['unresolved'] == 1
+        assert totals['rendered'] == 0
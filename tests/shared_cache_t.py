@@ -0,0 +1,79 @@
+# -*- encoding: utf-8
+
+from __future__ import absolute_import
+
+import multiprocessing
+
+import pytest
+
+from loris.shared_cache import SharedCache, SEQUENCE
+
+
+@pytest.fixture
+def table(tmpdir):
+    return SharedCache(str(tmpdir.join('shared')), slots=16, slot_size=256)
+
+
+def _put_in_child(fp, key, value):
+    SharedCache(fp).put(key, value)
+
+
+class TestSharedCache(object):
+
+    def test_get_and_put(self, table):
+        assert table.get(b'a') is None
+        assert table.put(b'a', b'value of a')
+        assert table.get(b'a') == b'value of a'
+        assert table.put(b'a', b'new value')
+        assert table.get(b'a') == b'new value'
+
+    def test_values_too_big_for_a_slot_are_not_stored(self, table):
+        assert not table.put(b'a', b'x' * 256)
+        assert table.get(b'a') is None
+
+    def test_keys_in_the_same_slot_replace_each_other(self, table):
+        keys = [str(i).encode('ascii') for i in range(17)]
+        for key in keys:
+            table.put(key, key)
+        assert sum(1 for key in keys if table.get(key) == key) <= 16
+
+    def test_discard(self, table):
+        table.put(b'a', b'value of a')
+        table.discard(b'b')
+        assert table.get(b'a') == b'value of a'
+        table.discard(b'a')
+        assert table.get(b'a') is None
+
+    def test_slots_being_written_are_misses(self, table):
+        table.put(b'a', b'value of a')
+        offset = table._offset(b'a')
+        seq = SEQUENCE.unpack_from(table._map, offset)[0]
+        SEQUENCE.pack_into(table._map, offset, seq + 1)
+        assert table.get(b'a') is None
+
+        # and a writer that died part way through doesn't wedge the slot
+        table.put(b'a', b'value of a')
+        assert table.get(b'a') == b'value of a'
+
+    def test_is_shared_between_processes(self, table):
+        p = multiprocessing.Process(
+            target=_put_in_child, args=(table.fp, b'a', b'from the child')
+        )
+        p.start()
+        p.join()
+        assert table.get(b'a') == b'from the child'
+
+    def test_later_processes_use_the_layout_of_the_file(self, table):
+        table.put(b'a', b'value of a')
+        other = SharedCache(table.fp, slots=1024, slot_size=4096)
+        assert (other.slots, other.slot_size) == (16, 256)
+        assert other.get(b'a') == b'value of a'
+
+    def test_bad_files_are_replaced(self, tmpdir):
+        fp = str(tmpdir.join('shared'))
+        with open(fp, 'wb') as f:
+            f.write(b'not a table')
+        table = SharedCache(fp, slots=16, slot_size=256)
+        assert table.get(b'a') is None
+        table.put(b'a', b'value of a')
+        assert table.get(b'a') == b'value of a'
@@ -0,0 +1,138 @@
+# -*- encoding: utf-8
+
+from __future__ import absolute_import
+
+import os
+import sys
+
+import mock
+import pytest
+
+from loris import source_index
+from loris.source_index import SourceIndex
+
+
+@pytest.fixture
+def index(tmpdir):
+    return SourceIndex(str(tmpdir.join('index', 'sources.sqlite')))
+
+
+@pytest.fixture
+def root(tmpdir):
+    root = tmpdir.mkdir('images')
+    root.ensure('a', '1.jp2')
+    root.ensure('a', '1.tif')
+    root.ensure('a', 'b', '2.jp2')
+    root.ensure('3.jp2')
+    root.ensure('.hidden', '4.jp2')
+    return root
+
+
+def _can_encode(name):
+    try:
+        name.encode(sys.getfilesystemencoding() or 'ascii')
+        return True
+    except UnicodeEncodeError:
+        return False
+
+
+def _bump_mtime(dp):
+    # (a change within the filesystem's timestamp resolution might not show)
+    mtime = os.stat(str(dp)).st_mtime + 10
+    os.utime(str(dp), (mtime, mtime))
+
+
+class TestSourceIndex(object):
+
+    def test_update_indexes_the_tree(self, index, root):
+        assert index.update(str(root)) == (3, 4)
+        assert len(index) == 4
+        assert index.find([str(root.join('a', 'b', '2.jp2'))]) == \
+            str(root.join('a', 'b', '2.jp2'))
+        assert index.find([str(root.join('.hidden', '4.jp2'))]) is None
+
+    def test_find_returns_the_first_indexed(self, index, root):
+        index.update(str(root))
+        fps = [str(root.join('x', '1.jp2')), str(root.join('a', '1.jp2')),
+               str(root.join('3.jp2'))]
+        assert index.find(fps) == fps[1]
+
+    def test_files_that_have_gone_are_dropped(self, index, root):
+        index.update(str(root))
+        fp = str(root.join('3.jp2'))
+        os.remove(fp)
+        assert index.find([fp]) is None
+        assert len(index) == 3
+
+    def test_glob_does_not_cross_directories(self, index, root):
+        index.update(str(root))
+        assert index.glob(str(root.join('a', '1.*'))) == [
+            str(root.join('a', '1.jp2')), str(root.join('a', '1.tif'))
+        ]
+        assert index.glob(str(root.join('*.jp2'))) == [str(root.join('3.jp2'))]
+
+    def test_update_lists_only_changed_directories(self, index, root):
+        index.update(str(root))
+        assert index.update(str(root)) == (0, 0)
+
+        root.ensure('a', 'b', 'new.jp2')
+        _bump_mtime(root.join('a', 'b'))
+        with mock.patch('os.listdir', wraps=os.listdir) as listdir:
+            assert index.update(str(root)) == (1, 2)
+        listdir.assert_called_once_with(str(root.join('a', 'b')))
+        assert index.find([str(root.join('a', 'b', 'new.jp2'))])
+
+        assert index.update(str(root), full=True) == (3, 5)
+
+    def test_removed_directories_are_dropped(self, index, root):
+        index.update(str(root))
+        root.join('a').remove()
+        _bump_mtime(root)
+        index.update(str(root))
+        assert len(index) == 1
+        assert index.glob(str(root.join('a', '*', '*'))) == []
+
+    @pytest.mark.skipif(not _can_encode(u'\xe9'),
+                        reason='needs a filesystem encoding for non-ASCII names')
+    def test_non_ascii_paths(self, index, root):
+        root.ensure(u'\xe9', u'\xe9.jpg')
+        index.update(str(root))
+        fp = os.path.join(str(root), u'\xe9', u'\xe9.jpg')
+        assert index.find([fp]) == fp
+        assert index.glob(os.path.join(str(root), u'\xe9', u'*.jpg')) == [fp]
+
+    def test_add_and_discard(self, index, root):
+        fp = str(root.join('3.jp2'))
+        index.add(fp)
+        assert index.find([fp]) == fp
+        index.discard(fp)
+        assert len(index) == 0
+
+    def test_from_config(self, tmpdir):
+        assert SourceIndex.from_config({}) is None
+        fp = str(tmpdir.join('sources.sqlite'))
+        assert SourceIndex.from_config({'source_index_fp': fp}).db_fp == fp
+
+
+def test_main_indexes_the_resolver_roots(tmpdir, root):
+    config_fp = tmpdir.join('loris2.conf')
+    db_fp = tmpdir.join('sources.sqlite')
+    config_fp.write('\n'.join([
+        '[resolver]',
+        "impl = 'loris.resolver.MemoizingResolver'",
+        "memoized_impl = 'loris.resolver.SimpleFSResolver'",
+        "src_img_root = '%s'" % root,
+        "source_index_fp = '%s'" % db_fp,
+    ]))
+    assert source_index.main(['-c', str(config_fp)]) == 0
+    assert len(SourceIndex(str(db_fp))) == 4
+
+
+def test_main_needs_an_index(tmpdir, root):
+    config_fp = tmpdir.join('loris2.conf')
+    config_fp.write('\n'.join([
+        '[resolver]',
+        "impl = 'loris.resolver.SimpleFSResolver'",
+        "src_img_root = '%s'" % root,
+    ]))
+    assert source_index.main(['-c', str(config_fp)]) == 1
@@ -1,13 +1,19 @@
 #-*- coding: utf-8 -*-
 from __future__ import absolute_import
 
-import unittest
+import os
 import operator
+import threading
+import time
+import unittest
 
+import mock
 import pytest
+from PIL import Image, ImageChops, ImageFilter, ImageStat
 
-from loris import transforms
-from loris.loris_exception import ConfigError
+from loris import img, img_info, transforms
+from loris.loris_exception import ConfigError, TransformException
+from loris.utils import mkdir_p
 from loris.webapp import get_debug_config
 from tests import loris_t
 
@@ -68,6 +74,46 @@ class _ResizingTestMixin:
         assert image.height <= 180
 
 
+class _ReducedRegionTestMixin:
+    """
+    Tests that regions decoded at a reduced resolution match what we got
+    by decoding them at full resolution and downsampling.
+
+    Wavelet reduction and Lanczos resampling never agree exactly, so the
+    images are compared after a light blur.
+    """
+    reduced_region_requests = [
+        ('test_jp2_gray_id', '0,0,1024,1024/256,'),
+        ('test_jp2_gray_id', '2048,2048,429,1152/108,'),
+        ('test_jp2_gray_id', 'pct:10,10,50,50/200,'),
+        ('test_jp2_gray_id', '100,100,1500,1500/!300,300'),
+        ('test_jp2_with_embedded_profile_id', '200,200,400,400/100,'),
+    ]
+
+    def _request_without_caching(self, request_path):
+        config = get_debug_config(self.debug_config)
+        config['loris.Loris']['enable_caching'] = False
+        self.build_client_from_config(config)
+        return self.request_image_from_client(request_path).convert('L')
+
+    def test_reduced_regions_match_full_resolution_decode(self):
+        for ident_attr, params in self.reduced_region_requests:
+            ident = getattr(self, ident_attr)
+            request_path = '/%s/%s/0/default.png' % (ident, params)
+            reduced = self._request_without_caching(request_path)
+            with mock.patch.object(transforms._AbstractJP2Transformer,
+                                   '_scales_to_reduce_arg', return_value=None):
+                expected = self._request_without_caching(request_path)
+
+            assert reduced.size == expected.size, request_path
+            blur = ImageFilter.GaussianBlur(2)
+            diff = ImageChops.difference(
+                reduced.filter(blur), expected.filter(blur)
+            )
+            assert ImageStat.Stat(diff).mean[0] < 3, request_path
+            assert max(diff.getdata()) < 40, request_path
+
+
 class ExampleTransformer(transforms._AbstractTransformer):
     pass
 
@@ -106,6 +152,244 @@ class Test_AbstractTransformer(object):
         assert 'you need to install Pillow with LittleCMS support' in str(err.value)
 
 
+def _add(x, y):
+    return x + y
+
+
+def _get_pid():
+    return os.getpid()
+
+
+def _sleep(seconds):
+    time.sleep(seconds)
+
+
+def _sleep_and_return(seconds, value):
+    time.sleep(seconds)
+    return value
+
+
+def _pid_is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    # (a zombie hasn't been reaped yet, but isn't running)
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            return f.read().split(')')[-1].split()[0] != 'Z'
+    except IOError:
+        return False
+
+
+class TestDecoderPool(object):
+
+    def test_runs_jobs_in_a_worker(self):
+        pool = transforms.DecoderPool(size=1, timeout=10)
+        try:
+            assert pool.run(_add, 1, 2) == 3
+            assert pool.run(_get_pid) != os.getpid()
+        finally:
+            pool.terminate()
+
+    def test_workers_are_reused(self):
+        pool = transforms.DecoderPool(size=1, timeout=10)
+        try:
+            assert pool.run(_get_pid) == pool.run(_get_pid)
+        finally:
+            pool.terminate()
+
+    def test_workers_are_recycled(self):
+        pool = transforms.DecoderPool(size=1, timeout=10, max_jobs_per_worker=1)
+        try:
+            assert pool.run(_get_pid) != pool.run(_get_pid)
+        finally:
+            pool.terminate()
+
+    def test_timeout_is_transformexception_and_restarts_pool(self):
+        pool = transforms.DecoderPool(size=1, timeout=0.5)
+        try:
+            with pytest.raises(TransformException):
+                pool.run(_sleep, 5)
+            assert pool.run(_add, 1, 2) == 3
+        finally:
+            pool.terminate()
+
+    def test_other_jobs_finish_when_one_times_out(self):
+        pool = transforms.DecoderPool(size=2, timeout=5)
+        try:
+            stuck = pool.submit(_sleep, 10)
+            other = pool.submit(_sleep_and_return, 1, 'done')
+            with pytest.raises(TransformException):
+                pool.wait(stuck, timeout=0.3)
+            assert pool.wait(other) == 'done'
+        finally:
+            pool.terminate()
+
+    def test_decoder_is_killed_after_its_timeout(self):
+        start = time.time()
+        returncode, _ = transforms._run_decoder(
+            ['sleep', '10'], dict(os.environ), timeout=0.2
+        )
+        assert returncode != 0
+        assert time.time() - start < 5
+
+    def test_terminated_workers_kill_their_decoders(self, tmpdir):
+        pid_fp = str(tmpdir.join('pid'))
+        pool = transforms.DecoderPool(size=1, timeout=10)
+        try:
+            pool.submit(transforms._run_decoder,
+                ['sh', '-c', 'echo $$ > %s; exec sleep 30' % pid_fp], dict(os.environ))
+            for _ in range(100):
+                if os.path.exists(pid_fp) and os.path.getsize(pid_fp):
+                    break
+                time.sleep(0.05)
+            with open(pid_fp) as f:
+                pid = int(f.read())
+            assert _pid_is_running(pid)
+        finally:
+            pool.terminate()
+        for _ in range(100):
+            if not _pid_is_running(pid):
+                break
+            time.sleep(0.05)
+        assert not _pid_is_running(pid)
+
+
+class TestMergeAdjacent(object):
+
+    def _merged(self, *rects):
+        return sorted(
+            (rect, sorted(m[0] for m in members))
+            for rect, members in transforms._merge_adjacent([(r,) for r in rects])
+        )
+
+    def test_merges_a_grid_of_tiles(self):
+        tiles = [(x, y, x + 10, y + 10) for x in (0, 10, 20) for y in (0, 10)]
+        assert self._merged(*tiles) == [((0, 0, 30, 20), sorted(tiles))]
+
+    def test_merges_overlapping_regions(self):
+        assert self._merged((0, 0, 10, 10), (5, 5, 15, 15)) == [
+            ((0, 0, 15, 15), [(0, 0, 10, 10), (5, 5, 15, 15)])
+        ]
+
+    def test_does_not_merge_corners_or_gaps(self):
+        assert len(self._merged((0, 0, 10, 10), (10, 10, 20, 20))) == 2
+        assert len(self._merged((0, 0, 10, 10), (11, 0, 20, 10))) == 2
+
+    def test_merges_through_a_later_region(self):
+        # The third region joins the first two, which don't touch each other
+        assert self._merged((0, 0, 10, 10), (20, 0, 30, 10), (10, 0, 20, 10)) == [
+            ((0, 0, 30, 10), [(0, 0, 10, 10), (10, 0, 20, 10), (20, 0, 30, 10)])
+        ]
+
+
+class RecordingTransformer(object):
+    # (mock.Mock isn't thread safe)
+    def __init__(self, batch_error=None):
+        self.batch_error = batch_error
+        self.batches = []
+        self.transformed = []
+
+    def transform_batch(self, target_fps, image_requests, image_info):
+        self.batches.append((target_fps, image_requests))
+        if self.batch_error:
+            raise self.batch_error
+
+    def transform(self, target_fp, image_request, image_info):
+        self.transformed.append(target_fp)
+
+
+class TestTransformBatcher(object):
+
+    def _transform_concurrently(self, batcher, transformer, n):
+        info = img_info.ImageInfo(None, src_img_fp='/img.jp2')
+        threads = [
+            threading.Thread(target=batcher.transform,
+                             args=(transformer, 'out-%d' % i, 'request-%d' % i, info))
+            for i in range(n)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def test_concurrent_requests_are_one_batch(self):
+        transformer = RecordingTransformer()
+        self._transform_concurrently(transforms.TransformBatcher(0.2), transformer, 3)
+        assert len(transformer.batches) == 1
+        target_fps, requests = transformer.batches[0]
+        assert sorted(target_fps) == ['out-0', 'out-1', 'out-2']
+        assert sorted(requests) == ['request-0', 'request-1', 'request-2']
+        assert transformer.transformed == []
+
+    def test_failed_batch_is_retried_request_by_request(self):
+        transformer = RecordingTransformer(batch_error=TransformException('boom'))
+        self._transform_concurrently(transforms.TransformBatcher(0.2), transformer, 2)
+        assert sorted(transformer.transformed) == ['out-0', 'out-1']
+
+
+class TestFIFOReader(object):
+
+    def _read_from_writer(self, tmpdir, data, **kwargs):
+        fifo_fp = str(tmpdir.join('fifo.pnm'))
+        os.mkfifo(fifo_fp)
+
+        def write():
+            with open(fifo_fp, 'wb') as f:
+                f.write(data)
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        try:
+            reader = transforms._FIFOReader(fifo_fp, time.time() + 5, **kwargs)
+            return reader.read()
+        finally:
+            writer.join()
+
+    def test_reads_pgm(self, tmpdir):
+        data = b'P5\n# a comment\n3 2\n255\n' + bytearray(range(6))
+        im = self._read_from_writer(tmpdir, data)
+        assert im.mode == 'L'
+        assert im.size == (3, 2)
+        assert list(im.getdata()) == list(range(6))
+
+    def test_reads_ppm(self, tmpdir):
+        data = b'P6 1 2 255 ' + b'abcdef'
+        im = self._read_from_writer(tmpdir, data)
+        assert im.mode == 'RGB'
+        assert list(im.getdata()) == [(97, 98, 99), (100, 101, 102)]
+
+    def test_scales_16_bit_samples(self, tmpdir):
+        data = b'P5 3 1 4095\n' + b'\x00\x00\x08\x00\x0f\xff'
+        im = self._read_from_writer(tmpdir, data)
+        assert list(im.getdata()) == [0, 127, 255]
+
+    def test_truncated_output_is_transformexception(self, tmpdir):
+        with pytest.raises(TransformException):
+            self._read_from_writer(tmpdir, b'P5 10 10 255\n' + b'x' * 50)
+
+    def test_dead_decoder_does_not_hang(self, tmpdir):
+        fifo_fp = str(tmpdir.join('fifo.pnm'))
+        os.mkfifo(fifo_fp)
+
+        def check_decoder():
+            raise TransformException('decoder exited')
+
+        reader = transforms._FIFOReader(fifo_fp, time.time() + 5, check_decoder)
+        with pytest.raises(TransformException) as err:
+            reader.read()
+        assert 'decoder exited' in str(err.value)
+
+    def test_deadline(self, tmpdir):
+        fifo_fp = str(tmpdir.join('fifo.pnm'))
+        os.mkfifo(fifo_fp)
+        reader = transforms._FIFOReader(fifo_fp, time.time() + 0.2)
+        with pytest.raises(TransformException) as err:
+            reader.read()
+        assert 'timed out' in str(err.value)
+
+
 class UnitTest_KakaduJP2Transformer(unittest.TestCase):
 
     def test_init(self):
@@ -117,11 +401,79 @@ class UnitTest_KakaduJP2Transformer(unittest.TestCase):
         config['timeout'] = 100
         kdu_transformer = transforms.KakaduJP2Transformer(config)
         self.assertEqual(kdu_transformer.transform_timeout, 100)
+        self.assertEqual(kdu_transformer.decoder_pool.timeout, 100)
+
+    def test_decoder_pool_config(self):
+        config = {'kdu_expand': '', 'num_threads': 4, 'kdu_libs': '',
+                  'tmp_dp': '/tmp/loris/tmp', 'target_formats': [],
+                  'dither_bitonal_images': '', 'decoder_pool_size': 3,
+                  'decoder_pool_max_jobs': 50}
+        kdu_transformer = transforms.KakaduJP2Transformer(config)
+        self.assertEqual(kdu_transformer.decoder_pool.size, 3)
+        self.assertEqual(kdu_transformer.decoder_pool.max_jobs_per_worker, 50)
+
+    def test_pnm_format_matches_components(self):
+        config = {'kdu_expand': '', 'num_threads': 4, 'kdu_libs': '',
+                  'tmp_dp': '/tmp/loris/tmp', 'target_formats': [],
+                  'dither_bitonal_images': ''}
+        kdu_transformer = transforms.KakaduJP2Transformer(config)
+        info = img_info.ImageInfo(None)
+        info.profile = img_info.Profile(
+            description={'qualities': ['default', 'bitonal', 'gray']}
+        )
+        self.assertEqual(kdu_transformer._pnm_format(info), 'pgm')
+        info.profile.description['qualities'] += ['color']
+        self.assertEqual(kdu_transformer._pnm_format(info), 'ppm')
+
+    def test_kdu_cmd_does_not_need_a_shell(self):
+        config = {'kdu_expand': '/bin/kdu_expand', 'num_threads': 4,
+                  'kdu_libs': '', 'tmp_dp': '/tmp/loris/tmp',
+                  'target_formats': [], 'dither_bitonal_images': ''}
+        kdu_transformer = transforms.KakaduJP2Transformer(config)
+        info = img_info.ImageInfo(None, src_img_fp='/images/my image.jp2')
+        info.width = 1000
+        info.height = 1000
+        info.tiles = []
+        request = img.ImageRequest('id', '0,0,500,500', 'full', '0', 'default', 'jpg')
+        cmd = kdu_transformer._kdu_cmd(
+            info, request.region_param(info),
+            kdu_transformer._scales_to_reduce_arg(request, info), '/tmp/fifo.bmp'
+        )
+        self.assertEqual(cmd, [
+            '/bin/kdu_expand', '-quiet', '-i', '/images/my image.jp2',
+            '-num_threads', '4', '-region', '{0,0},{0.5,0.5}',
+            '-o', '/tmp/fifo.bmp'
+        ])
+
+    def test_kdu_cmd_reduces_regions(self):
+        config = {'kdu_expand': '/bin/kdu_expand', 'num_threads': 4,
+                  'kdu_libs': '', 'tmp_dp': '/tmp/loris/tmp',
+                  'target_formats': [], 'dither_bitonal_images': ''}
+        kdu_transformer = transforms.KakaduJP2Transformer(config)
+        info = img_info.ImageInfo(None, src_img_fp='/images/my image.jp2')
+        info.width = 1000
+        info.height = 1000
+        info.tiles = [{'width': 256, 'scaleFactors': [1, 2, 4, 8]}]
+
+        for size, reduce_arg in [('125,', '2'), ('126,', '1'), ('full', None), ('600,', None)]:
+            request = img.ImageRequest('id', '0,0,500,500', size, '0', 'default', 'jpg')
+            cmd = kdu_transformer._kdu_cmd(
+                info, request.region_param(info),
+                kdu_transformer._scales_to_reduce_arg(request, info), '/tmp/fifo.ppm'
+            )
+            # The region is still given relative to the full image
+            self.assertEqual(cmd[6:8], ['-region', '{0,0},{0.5,0.5}'])
+            if reduce_arg:
+                self.assertEqual(cmd[8:10], ['-reduce', reduce_arg])
+            else:
+                self.assertNotIn('-reduce', cmd)
 
 
 class Test_KakaduJP2Transformer(loris_t.LorisTest,
                                 ColorConversionMixin,
-                                _ResizingTestMixin):
+                                _ResizingTestMixin,
+                                _ReducedRegionTestMixin):
+    debug_config = 'kdu'
 
     def setUp(self):
         super(Test_KakaduJP2Transformer, self).setUp()
@@ -137,6 +489,58 @@ class Test_KakaduJP2Transformer(loris_t.LorisTest,
 
         self.assertEqual(expected_dims, image.size)
 
+    def _assert_batch_matches_single_renders(self, regions, expected_decodes):
+        ident = self.test_jp2_gray_id
+        info = self.app.resolver.resolve(self.app, ident, 'http://localhost/' + ident)
+        transformer = self.app.transformers['jp2']
+        requests = [
+            img.ImageRequest(ident, region, size, '0', 'default', 'png')
+            for region, size in regions
+        ]
+        mkdir_p(self.app.tmp_dp)
+
+        def target_fps(label):
+            return [
+                os.path.join(self.app.tmp_dp, '%s-%d.png' % (label, i))
+                for i in range(len(requests))
+            ]
+
+        with mock.patch.object(transformer, '_decode_region',
+                               wraps=transformer._decode_region) as decode:
+            transformer.transform_batch(target_fps('batch'), requests, info)
+        self.assertEqual(decode.call_count, expected_decodes)
+
+        for request, batch_fp, single_fp in zip(requests, target_fps('batch'),
+                                                target_fps('single')):
+            transformer.transform(single_fp, request, info)
+            batched = Image.open(batch_fp)
+            single = Image.open(single_fp)
+            self.assertEqual(batched.size, single.size)
+            self.assertIsNone(ImageChops.difference(batched, single).getbbox())
+
+    def test_transform_batch_decodes_adjacent_tiles_once(self):
+        # Four neighbouring tiles at -reduce 2, one region elsewhere at the
+        # same level, and a tile at full resolution.
+        self._assert_batch_matches_single_renders([
+            ('0,0,1024,1024', '256,'),
+            ('1024,0,1024,1024', '256,'),
+            ('0,1024,1024,1024', '256,'),
+            ('1024,1024,1024,1024', '256,'),
+            ('2048,2048,429,1152', ',288'),
+            ('0,0,256,256', '256,'),
+        ], expected_decodes=3)
+
+    def test_transform_batch_splits_large_areas(self):
+        transformer = self.app.transformers['jp2']
+        # two of the 256x256 (reduced) tiles at a time
+        with mock.patch.dict(transformer.config, {'batch_max_pixels': 2 * 256 * 256}):
+            self._assert_batch_matches_single_renders([
+                ('0,0,1024,1024', '256,'),
+                ('1024,0,1024,1024', '256,'),
+                ('0,1024,1024,1024', '256,'),
+                ('1024,1024,1024,1024', '256,'),
+            ], expected_decodes=2)
+
     def test_can_edit_embedded_color_profile(self):
         self._assert_can_edit_embedded_color_profile(
             ident=self.test_jp2_with_embedded_profile_id,
@@ -145,7 +549,10 @@ class Test_KakaduJP2Transformer(loris_t.LorisTest,
         )
 
 
-class Test_OPJ_JP2Transformer(loris_t.LorisTest, ColorConversionMixin):
+class Test_OPJ_JP2Transformer(loris_t.LorisTest,
+                              ColorConversionMixin,
+                              _ReducedRegionTestMixin):
+    debug_config = 'opj'
 
     def setUp(self):
         super(Test_OPJ_JP2Transformer, self).setUp()
@@ -164,6 +571,60 @@ class Test_OPJ_JP2Transformer(loris_t.LorisTest, ColorConversionMixin):
         )
 
 
+class Test_PillowJP2Transformer(loris_t.LorisTest,
+                                ColorConversionMixin,
+                                _ResizingTestMixin,
+                                _ReducedRegionTestMixin):
+    debug_config = 'pillow'
+
+    def setUp(self):
+        super(Test_PillowJP2Transformer, self).setUp()
+        self.build_client_from_config(get_debug_config('pillow'))
+        self.ident = self.test_jp2_gray_id
+
+    def test_is_configured(self):
+        assert isinstance(
+            self.app.transformers['jp2'], transforms.PillowJP2Transformer
+        )
+
+    def test_can_edit_embedded_color_profile(self):
+        self._assert_can_edit_embedded_color_profile(
+            ident=self.test_jp2_with_embedded_profile_id,
+            transformer='jp2',
+            debug_config='pillow'
+        )
+
+    def test_region_matches_kakadu(self):
+        request_path = '/%s/200,400,300,300/full/0/default.png' % self.ident
+        image = self.request_image_from_client(request_path)
+        assert image.size == (300, 300)
+
+        self.build_client_from_config(get_debug_config('kdu'))
+        kdu_image = self.request_image_from_client(request_path)
+
+        # Both decoders are lossless for the same codestream, so the pixels
+        # should be (nearly) identical.
+        diff = ImageChops.difference(image, kdu_image).convert('L')
+        assert max(diff.getdata()) <= 2
+
+    def test_reduce_levels_with_odd_dimensions(self):
+        # 2477 / 4 and 2477 / 32 round differently in Pillow and OpenJPEG
+        for size, expected in [('620,', (620, 800)), ('!77,100', (77, 99))]:
+            request_path = '/%s/full/%s/0/default.png' % (self.ident, size)
+            image = self.request_image_from_client(request_path)
+            assert image.size == expected
+
+    def test_reduced_box_covers_region(self):
+        transformer = self.app.transformers['jp2']
+        info = img_info.ImageInfo(None)
+        info.width = 1000
+        info.height = 1000
+        region_param = img.ImageRequest(
+            'id', '101,101,301,301', 'full', '0', 'default', 'jpg'
+        ).region_param(info)
+        assert transformer._region_to_reduced_box(region_param, 4) == (25, 25, 101, 101)
+
+
 class Test_PILTransformer(loris_t.LorisTest,
                           ColorConversionMixin,
                           _ResizingTestMixin):
@@ -1,6 +1,9 @@
 # -*- encoding: utf-8
 
+import fcntl
 import os
+import threading
+import time
 
 import mock
 import pytest
@@ -120,3 +123,57 @@ class TestSymlink:
         utils.symlink(symlink_src, dst)
         self._assert_is_symlink(symlink_src, dst)
         assert open(dst, 'wb') != b'I am the old file'
+
+
+class TestKeyedLock:
+
+    def test_only_one_holder_per_key(self):
+        lock = utils.KeyedLock()
+        active = []
+        overlaps = []
+
+        def worker():
+            with lock.lock('key'):
+                active.append(1)
+                if len(active) > 1:
+                    overlaps.append(len(active))
+                time.sleep(0.01)
+                active.pop()
+
+        threads = [threading.Thread(target=worker) for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert overlaps == []
+
+    def test_different_keys_do_not_block(self):
+        lock = utils.KeyedLock()
+        with lock.lock('key1'):
+            with lock.lock('key2'):
+                assert len(lock) == 2
+
+    def test_locks_are_discarded_after_use(self):
+        lock = utils.KeyedLock()
+        with lock.lock('key'):
+            pass
+        assert len(lock) == 0
+
+
+class TestLockFile:
+
+    def test_creates_lock_file_and_directories(self, tmpdir):
+        path = str(tmpdir.join('locks', 'a.lock'))
+        with utils.lock_file(path):
+            assert os.path.exists(path)
+
+    def test_lock_is_exclusive(self, tmpdir):
+        path = str(tmpdir.join('a.lock'))
+        with utils.lock_file(path):
+            fd = os.open(path, os.O_RDWR)
+            try:
+                with pytest.raises(IOError):
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            finally:
+                os.close(fd)
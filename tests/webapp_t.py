@@ -4,20 +4,25 @@
 from __future__ import absolute_import
 
 from datetime import datetime
+import os
 from os import path, listdir
 from time import sleep
 from unittest import TestCase
 import re
+import threading
 
+import mock
 import pytest
 from werkzeug.datastructures import Headers
 from werkzeug.http import http_date
 from werkzeug.test import EnvironBuilder
 from werkzeug.wrappers import Request
 
-from loris import img_info, webapp
-from loris.loris_exception import ConfigError
-from loris.transforms import KakaduJP2Transformer, OPJ_JP2Transformer
+from loris import img, img_info, webapp
+from loris.loris_exception import ConfigError, TransformException
+from loris.transforms import (
+    KakaduJP2Transformer, OPJ_JP2Transformer, TransformBatcher
+)
 from tests import loris_t
 
 
@@ -615,3 +620,338 @@ class SizeRestriction(loris_t.LorisTest):
         request_path = '/%s/full/pct:120/0/default.jpg' % (self.test_jpeg_id,)
         resp = self.client.get(request_path)
         self.assertEqual(resp.status_code, 200)
+
+
+class ImageETags(loris_t.LorisTest):
+
+    def setUp(self):
+        super(ImageETags, self).setUp()
+        self.url = '/%s/full/pct:10/0/default.jpg' % self.test_jpeg_id
+
+    def test_rendered_and_cached_images_have_the_same_etag(self):
+        first = self.client.get(self.url)
+        etag = first.headers['ETag']
+        assert etag.startswith('"')
+        second = self.client.get(self.url)
+        assert second.headers['ETag'] == etag
+        assert second.headers['Last-Modified'] == first.headers['Last-Modified']
+
+    def test_if_none_match_is_answered_without_opening_the_file(self):
+        etag = self.client.get(self.url).headers['ETag']
+        headers = Headers([('If-None-Match', etag)])
+        with mock.patch('loris.webapp.open', create=True,
+                        side_effect=AssertionError):
+            resp = self.client.get(self.url, headers=headers)
+        assert resp.status_code == 304
+        assert resp.headers['ETag'] == etag
+        assert resp.data == b''
+
+    def test_if_none_match_with_another_etag(self):
+        self.client.get(self.url)
+        headers = Headers([('If-None-Match', '"something else", "other"')])
+        assert self.client.get(self.url, headers=headers).status_code == 200
+
+    def test_if_none_match_takes_precedence_over_if_modified_since(self):
+        first = self.client.get(self.url)
+        headers = Headers([
+            ('If-None-Match', '"something else"'),
+            ('If-Modified-Since', first.headers['Last-Modified']),
+        ])
+        assert self.client.get(self.url, headers=headers).status_code == 200
+
+    def test_a_new_rendering_gets_a_new_etag(self):
+        etag = self.client.get(self.url).headers['ETag']
+        fp = self.app.img_cache.get_entry(
+            img.ImageRequest(self.test_jpeg_id, 'full', 'pct:10', '0', 'default', 'jpg')
+        ).fp
+        st = os.stat(fp)
+        os.utime(fp, (st.st_atime, st.st_mtime + 10))
+        assert self.client.get(self.url).headers['ETag'] != etag
+
+    def test_etags_from_memory(self):
+        self.app.memory_cache = img.MemoryImageCache(max_size=1024 * 1024)
+        etag = self.client.get(self.url).headers['ETag']
+        headers = Headers([('If-None-Match', etag)])
+        resp = self.client.get(self.url, headers=headers)
+        assert resp.status_code == 304
+        assert self.app.memory_cache.hits == 1
+
+
+class SendFile(loris_t.LorisTest):
+
+    def setUp(self):
+        super(SendFile, self).setUp()
+        self.url = '/%s/full/pct:10/0/default.jpg' % self.test_jpeg_id
+        self.first = self.client.get(self.url)
+
+    def _get_cached(self):
+        with mock.patch('loris.webapp.open', create=True,
+                        side_effect=AssertionError):
+            resp = self.client.get(self.url)
+        assert resp.status_code == 200
+        assert resp.headers['Content-Type'] == 'image/jpeg'
+        assert resp.headers['ETag'] == self.first.headers['ETag']
+        return resp
+
+    def test_x_sendfile(self):
+        self.app.send_file = 'x-sendfile'
+        resp = self._get_cached()
+        fp = resp.headers['X-Sendfile']
+        assert path.isabs(fp)
+        with open(fp, 'rb') as f:
+            assert f.read() == self.first.data
+        assert resp.data == b''
+        assert 'Content-Length' not in resp.headers
+
+    def test_x_accel_redirect(self):
+        self.app.send_file = 'x-accel-redirect'
+        self.app.x_accel_redirect_prefix = '/internal/'
+        resp = self._get_cached()
+        # (the symlink for the request; nginx follows it)
+        assert resp.headers['X-Accel-Redirect'] == (
+            '/internal/01/03/0001.jpg/full/pct%3A10/0/default.jpg'
+        )
+        assert resp.data == b''
+
+    def test_wsgi_file_wrapper(self):
+        self.app.send_file = 'wsgi'
+        wrapped = []
+
+        def file_wrapper(f, block_size=8192):
+            wrapped.append(f)
+            return iter(lambda: f.read(block_size), b'')
+
+        resp = self.client.get(
+            self.url, environ_overrides={'wsgi.file_wrapper': file_wrapper}
+        )
+        assert len(wrapped) == 1
+        assert resp.data == self.first.data
+        assert resp.headers['Content-Length'] == str(len(self.first.data))
+
+    def test_small_images_still_go_to_memory(self):
+        self.app.send_file = 'x-sendfile'
+        self.app.memory_cache = img.MemoryImageCache(max_size=1024 * 1024)
+        resp = self.client.get(self.url)
+        assert 'X-Sendfile' not in resp.headers
+        assert resp.data == self.first.data
+
+    def test_bad_mode(self):
+        config = webapp.get_debug_config('kdu')
+        config['loris.Loris']['send_file'] = 'carrier-pigeon'
+        with pytest.raises(ConfigError):
+            webapp.Loris(config)
+
+
+class MemoryCaching(loris_t.LorisTest):
+
+    def setUp(self):
+        super(MemoryCaching, self).setUp()
+        self.app.memory_cache = img.MemoryImageCache(max_size=1024 * 1024)
+        self.url = '/%s/full/pct:10/0/default.jpg' % self.test_jpeg_id
+
+    def test_small_images_are_served_from_memory(self):
+        first = self.client.get(self.url)
+        assert self.app.memory_cache.misses == 1
+        assert len(self.app.memory_cache) == 1
+
+        with mock.patch('loris.webapp.open', create=True,
+                        side_effect=AssertionError):
+            second = self.client.get(self.url)
+        assert second.status_code == 200
+        assert second.data == first.data
+        assert second.headers['Content-Type'] == 'image/jpeg'
+        assert second.headers['Content-Length'] == str(len(first.data))
+        assert second.headers['Last-Modified'] == first.headers['Last-Modified']
+        assert second.headers['Link'] == first.headers['Link']
+        assert self.app.memory_cache.hits == 1
+
+    def test_if_modified_since(self):
+        first = self.client.get(self.url)
+        headers = Headers([('If-Modified-Since', first.headers['Last-Modified'])])
+        second = self.client.get(self.url, headers=headers)
+        assert second.status_code == 304
+        assert self.app.memory_cache.hits == 1
+
+    def test_large_images_are_streamed_from_disk(self):
+        self.app.memory_cache = img.MemoryImageCache(max_size=1024 * 1024,
+                                                     max_file_size=100)
+        self.client.get(self.url)
+        resp = self.client.get(self.url)
+        assert resp.status_code == 200
+        assert len(self.app.memory_cache) == 0
+
+
+class TestRenderStream(object):
+
+    def test_sends_and_writes_what_is_written(self, tmpdir):
+        temp_fp = str(tmpdir.join('x.jpg'))
+        stream = webapp.RenderStream(temp_fp)
+        stream.write(b'abc')
+        stream.write(b'def')
+        assert stream.tell() == 6
+        stream.finish()
+        assert b''.join(stream) == b'abcdef'
+        with open(temp_fp, 'rb') as f:
+            assert f.read() == b'abcdef'
+
+    def test_chunks_are_sent_while_writing(self, tmpdir):
+        stream = webapp.RenderStream(str(tmpdir.join('x.jpg')))
+        stream.write(b'abc')
+        chunks = iter(stream)
+        assert next(chunks) == b'abc'
+        stream.write(b'def')
+        stream.finish()
+        assert list(chunks) == [b'def']
+
+    def test_failure_before_anything_is_sent_is_raised(self, tmpdir):
+        temp_fp = str(tmpdir.join('x.jpg'))
+        stream = webapp.RenderStream(temp_fp)
+        stream.write(b'abc')
+        stream.fail(TransformException('no'))
+        with pytest.raises(TransformException):
+            stream.wait()
+        assert not path.exists(temp_fp)
+
+    def test_failure_part_way_ends_the_body_with_it(self, tmpdir):
+        stream = webapp.RenderStream(str(tmpdir.join('x.jpg')))
+        stream.write(b'abc')
+        chunks = iter(stream)
+        assert next(chunks) == b'abc'
+        stream.fail(TransformException('no'))
+        with pytest.raises(TransformException):
+            next(chunks)
+
+
+class StreamRenders(loris_t.LorisTest):
+
+    def setUp(self):
+        super(StreamRenders, self).setUp()
+        self.app.stream_renders = True
+        self.url = '/%s/full/pct:10/0/default.jpg' % self.test_jpeg_id
+
+    def _temp_files(self):
+        return [n for n in listdir(self.app.tmp_dp)
+                if path.isfile(path.join(self.app.tmp_dp, n))]
+
+    def test_render_is_streamed_and_cached(self):
+        resp = self.client.get(self.url)
+        assert resp.status_code == 200
+        assert resp.headers['Content-Type'] == 'image/jpeg'
+        assert 'Content-Length' not in resp.headers
+        assert 'ETag' not in resp.headers
+        resp.data  # (the render finishes as the body is read)
+
+        image_request = img.ImageRequest(
+            self.test_jpeg_id, 'full', 'pct:10', '0', 'default', 'jpg'
+        )
+        entry = self.app.img_cache.get_entry(image_request)
+        with open(entry.fp, 'rb') as f:
+            assert f.read() == resp.data
+        assert not self._temp_files()
+
+        second = self.client.get(self.url)
+        assert second.data == resp.data
+        assert second.headers['Content-Length'] == str(len(resp.data))
+
+    def test_nothing_is_cached_until_the_image_is_complete(self):
+        transformer = self.app.transformers['jpg']
+        original_transform = transformer.transform
+        cache_fps = []
+
+        def transform(target_fp, image_request, image_info):
+            original_transform(target_fp, image_request, image_info)
+            cache_fps.append(self.app.img_cache.get_canonical_cache_path(
+                image_request, image_info
+            ))
+            assert not path.exists(cache_fps[0])
+
+        transformer.transform = transform
+        resp = self.client.get(self.url)
+        assert resp.status_code == 200
+        resp.data
+        assert path.exists(cache_fps[0])
+
+    def test_failed_render_is_an_error_response(self):
+        transformer = self.app.transformers['jpg']
+        transformer.transform = mock.Mock(side_effect=TransformException('no'))
+        resp = self.client.get(self.url)
+        assert resp.status_code == 500
+        assert not self._temp_files()
+        resp = self.client.get(self.url)
+        assert resp.status_code == 500
+
+    def test_formats_that_seek_are_not_streamed(self):
+        resp = self.client.get('/%s/full/pct:10/0/default.tif' % self.test_jpeg_id)
+        assert resp.status_code == 200
+        assert 'ETag' in resp.headers
+
+
+class ConcurrentRendering(loris_t.LorisTest):
+
+    def _count_transforms(self, src_format):
+        transformer = self.app.transformers[src_format]
+        original_transform = transformer.transform
+        calls = []
+
+        def slow_transform(*args, **kwargs):
+            calls.append(1)
+            sleep(0.2)
+            return original_transform(*args, **kwargs)
+
+        transformer.transform = slow_transform
+        return calls
+
+    def test_identical_requests_are_rendered_once(self):
+        calls = self._count_transforms('jpg')
+        to_get = '/%s/full/200,/0/default.jpg' % (self.test_jpeg_id,)
+        statuses = []
+
+        def fetch():
+            statuses.append(self.client.get(to_get).status_code)
+
+        threads = [threading.Thread(target=fetch) for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(statuses, [200] * 5)
+        self.assertEqual(len(calls), 1)
+
+    def test_equivalent_requests_share_a_render(self):
+        # Both of these requests have the canonical form full/200,/0/...
+        calls = self._count_transforms('jpg')
+        self.client.get('/%s/full/200,/0/default.jpg' % (self.test_jpeg_id,))
+        resp = self.client.get('/%s/full/!200,200/0/default.jpg' % (self.test_jpeg_id,))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(calls), 1)
+
+    def test_lock_files_are_used_when_configured(self):
+        self.app.img_cache.use_lock_files = True
+        to_get = '/%s/full/200,/0/default.jpg' % (self.test_jpeg_id,)
+        resp = self.client.get(to_get)
+        self.assertEqual(resp.status_code, 200)
+        lock_dp = path.join(self.app.img_cache.cache_root, '.locks')
+        self.assertEqual(len(listdir(lock_dp)), 1)
+
+    def test_tiles_requested_together_share_a_decode(self):
+        self.app.transform_batcher = TransformBatcher(0.5)
+        transformer = self.app.transformers['jp2']
+        tiles = ['0,0,1024,1024', '1024,0,1024,1024', '0,1024,1024,1024']
+        statuses = []
+
+        def fetch(region):
+            statuses.append(self.client.get(
+                '/%s/%s/256,/0/default.jpg' % (self.test_jp2_gray_id, region)
+            ).status_code)
+
+        threads = [threading.Thread(target=fetch, args=(t,)) for t in tiles]
+        with mock.patch.object(transformer, '_decode_region',
+                          wraps=transformer._decode_region) as decode:
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+        self.assertEqual(statuses, [200] * 3)
+        self.assertEqual(decode.call_count, 1)